@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+قياس أداء برنامج السهولة في البناء على بيانات اصطناعية
+
+يولد قاعدة بيانات بحجم محدد (هيكل تنظيمي وموظفين وعهد وبنود مالية وتواجد)
+بمولد حتمي (نفس البذرة = نفس البيانات)، ثم يقيس زمن العمليات الرئيسية
+ويطبع النتائج بصيغة JSON للمقارنة بين الإصدارات:
+
+    python benchmark_construction_program.py --scale 100k --repeat 20 --output bench.json
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import construction_program
+from construction_program import ConstructionProgram
+
+# أحجام القياس المعتمدة (عدد الموظفين)
+SCALES = {
+    '10k': 10_000,
+    '100k': 100_000,
+    '1m': 1_000_000,
+    '10m': 10_000_000,
+}
+
+POSITIONS = ['كهربائي', 'سباك', 'نجار', 'حداد', 'مهندس موقع', 'مراقب جودة', 'سائق معدات', 'عامل']
+LEVELS = ['م1', 'م2', 'م3', 'م4', 'م5']
+QUALIFICATIONS = ['دبلوم كهرباء', 'دبلوم ميكانيكا', 'بكالوريوس هندسة', 'ثانوية', '']
+COURSES = ['السلامة في المشاريع', 'الإسعافات الأولية', 'تشغيل المعدات', '']
+EQUIPMENT = ['خوذة أمان, قفازات عمل', 'خوذة أمان', 'حذاء سلامة, نظارات', '']
+# أنواع العهد من مفاتيح ASSET_STANDARDS حتى تقيس محركات الاحتياج والنواقص معاييرها الفعلية
+ASSETS = [('كمبريشن هواء', 'متوسطة'), ('مولد كهرباء', 'ثقيلة'), ('مثقاب', 'خفيفة'),
+          ('سقالة', 'متوسطة'), ('خلاطة خرسانة', 'ثقيلة'), ('عدة يدوية', 'خفيفة'),
+          ('جهاز لاسلكي', 'تواصلية'), ('قفازات عمل', 'استهلاكية')]
+FINANCIAL_ITEMS = ['الرواتب', 'التغذية', 'الإسكان', 'الصحية', 'الإيجارات', 'الصيانة']
+COMPANY = 'الشركة المعمارية العالمية'
+
+
+def parse_scale(value):
+    """تحويل الحجم ('100k' أو رقم) إلى عدد موظفين"""
+    value = str(value).lower()
+    if value in SCALES:
+        return SCALES[value]
+    return int(value)
+
+
+class WorkforceGenerator:
+    """مولد حتمي لبيانات شركة بناء بحجم معين"""
+
+    def __init__(self, employees, seed=2024, months=3, attendance_days=10):
+        self.employees = employees
+        self.seed = seed
+        self.months = months
+        self.attendance_days = attendance_days
+        # مديرية لكل 2000 موظف تقريباً (بين 5 و 50)
+        self.directorates = [f'مديرية {i + 1}' for i in range(min(50, max(5, employees // 2000)))]
+
+    def org_units(self):
+        """الهيكل التنظيمي: مديرية > شعبة > إدارة > فرع > قسم"""
+        for directorate in self.directorates:
+            for department in range(1, 4):
+                for branch in range(1, 3):
+                    yield (COMPANY, directorate, f'شعبة {department}', f'إدارة {department}',
+                           f'فرع {branch}', f'قسم {branch}')
+
+    def employee_rows(self):
+        """صفوف الموظفين كقواميس جاهزة لـ add_employees_bulk"""
+        rng = random.Random(self.seed)
+        for i in range(self.employees):
+            directorate = self.directorates[i % len(self.directorates)]
+            department = rng.randint(1, 3)
+            branch = rng.randint(1, 2)
+            yield {
+                'global_id': f'RSA-{i:08d}',
+                'functional_id': f'{i % 1000:03d}',
+                'full_name': f'موظف {i}',
+                'position': rng.choice(POSITIONS),
+                'level': rng.choice(LEVELS),
+                'qualification': rng.choice(QUALIFICATIONS),
+                'training_courses': rng.choice(COURSES),
+                'personal_equipment': rng.choice(EQUIPMENT),
+                'equipment_notes': '',
+                'company': COMPANY,
+                'directorate': directorate,
+                'department': f'شعبة {department}',
+                'administration': f'إدارة {department}',
+                'branch': f'فرع {branch}',
+                'section': f'قسم {branch}',
+            }
+
+    def month_list(self):
+        """آخر الأشهر المولدة بصيغة YYYY-MM"""
+        return [f'{2024 + m // 12}-{m % 12 + 1:02d}' for m in range(self.months)]
+
+    def attendance_events(self):
+        """حركات تواجد يومية: attendance_days يوماً لكل موظف في كل شهر"""
+        rng = random.Random(self.seed + 1)
+        for month in self.month_list():
+            first_day = datetime.strptime(month + '-01', '%Y-%m-%d').date()
+            for i in range(self.employees):
+                # نسبة حضور ثابتة لكل موظف حتى تظهر تناقضات التواجد المنخفض
+                presence = 0.4 + 0.6 * ((i * 7919) % 100) / 100
+                for day in range(self.attendance_days):
+                    yield {
+                        'global_id': f'RSA-{i:08d}',
+                        'date': first_day + timedelta(days=day),
+                        'present': rng.random() < presence,
+                        'source': 'benchmark',
+                    }
+
+    def asset_rows(self):
+        """عهدة من كل نوع في كل مديرية"""
+        rng = random.Random(self.seed + 2)
+        for directorate in self.directorates:
+            for asset_name, asset_type in ASSETS:
+                required = rng.randint(5, 50)
+                current = rng.randint(0, required)
+                yield (asset_name, asset_type, current, required, required - current,
+                       'لكل 10 عمال', directorate, 'جاهز')
+
+    def financial_rows(self):
+        """بنود مالية يدوية لكل مديرية وشهر"""
+        rng = random.Random(self.seed + 3)
+        for month in self.month_list():
+            for directorate in self.directorates:
+                for item in FINANCIAL_ITEMS:
+                    employee_count = self.employees // len(self.directorates)
+                    amount = round(rng.uniform(100, 5000), 2)
+                    yield (item, 'يدوي', amount, '', employee_count, 80.0,
+                           amount * employee_count, month, directorate)
+
+
+@contextlib.contextmanager
+def quiet():
+    """إخفاء رسائل البرنامج أثناء القياس (الطباعة و stderr و logging)"""
+    previous = logging.root.manager.disable
+    logging.disable(logging.CRITICAL)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            yield
+    finally:
+        logging.disable(previous)
+
+
+def peak_rss_mb():
+    """أقصى ذاكرة مقيمة للعملية بالميغابايت (إن توفرت)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS يعيدها بالبايت و Linux بالكيلوبايت
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def populate(program, generator, chunk_size=10000):
+    """تعبئة القاعدة من المولد وإرجاع زمن ومعدل كل جدول"""
+    results = {}
+
+    def timed(name, function):
+        started = time.perf_counter()
+        count = function()
+        elapsed = time.perf_counter() - started
+        results[name] = {
+            'rows': count,
+            'seconds': elapsed,
+            'rows_per_second': count / elapsed if elapsed > 0 else None,
+        }
+
+    def insert_many(query, rows):
+        rows = list(rows)
+        program.db.write(lambda conn: conn.executemany(query, rows))
+        return len(rows)
+
+    with quiet():
+        timed('org_structure', lambda: insert_many('''
+            INSERT INTO organizational_structure (company, directorate, department, administration, branch, section)
+            VALUES (?, ?, ?, ?, ?, ?)''', generator.org_units()))
+        timed('employees', lambda: program.add_employees_bulk(
+            generator.employee_rows(), chunk_size=chunk_size)['imported'])
+        timed('attendance_events', lambda: program.record_attendance_bulk(
+            generator.attendance_events(), chunk_size=chunk_size)['recorded'])
+        timed('assets', lambda: insert_many('''
+            INSERT INTO assets (asset_name, asset_type, current_quantity, required_quantity,
+                                missing_quantity, calculation_standard, location, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', generator.asset_rows()))
+        timed('financial_items', lambda: insert_many('''
+            INSERT INTO financial_items (item_name, item_type, amount, calculation_formula,
+                                         employee_count, attendance_rate, total_amount, month, directorate)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', generator.financial_rows()))
+    return results
+
+
+def measure(name, function, repeat, rows=None):
+    """تكرار عملية وقياس توزيع زمنها وذروة الذاكرة المخصصة من بايثون
+
+    tracemalloc يبطئ كل تخصيص، لذا يقاس الزمن بدونه ثم تقاس الذاكرة في
+    استدعاء إضافي منفصل.
+    """
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        with quiet():
+            result = function()
+        latencies.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    try:
+        with quiet():
+            function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    if rows is None and hasattr(result, '__len__'):
+        rows = len(result)
+    latencies_ms = np.array(latencies) * 1000
+    total = float(np.sum(latencies))
+    return {
+        'operation': name,
+        'repeat': repeat,
+        'rows': rows,
+        'latency_ms': {
+            'min': float(latencies_ms.min()),
+            'p50': float(np.percentile(latencies_ms, 50)),
+            'p90': float(np.percentile(latencies_ms, 90)),
+            'p99': float(np.percentile(latencies_ms, 99)),
+            'max': float(latencies_ms.max()),
+            'mean': float(latencies_ms.mean()),
+        },
+        'peak_python_memory_mb': peak / (1024 * 1024),
+        'rows_per_second': (rows * repeat / total) if rows and total > 0 else None,
+    }
+
+
+def run_benchmark(employees, repeat=10, db_name=None, seed=2024, keep=False, months=3, attendance_days=10):
+    """تعبئة قاعدة جديدة بالحجم المطلوب وقياس العمليات الرئيسية"""
+    generator = WorkforceGenerator(employees, seed=seed, months=months, attendance_days=attendance_days)
+    db_name = db_name or f'benchmark_{employees}.db'
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_name + suffix):
+            os.remove(db_name + suffix)
+
+    with quiet():
+        program = ConstructionProgram(db_name)
+    try:
+        population = populate(program, generator)
+        directorate = generator.directorates[0]
+        month = generator.month_list()[-1]
+        # عداد مفتوح لأن measure يستدعي العملية مرة إضافية لقياس الذاكرة
+        sequence = itertools.count()
+
+        def add_employee():
+            i = next(sequence)
+            row = next(WorkforceGenerator(1, seed=seed + i).employee_rows())
+            row['global_id'] = f'RSA-NEW-{i:06d}'
+            return program.add_employee(row)
+
+        operations = [
+            measure('add_employee', add_employee, repeat, rows=1),
+            measure('get_employees', lambda: program.get_employees(directorate), repeat),
+            measure('analyze_discrepancies',
+                    lambda: program.analyze_discrepancies(directorate, month), repeat),
+            measure('comprehensive_analysis',
+                    lambda: program.comprehensive_analysis(directorate), repeat,
+                    rows=employees // len(generator.directorates)),
+            measure('calculate_all_financials',
+                    lambda: program.calculate_all_financials(directorate, month), repeat,
+                    rows=employees // len(generator.directorates)),
+            measure('show_dashboard', program.show_dashboard, repeat, rows=1),
+            *(measure(f'generate_report:{report_type}',
+                      lambda report_type=report_type: program.generate_report(report_type, directorate), repeat)
+              for report_type in ('بشري', 'مالي', 'عهد', 'تحليل')),
+        ]
+    finally:
+        with quiet():
+            program.close_connection()
+        if not keep:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_name + suffix):
+                    os.remove(db_name + suffix)
+
+    return {
+        'employees': employees,
+        'directorates': len(generator.directorates),
+        'seed': seed,
+        'months': months,
+        'attendance_days': attendance_days,
+        'schema_version': construction_program.SCHEMA_VERSION,
+        'python': platform.python_version(),
+        'sqlite': construction_program.sqlite3.sqlite_version,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'population': population,
+        'operations': operations,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='قياس أداء برنامج السهولة في البناء')
+    parser.add_argument('--scale', action='append',
+                        help='عدد الموظفين: 10k أو 100k أو 1m أو 10m أو رقم (يمكن تكراره)')
+    parser.add_argument('--repeat', type=int, default=10, help='عدد مرات تكرار كل عملية')
+    parser.add_argument('--seed', type=int, default=2024, help='بذرة المولد')
+    parser.add_argument('--months', type=int, default=3, help='عدد الأشهر المولدة')
+    parser.add_argument('--attendance-days', type=int, default=10,
+                        help='أيام التواجد المسجلة لكل موظف في الشهر (0 لتعطيلها)')
+    parser.add_argument('--db', help='مسار قاعدة القياس (افتراضياً benchmark_<الحجم>.db)')
+    parser.add_argument('--keep', action='store_true', help='إبقاء قاعدة القياس بعد الانتهاء')
+    parser.add_argument('--output', help='حفظ النتائج في ملف JSON بدل الطباعة')
+    args = parser.parse_args(argv)
+
+    results = [
+        run_benchmark(parse_scale(scale), repeat=args.repeat, db_name=args.db, seed=args.seed, keep=args.keep,
+                      months=args.months, attendance_days=args.attendance_days)
+        for scale in (args.scale or ['10k'])
+    ]
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
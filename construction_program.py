@@ -4,22 +4,1574 @@
 تم التطوير بناء على المواصفات المتفق عليها
 """
 import sqlite3
-import pandas as pd
+import importlib
 from datetime import datetime
 import json
 import os
+import pickle
+import sys
+import time
+import functools
+import threading
+import queue
+import contextlib
+import logging
+import collections
+import itertools
+import re
+from types import FunctionType
+
+
+class _LazyModule:
+    """وحدة ثقيلة لا تستورد إلا عند أول استخدام لأحد أسمائها
+
+    عند أول وصول تستبدل نفسها في globals بالوحدة الحقيقية فلا كلفة بعد ذلك.
+    بهذا لا تدفع أوامر سطر الأوامر البسيطة زمن استيراد pandas و numpy.
+    """
+
+    def __init__(self, module_name, alias):
+        self._module_name = module_name
+        self._alias = alias
+
+    def __getattr__(self, name):
+        module = importlib.import_module(self._module_name)
+        globals()[self._alias] = module
+        return getattr(module, name)
+
+
+pd = _LazyModule('pandas', 'pd')
+np = _LazyModule('numpy', 'np')
+asyncio = _LazyModule('asyncio', 'asyncio')
+# وحدات المكتبة القياسية التي لا تحتاجها إلا المسارات غير المتكررة (الاستيراد،
+# النسخ الاحتياطي، المعادلات، سطر الأوامر) تؤجل أيضاً لتقصير بدء التشغيل
+argparse = _LazyModule('argparse', 'argparse')
+ast = _LazyModule('ast', 'ast')
+csv = _LazyModule('csv', 'csv')
+futures = _LazyModule('concurrent.futures', 'futures')
+gzip = _LazyModule('gzip', 'gzip')
+inspect = _LazyModule('inspect', 'inspect')
+shutil = _LazyModule('shutil', 'shutil')
+urllib_parse = _LazyModule('urllib.parse', 'urllib_parse')
+
+# رسائل البرنامج تمر عبر logging؛ المكتبة صامتة ما لم يضبط المستخدم مستوى ومعالجاً
+logger = logging.getLogger('construction_program')
+logger.addHandler(logging.NullHandler())
+
+# أعمدة الموظف بالترتيب المستخدم في جمل الإدخال
+EMPLOYEE_FIELDS = (
+    'global_id', 'functional_id', 'full_name', 'position', 'level',
+    'qualification', 'training_courses', 'personal_equipment', 'equipment_notes',
+    'company', 'directorate', 'department', 'administration', 'branch', 'section'
+)
+
+# الحقول التي يشترطها add_employee (البقية اختيارية وتأخذ '' افتراضياً)
+EMPLOYEE_REQUIRED_FIELDS = (
+    'global_id', 'functional_id', 'full_name', 'position', 'level',
+    'company', 'directorate', 'department', 'administration', 'branch', 'section'
+)
+
+# الجداول التي تحفظ أعداد صفوفها في table_counts
+COUNTED_TABLES = ('employees', 'assets', 'financial_items')
+
+
+def _rebuild_rollups(cursor):
+    """إعادة حساب جداول التجميع من البيانات الفعلية"""
+    cursor.execute("DELETE FROM table_counts")
+    for table in COUNTED_TABLES:
+        cursor.execute(f"INSERT INTO table_counts (table_name, row_count) SELECT '{table}', COUNT(*) FROM {table}")
+    cursor.execute("DELETE FROM employee_rollups")
+    cursor.execute('''
+    INSERT INTO employee_rollups (directorate, status, employee_count, attendance_sum)
+    SELECT COALESCE(directorate, ''), COALESCE(status, ''), COUNT(*), COALESCE(SUM(attendance_rate), 0)
+    FROM employees
+    GROUP BY COALESCE(directorate, ''), COALESCE(status, '')
+    ''')
+
+
+def _rebuild_financial_summary(cursor):
+    """إعادة حساب الملخص المالي الشهري للأشهر غير المؤرشفة من financial_items"""
+    cursor.execute("DELETE FROM financial_monthly_summary WHERE month NOT IN (SELECT month FROM financial_archives)")
+    cursor.execute('''
+    INSERT INTO financial_monthly_summary (month, directorate, item_type, item_count, total_amount)
+    SELECT COALESCE(month, ''), COALESCE(directorate, ''), COALESCE(item_type, ''),
+           COUNT(*), COALESCE(SUM(total_amount), 0)
+    FROM financial_items
+    GROUP BY COALESCE(month, ''), COALESCE(directorate, ''), COALESCE(item_type, '')
+    ''')
+
+
+# الأشهر التي تقبل الأرشفة (YYYY-MM)؛ القيم النصية الأخرى تبقى في القاعدة الرئيسية
+ARCHIVABLE_MONTH_GLOB = '[0-9][0-9][0-9][0-9]-[0-9][0-9]'
+
+# جدول البنود في ملفات الأرشيف (نفس أعمدة financial_items)
+FINANCIAL_ARCHIVE_TABLE = '''
+CREATE TABLE IF NOT EXISTS {schema}.financial_items (
+    id INTEGER PRIMARY KEY,
+    item_name TEXT NOT NULL,
+    item_type TEXT,
+    amount REAL,
+    calculation_formula TEXT,
+    employee_count INTEGER,
+    attendance_rate REAL,
+    total_amount REAL,
+    month TEXT,
+    directorate TEXT,
+    created_at TIMESTAMP
+)
+'''
+
+
+# جداول التقارير: نوع التقرير -> (الجدول, عمود التصفية)
+REPORT_TABLES = {
+    'بشري': ('employee_records', 'directorate'),
+    'مالي': ('financial_items', 'directorate'),
+    'ملخص مالي': ('financial_monthly_summary', 'directorate'),
+    'عهد': ('assets', 'location'),
+}
+
+
+# مستويات الهيكل التنظيمي من الأعلى للأسفل (نفس حقول الموظف وأعمدة organizational_structure)
+ORG_LEVELS = ('company', 'directorate', 'department', 'administration', 'branch', 'section')
+
+# فاصل أسماء الوحدات في org_units.path (لا يظهر في الأسماء العادية)
+ORG_PATH_SEPARATOR = '\x1f'
+
+# مستويات الهيكل التي لا تخزن في صفوف employees بل تقرأ من وحدة الموظف (org_unit_id).
+# المديرية تبقى عموداً لأن التجميع والتواجد والمسير والبنود المالية تعتمد عليها
+EMPLOYEE_ORG_FIELDS = tuple(level for level in ORG_LEVELS if level != 'directorate')
+
+# أعمدة employees المخزنة فعلاً بترتيب جمل الإدخال (الحقول عدا مستويات الهيكل ثم رقم الوحدة)
+EMPLOYEE_COLUMNS = tuple(field for field in EMPLOYEE_FIELDS if field not in EMPLOYEE_ORG_FIELDS) + ('org_unit_id',)
+
+
+def _org_path_sql(row, depth):
+    """تعبير SQL لمسار الوحدة حتى المستوى depth من أعمدة الصف row"""
+    return " || char(31) || ".join(f"COALESCE({row}.{level}, '')" for level in ORG_LEVELS[:depth + 1])
+
+
+def _org_units_insert_sql(row):
+    """جمل إنشاء وحدات مسار الصف row (إن لم تكن موجودة) من الشركة حتى القسم"""
+    statements = [
+        f"INSERT OR IGNORE INTO org_units (parent_id, level, name, path) "
+        f"VALUES (NULL, 'company', COALESCE({row}.company, ''), {_org_path_sql(row, 0)});"
+    ]
+    for depth, level in enumerate(ORG_LEVELS[1:], start=1):
+        statements.append(
+            f"INSERT OR IGNORE INTO org_units (parent_id, level, name, path) "
+            f"SELECT id, '{level}', COALESCE({row}.{level}, ''), {_org_path_sql(row, depth)} "
+            f"FROM org_units WHERE path = {_org_path_sql(row, depth - 1)};"
+        )
+    return "\n            ".join(statements)
+
+
+def _link_employee_org_units(cursor):
+    """إنشاء الوحدات من البيانات الحالية وربط كل موظف بوحدته (ترحيل الإصدار 6)"""
+    for depth, level in enumerate(ORG_LEVELS):
+        parent = (f"(SELECT id FROM org_units WHERE path = {_org_path_sql('src', depth - 1)})"
+                  if depth else "NULL")
+        cursor.execute(f'''
+        INSERT OR IGNORE INTO org_units (parent_id, level, name, path)
+        SELECT {parent}, '{level}', COALESCE(src.{level}, ''), {_org_path_sql('src', depth)}
+        FROM (
+            SELECT DISTINCT {', '.join(ORG_LEVELS[:depth + 1])} FROM employees
+            UNION
+            SELECT DISTINCT {', '.join(ORG_LEVELS[:depth + 1])} FROM organizational_structure
+        ) src
+        ''')
+    cursor.execute(f'''
+    UPDATE employees SET org_unit_id = (
+        SELECT id FROM org_units WHERE path = {_org_path_sql('employees', len(ORG_LEVELS) - 1)}
+    )
+    ''')
+
+
+def _org_unit_ids(cursor, org_paths):
+    """أرقام وحدات المسارات (أسماء ORG_LEVELS لكل مسار) مع إنشاء الناقص منها ومن آبائها"""
+    ids = {}
+    for names in set(org_paths):
+        path = ORG_PATH_SEPARATOR.join(names)
+        row = cursor.execute("SELECT id FROM org_units WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            # مسار جديد (الحالة النادرة): تنشأ وحداته من الشركة نزولاً، والموجود منها يتجاوز
+            parent_id = None
+            for depth, level in enumerate(ORG_LEVELS):
+                unit_path = ORG_PATH_SEPARATOR.join(names[:depth + 1])
+                cursor.execute(
+                    "INSERT OR IGNORE INTO org_units (parent_id, level, name, path) VALUES (?, ?, ?, ?)",
+                    (parent_id, level, names[depth], unit_path)
+                )
+                parent_id = cursor.execute("SELECT id FROM org_units WHERE path = ?", (unit_path,)).fetchone()[0]
+            row = (parent_id,)
+        ids[names] = row[0]
+    return ids
+
+
+# توحيد الكتابة العربية قبل الفهرسة والبحث: (الحرف, بديله). التشكيل والتطويل يحذفان
+ARABIC_NORMALIZATION = (
+    ('أ', 'ا'), ('إ', 'ا'), ('آ', 'ا'), ('ٱ', 'ا'),
+    ('ؤ', 'و'), ('ئ', 'ي'), ('ى', 'ي'), ('ة', 'ه'),
+    ('\u064b', ''), ('\u064c', ''), ('\u064d', ''), ('\u064e', ''), ('\u064f', ''),
+    ('\u0650', ''), ('\u0651', ''), ('\u0652', ''), ('\u0670', ''), ('\u0640', ''),
+)
+
+# فاصل دمج القيم عند توحيدها دفعة واحدة (محرف تحكم لا يرد في البيانات عادة)
+_NORMALIZE_SEPARATOR = '\x1f'
+
+# فهارس البحث النصي: الجدول -> (جدول FTS5, ((عمود الفهرس, أعمدة الجدول المدمجة فيه, وزنه), ...))
+# الأعمدة الثانوية تدمج في عمود واحد لتقليل كلفة التوحيد في المشغلات
+SEARCH_INDEXES = {
+    'employees': ('employees_fts', (
+        ('full_name', ('full_name',), 10.0),
+        ('identifiers', ('global_id', 'functional_id'), 5.0),
+        ('position', ('position',), 3.0),
+        ('qualification', ('qualification',), 2.0),
+        ('details', ('training_courses', 'personal_equipment', 'equipment_notes'), 1.0),
+    )),
+    'assets': ('assets_fts', (
+        ('asset_name', ('asset_name',), 10.0),
+        ('asset_type', ('asset_type',), 3.0),
+        ('location', ('location',), 2.0),
+        ('details', ('calculation_standard', 'status'), 1.0),
+    )),
+}
+
+
+def normalize_ar(text):
+    """توحيد النص العربي: الألف والهمزات والتاء المربوطة والألف المقصورة وحذف التشكيل"""
+    text = str(text or '')
+    # replace لكل حرف موجود أسرع من translate بجدول قاموس على النصوص العربية
+    for char, replacement in ARABIC_NORMALIZATION:
+        if char in text:
+            text = text.replace(char, replacement)
+    return text
+
+
+def normalize_ar_many(texts):
+    """توحيد قائمة نصوص دفعة واحدة: تدمج بفاصل وتوحد كنص واحد ثم تقسم
+
+    كل replace يمر على نص الدفعة كاملاً مرة واحدة بدل استدعاء لكل قيمة.
+    """
+    joined = _NORMALIZE_SEPARATOR.join(texts)
+    if joined.count(_NORMALIZE_SEPARATOR) != len(texts) - 1:
+        # قيمة تحتوي الفاصل نفسه: توحد كل قيمة وحدها
+        return [normalize_ar(text) for text in texts]
+    return normalize_ar(joined).split(_NORMALIZE_SEPARATOR)
+
+
+def _normalize_ar_sql(expr):
+    """نفس توحيد normalize_ar كتعبير SQL (يعمل في المشغلات دون دوال مسجلة)
+
+    حذف التشكيل لا ينفذ إلا إذا احتوى النص على علامة منه، لأن كل replace
+    ينسخ النص وأغلب البيانات المدخلة بلا تشكيل.
+    """
+    marks = ''.join(char for char, replacement in ARABIC_NORMALIZATION if not replacement)
+    stripped = expr
+    for char in marks:
+        stripped = f"replace({stripped}, '{char}', '')"
+    expr = f"CASE WHEN {expr} GLOB '*[{marks}]*' THEN {stripped} ELSE {expr} END"
+    for char, replacement in ARABIC_NORMALIZATION:
+        if replacement:
+            expr = f"replace({expr}, '{char}', '{replacement}')"
+    return expr
+
+
+def _search_values_sql(table, row):
+    """قيم أعمدة فهرس البحث الموحدة من أعمدة الصف row (أو أعمدة الجدول إن كان فارغاً)"""
+    prefix = f"{row}." if row else ""
+    return [
+        _normalize_ar_sql(" || ' ' || ".join(f"COALESCE({prefix}{source}, '')" for source in sources))
+        for _, sources, _ in SEARCH_INDEXES[table][1]
+    ]
+
+
+def _search_index_populate_sql(table):
+    """ملء فهرس البحث من كل صفوف الجدول بالتوحيد في SQL (ترحيل الإصدار 8)"""
+    fts_table, columns = SEARCH_INDEXES[table]
+    names = ', '.join(column for column, _, _ in columns)
+    return f"INSERT INTO {fts_table} (rowid, {names}) SELECT id, {', '.join(_search_values_sql(table, None))} FROM {table}"
+
+
+def _search_index_steps(table):
+    """جمل إنشاء فهرس البحث للجدول وملئه ومشغلات مزامنته (ترحيل الإصدار 8)"""
+    fts_table, columns = SEARCH_INDEXES[table]
+    names = ', '.join(column for column, _, _ in columns)
+    sources = ', '.join(source for _, column_sources, _ in columns for source in column_sources)
+    new_values = _search_values_sql(table, 'new')
+    assignments = ', '.join(f"{column} = {value}" for (column, _, _), value in zip(columns, new_values))
+    new_values = ', '.join(new_values)
+    return (
+        # البادئات من حرفين وثلاثة مفهرسة للبحث بجزء من الاسم
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5 ({names}, prefix = '2 3')",
+        _search_index_populate_sql(table),
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{fts_table}_insert AFTER INSERT ON {table}
+        BEGIN
+            INSERT INTO {fts_table} (rowid, {names}) VALUES (new.id, {new_values});
+        END
+        ''',
+        # لا يطلق إلا عند تغير الأعمدة النصية، لا عند تحديث التواجد أو أرقام التتبع
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{fts_table}_update AFTER UPDATE OF {sources} ON {table}
+        BEGIN
+            UPDATE {fts_table} SET {assignments} WHERE rowid = new.id;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{fts_table}_delete AFTER DELETE ON {table}
+        BEGIN
+            DELETE FROM {fts_table} WHERE rowid = old.id;
+        END
+        ''',
+    )
+
+
+def _index_search_rows(cursor, table, key=None, keys=None, batch_size=1000):
+    """كتابة صفوف فهرس البحث للجدول كله، أو للصفوف التي قيمة العمود key فيها ضمن keys
+
+    تستدعيها دوال الإضافة بعد كل دفعة داخل نفس المعاملة. نصوص كل دفعة توحد
+    معاً في بايثون بدل replace متداخلة لكل صف داخل مشغل.
+    """
+    fts_table, columns = SEARCH_INDEXES[table]
+    names = ', '.join(column for column, _, _ in columns)
+    values = ', '.join(
+        " || ' ' || ".join(f"COALESCE({source}, '')" for source in sources) for _, sources, _ in columns
+    )
+    query = f"SELECT id, {values} FROM {table}"
+    insert = f"INSERT OR REPLACE INTO {fts_table} (rowid, {names}) VALUES (?, {', '.join('?' for _ in columns)})"
+    # القراءة بمؤشر منفصل حتى لا تقطعها جمل الكتابة
+    if keys is None:
+        reader = cursor.connection.execute(query)
+        batches = iter(lambda: reader.fetchmany(batch_size), [])
+    else:
+        keys = list(keys)
+        batches = (
+            cursor.connection.execute(
+                f"{query} WHERE {key} IN ({', '.join('?' for _ in part)})", part
+            ).fetchall()
+            for part in (keys[start:start + batch_size] for start in range(0, len(keys), batch_size))
+        )
+    width = len(columns)
+    for rows in batches:
+        texts = normalize_ar_many([text for row in rows for text in row[1:]])
+        cursor.executemany(insert, [
+            (row[0], *texts[index * width:(index + 1) * width]) for index, row in enumerate(rows)
+        ])
+
+
+def _recreate_search_indexes(cursor):
+    """فهارس البحث بلا مشغلات إدخال وتحديث وبلا فهارس بادئات (ترحيل الإصدار 11)
+
+    مشغلات الإصدار 8 كانت توحد النص بـ replace متداخلة لكل صف فتبطئ الاستيراد
+    الجماعي ثلاث مرات، فصارت دوال الإضافة تكتب الفهرس بنفسها. وفهارس البادئات
+    لم تسرع البحث في القياس لأن FTS5 يقرأ مدى المصطلحات من الفهرس الأساسي.
+    مشغل الحذف يبقى لأنه لا يوحد شيئاً.
+    """
+    for table, (fts_table, columns) in SEARCH_INDEXES.items():
+        cursor.execute(f"DROP TRIGGER IF EXISTS trg_{fts_table}_insert")
+        cursor.execute(f"DROP TRIGGER IF EXISTS trg_{fts_table}_update")
+        cursor.execute(f"DROP TABLE IF EXISTS {fts_table}")
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE {fts_table} USING fts5 ({', '.join(column for column, _, _ in columns)})"
+        )
+        _index_search_rows(cursor, table)
+
+
+def _search_match_query(text):
+    """تحويل نص البحث إلى استعلام FTS5: كل كلمة بادئة، والكلمات مجتمعة (AND)"""
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', normalize_ar(text)))
+
+
+# ترحيلات مخطط قاعدة البيانات بالترتيب: (الإصدار, الوصف, الخطوات)
+# كل خطوة إما جملة SQL أو دالة تستقبل cursor. الإصدار الحالي يحفظ في PRAGMA user_version
+SCHEMA_MIGRATIONS = [
+    (1, 'فهارس مسارات الاستعلام الرئيسية', (
+        # get_employees(directorate) مع الترتيب حسب created_at
+        "CREATE INDEX IF NOT EXISTS idx_employees_directorate_created ON employees (directorate, created_at)",
+        # update_asset_quantity(asset_name, location) وتقرير العهد حسب الموقع
+        "CREATE INDEX IF NOT EXISTS idx_assets_name_location ON assets (asset_name, location)",
+        "CREATE INDEX IF NOT EXISTS idx_assets_location ON assets (location)",
+        # التقارير المالية حسب الشهر والمديرية
+        "CREATE INDEX IF NOT EXISTS idx_financial_month_directorate ON financial_items (month, directorate)",
+        "CREATE INDEX IF NOT EXISTS idx_financial_directorate ON financial_items (directorate)",
+    )),
+    (2, 'مفتاح فريد للإعدادات', (
+        # إبقاء آخر قيمة فقط لكل إعداد مكرر قبل إنشاء الفهرس الفريد
+        '''
+        DELETE FROM settings WHERE id NOT IN (
+            SELECT MAX(id) FROM settings GROUP BY setting_type, setting_name
+        )
+        ''',
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_settings_type_name ON settings (setting_type, setting_name)",
+        # get_setting(setting_name) يبحث بالاسم فقط
+        "CREATE INDEX IF NOT EXISTS idx_settings_name ON settings (setting_name)",
+    )),
+    (3, 'جداول تجميع لوحة التحكم مع المشغلات', (
+        '''
+        CREATE TABLE IF NOT EXISTS table_counts (
+            table_name TEXT PRIMARY KEY,
+            row_count INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS employee_rollups (
+            directorate TEXT NOT NULL,
+            status TEXT NOT NULL,
+            employee_count INTEGER NOT NULL DEFAULT 0,
+            attendance_sum REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (directorate, status)
+        )
+        ''',
+        *(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_count_insert AFTER INSERT ON {table}
+        BEGIN
+            INSERT INTO table_counts (table_name, row_count) VALUES ('{table}', 1)
+            ON CONFLICT(table_name) DO UPDATE SET row_count = row_count + 1;
+        END
+        ''' for table in COUNTED_TABLES),
+        *(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_count_delete AFTER DELETE ON {table}
+        BEGIN
+            UPDATE table_counts SET row_count = row_count - 1 WHERE table_name = '{table}';
+        END
+        ''' for table in COUNTED_TABLES),
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_employees_rollup_insert AFTER INSERT ON employees
+        BEGIN
+            INSERT INTO employee_rollups (directorate, status, employee_count, attendance_sum)
+            VALUES (COALESCE(new.directorate, ''), COALESCE(new.status, ''), 1, COALESCE(new.attendance_rate, 0))
+            ON CONFLICT(directorate, status) DO UPDATE SET
+                employee_count = employee_count + 1,
+                attendance_sum = attendance_sum + excluded.attendance_sum;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_employees_rollup_delete AFTER DELETE ON employees
+        BEGIN
+            UPDATE employee_rollups SET
+                employee_count = employee_count - 1,
+                attendance_sum = attendance_sum - COALESCE(old.attendance_rate, 0)
+            WHERE directorate = COALESCE(old.directorate, '') AND status = COALESCE(old.status, '');
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_employees_rollup_update
+        AFTER UPDATE OF directorate, status, attendance_rate ON employees
+        BEGIN
+            UPDATE employee_rollups SET
+                employee_count = employee_count - 1,
+                attendance_sum = attendance_sum - COALESCE(old.attendance_rate, 0)
+            WHERE directorate = COALESCE(old.directorate, '') AND status = COALESCE(old.status, '');
+            INSERT INTO employee_rollups (directorate, status, employee_count, attendance_sum)
+            VALUES (COALESCE(new.directorate, ''), COALESCE(new.status, ''), 1, COALESCE(new.attendance_rate, 0))
+            ON CONFLICT(directorate, status) DO UPDATE SET
+                employee_count = employee_count + 1,
+                attendance_sum = attendance_sum + excluded.attendance_sum;
+        END
+        ''',
+        _rebuild_rollups,
+    )),
+    (4, 'سجل التواجد اليومي مع تجميع شهري', (
+        '''
+        CREATE TABLE IF NOT EXISTS attendance_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            global_id TEXT NOT NULL,
+            event_date TEXT NOT NULL,
+            present INTEGER NOT NULL DEFAULT 1,
+            source TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (global_id, event_date)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS attendance_monthly (
+            global_id TEXT NOT NULL,
+            month TEXT NOT NULL,
+            days_recorded INTEGER NOT NULL DEFAULT 0,
+            days_present INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (global_id, month)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_attendance_monthly_month ON attendance_monthly (month)",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_attendance_events_insert AFTER INSERT ON attendance_events
+        BEGIN
+            INSERT INTO attendance_monthly (global_id, month, days_recorded, days_present)
+            VALUES (new.global_id, substr(new.event_date, 1, 7), 1, new.present)
+            ON CONFLICT(global_id, month) DO UPDATE SET
+                days_recorded = days_recorded + 1,
+                days_present = days_present + excluded.days_present;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_attendance_events_delete AFTER DELETE ON attendance_events
+        BEGIN
+            UPDATE attendance_monthly SET
+                days_recorded = days_recorded - 1,
+                days_present = days_present - old.present
+            WHERE global_id = old.global_id AND month = substr(old.event_date, 1, 7);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_attendance_events_update
+        AFTER UPDATE OF global_id, event_date, present ON attendance_events
+        BEGIN
+            UPDATE attendance_monthly SET
+                days_recorded = days_recorded - 1,
+                days_present = days_present - old.present
+            WHERE global_id = old.global_id AND month = substr(old.event_date, 1, 7);
+            INSERT INTO attendance_monthly (global_id, month, days_recorded, days_present)
+            VALUES (new.global_id, substr(new.event_date, 1, 7), 1, new.present)
+            ON CONFLICT(global_id, month) DO UPDATE SET
+                days_recorded = days_recorded + 1,
+                days_present = days_present + excluded.days_present;
+        END
+        ''',
+    )),
+    (5, 'تتبع تعديلات الموظفين وحفظ التناقضات في analysis_records', (
+        # رقم تسلسلي يزيد مع كل إضافة أو تعديل لموظف (إصدار الصف)
+        "ALTER TABLE employees ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0",
+        '''
+        CREATE TABLE IF NOT EXISTS change_sequences (
+            table_name TEXT PRIMARY KEY,
+            last_seq INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        # الصفوف الموجودة تأخذ أرقاماً أولية حتى يفحصها أول تشغيل
+        "UPDATE employees SET change_seq = id",
+        "INSERT INTO change_sequences (table_name, last_seq) SELECT 'employees', COALESCE(MAX(id), 0) FROM employees",
+        "CREATE INDEX IF NOT EXISTS idx_employees_change_seq ON employees (change_seq)",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_employees_change_insert AFTER INSERT ON employees
+        BEGIN
+            UPDATE change_sequences SET last_seq = last_seq + 1 WHERE table_name = 'employees';
+            UPDATE employees SET change_seq = (
+                SELECT last_seq FROM change_sequences WHERE table_name = 'employees'
+            ) WHERE id = new.id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_employees_change_update AFTER UPDATE ON employees
+        WHEN new.change_seq IS old.change_seq
+        BEGIN
+            UPDATE change_sequences SET last_seq = last_seq + 1 WHERE table_name = 'employees';
+            UPDATE employees SET change_seq = (
+                SELECT last_seq FROM change_sequences WHERE table_name = 'employees'
+            ) WHERE id = new.id;
+        END
+        ''',
+        # آخر رقم تسلسلي فحصه كل نوع تحليل
+        '''
+        CREATE TABLE IF NOT EXISTS analysis_state (
+            analysis_type TEXT PRIMARY KEY,
+            last_seq INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        DELETE FROM analysis_records WHERE id NOT IN (
+            SELECT MAX(id) FROM analysis_records GROUP BY analysis_type, employee_id
+        )
+        ''',
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_analysis_records_employee_type ON analysis_records (employee_id, analysis_type)",
+        "CREATE INDEX IF NOT EXISTS idx_analysis_records_type ON analysis_records (analysis_type)",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_employees_analysis_delete AFTER DELETE ON employees
+        BEGIN
+            DELETE FROM analysis_records WHERE employee_id = old.id;
+        END
+        ''',
+    )),
+    (6, 'هيكل تنظيمي موحد مع جدول الإغلاق (closure) وربط الموظفين بوحداتهم', (
+        # كل وحدة مرة واحدة: اسمها ومستواها وأبوها ومسارها الكامل من الشركة
+        '''
+        CREATE TABLE IF NOT EXISTS org_units (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            parent_id INTEGER REFERENCES org_units (id),
+            level TEXT NOT NULL,
+            name TEXT NOT NULL,
+            path TEXT NOT NULL UNIQUE
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_org_units_parent ON org_units (parent_id)",
+        "CREATE INDEX IF NOT EXISTS idx_org_units_level ON org_units (level)",
+        # كل زوج (سلف، خلف) بعمقه، والوحدة سلف لنفسها بعمق 0
+        '''
+        CREATE TABLE IF NOT EXISTS org_closure (
+            ancestor_id INTEGER NOT NULL,
+            descendant_id INTEGER NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_org_closure_descendant ON org_closure (descendant_id)",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_org_units_closure AFTER INSERT ON org_units
+        BEGIN
+            INSERT INTO org_closure (ancestor_id, descendant_id, depth) VALUES (new.id, new.id, 0);
+            INSERT INTO org_closure (ancestor_id, descendant_id, depth)
+            SELECT ancestor_id, new.id, depth + 1 FROM org_closure WHERE descendant_id = new.parent_id;
+        END
+        ''',
+        "ALTER TABLE employees ADD COLUMN org_unit_id INTEGER REFERENCES org_units (id)",
+        "CREATE INDEX IF NOT EXISTS idx_employees_org_unit ON employees (org_unit_id)",
+        # الهيكل المعرف في organizational_structure ينشئ وحداته أيضاً
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_organizational_structure_units
+        AFTER INSERT ON organizational_structure
+        BEGIN
+            {_org_units_insert_sql('new')}
+        END
+        ''',
+        # ربط كل صف بوحدته من نصوصه الحالية، ثم تحذف النصوص: الأسماء تخزن مرة في org_units،
+        # والإدخال يمرر org_unit_id محسوباً مرة لكل مسار (_org_unit_ids) فلا حاجة لمشغلات
+        _link_employee_org_units,
+        *(f"ALTER TABLE employees DROP COLUMN {level}" for level in EMPLOYEE_ORG_FIELDS),
+        # الموظفون بكل أعمدتهم السابقة: أسماء المستويات من سلسلة آباء وحدة القسم
+        '''
+        CREATE VIEW IF NOT EXISTS employee_records AS
+        SELECT e.id, e.global_id, e.functional_id, e.full_name, e.position, e.level,
+               e.qualification, e.training_courses, e.personal_equipment, e.equipment_notes,
+               company.name AS company, e.directorate, department.name AS department,
+               administration.name AS administration, branch.name AS branch, section.name AS section,
+               e.attendance_rate, e.status, e.created_at, e.change_seq, e.org_unit_id
+        FROM employees e
+        LEFT JOIN org_units section ON section.id = e.org_unit_id
+        LEFT JOIN org_units branch ON branch.id = section.parent_id
+        LEFT JOIN org_units administration ON administration.id = branch.parent_id
+        LEFT JOIN org_units department ON department.id = administration.parent_id
+        LEFT JOIN org_units directorate ON directorate.id = department.parent_id
+        LEFT JOIN org_units company ON company.id = directorate.parent_id
+        ''',
+    )),
+    (7, 'سجل حركات العهد وجدول النواقص', (
+        # سجل للإضافة فقط: كل تغيير في الكمية حركة، والرصيد في assets يحدث تدريجياً
+        '''
+        CREATE TABLE IF NOT EXISTS asset_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            asset_id INTEGER NOT NULL REFERENCES assets (id),
+            movement_type TEXT NOT NULL DEFAULT 'حركة',
+            quantity_change INTEGER NOT NULL,
+            reason TEXT,
+            reference TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_asset_ledger_asset ON asset_ledger (asset_id, id)",
+        # الأرصدة الحالية تصبح أرصدة افتتاحية في السجل
+        '''
+        INSERT INTO asset_ledger (asset_id, movement_type, quantity_change, reason)
+        SELECT id, 'رصيد افتتاحي', COALESCE(current_quantity, 0), 'ترحيل' FROM assets
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_asset_ledger_balance AFTER INSERT ON asset_ledger
+        WHEN new.movement_type != 'رصيد افتتاحي'
+        BEGIN
+            UPDATE assets SET current_quantity = COALESCE(current_quantity, 0) + new.quantity_change
+            WHERE id = new.asset_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_asset_ledger_no_update BEFORE UPDATE ON asset_ledger
+        BEGIN
+            SELECT RAISE(ABORT, 'سجل حركات العهد للإضافة فقط');
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_asset_ledger_no_delete BEFORE DELETE ON asset_ledger
+        BEGIN
+            SELECT RAISE(ABORT, 'سجل حركات العهد للإضافة فقط');
+        END
+        ''',
+        # النقص يشتق دائماً من المطلوب والحالي بدل أن يمرره المستخدم
+        "UPDATE assets SET missing_quantity = MAX(COALESCE(required_quantity, 0) - COALESCE(current_quantity, 0), 0)",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_insert AFTER INSERT ON assets
+        BEGIN
+            INSERT INTO asset_ledger (asset_id, movement_type, quantity_change, reason)
+            VALUES (new.id, 'رصيد افتتاحي', COALESCE(new.current_quantity, 0), 'إضافة عهدة');
+            UPDATE assets
+            SET missing_quantity = MAX(COALESCE(new.required_quantity, 0) - COALESCE(new.current_quantity, 0), 0)
+            WHERE id = new.id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_assets_missing
+        AFTER UPDATE OF current_quantity, required_quantity ON assets
+        BEGIN
+            UPDATE assets
+            SET missing_quantity = MAX(COALESCE(new.required_quantity, 0) - COALESCE(new.current_quantity, 0), 0)
+            WHERE id = new.id;
+        END
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_assets_location_type ON assets (location, asset_type)",
+        # ناتج محرك النواقص: سطر لكل (موقع، نوع عهدة)
+        '''
+        CREATE TABLE IF NOT EXISTS asset_shortages (
+            location TEXT NOT NULL,
+            asset_type TEXT NOT NULL,
+            employee_count INTEGER NOT NULL,
+            required_quantity INTEGER NOT NULL,
+            current_quantity INTEGER NOT NULL,
+            missing_quantity INTEGER NOT NULL,
+            computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (location, asset_type)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_asset_shortages_missing ON asset_shortages (missing_quantity)",
+    )),
+    (8, 'فهارس البحث النصي للموظفين والعهد', (
+        *_search_index_steps('employees'),
+        *_search_index_steps('assets'),
+    )),
+    (9, 'أنواع قيم الإعدادات', (
+        # القيم السابقة كلها نصوص؛ الجديدة تحفظ نوعها لتعاد كما حفظت
+        "ALTER TABLE settings ADD COLUMN value_type TEXT NOT NULL DEFAULT 'str'",
+        "ALTER TABLE settings ADD COLUMN updated_at TIMESTAMP",
+        "UPDATE settings SET updated_at = created_at",
+    )),
+    (10, 'ملخص مالي شهري وسجل الأشهر المؤرشفة', (
+        '''
+        CREATE TABLE IF NOT EXISTS financial_monthly_summary (
+            month TEXT NOT NULL,
+            directorate TEXT NOT NULL,
+            item_type TEXT NOT NULL,
+            item_count INTEGER NOT NULL DEFAULT 0,
+            total_amount REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, directorate, item_type)
+        ) WITHOUT ROWID
+        ''',
+        # الأشهر المغلقة المنقولة إلى ملفات أرشيف (ملف لكل سنة)
+        '''
+        CREATE TABLE IF NOT EXISTS financial_archives (
+            month TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            item_count INTEGER NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_financial_summary_insert AFTER INSERT ON financial_items
+        BEGIN
+            INSERT INTO financial_monthly_summary (month, directorate, item_type, item_count, total_amount)
+            VALUES (COALESCE(new.month, ''), COALESCE(new.directorate, ''), COALESCE(new.item_type, ''),
+                    1, COALESCE(new.total_amount, 0))
+            ON CONFLICT(month, directorate, item_type) DO UPDATE SET
+                item_count = item_count + 1,
+                total_amount = total_amount + excluded.total_amount;
+        END
+        ''',
+        # حذف الأشهر المؤرشفة من القاعدة الرئيسية لا يغير ملخصها
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_financial_summary_delete AFTER DELETE ON financial_items
+        WHEN NOT EXISTS (SELECT 1 FROM financial_archives WHERE month = old.month)
+        BEGIN
+            UPDATE financial_monthly_summary SET
+                item_count = item_count - 1,
+                total_amount = total_amount - COALESCE(old.total_amount, 0)
+            WHERE month = COALESCE(old.month, '') AND directorate = COALESCE(old.directorate, '')
+              AND item_type = COALESCE(old.item_type, '');
+            DELETE FROM financial_monthly_summary
+            WHERE month = COALESCE(old.month, '') AND directorate = COALESCE(old.directorate, '')
+              AND item_type = COALESCE(old.item_type, '') AND item_count = 0;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_financial_summary_update
+        AFTER UPDATE OF month, directorate, item_type, total_amount ON financial_items
+        BEGIN
+            UPDATE financial_monthly_summary SET
+                item_count = item_count - 1,
+                total_amount = total_amount - COALESCE(old.total_amount, 0)
+            WHERE month = COALESCE(old.month, '') AND directorate = COALESCE(old.directorate, '')
+              AND item_type = COALESCE(old.item_type, '');
+            INSERT INTO financial_monthly_summary (month, directorate, item_type, item_count, total_amount)
+            VALUES (COALESCE(new.month, ''), COALESCE(new.directorate, ''), COALESCE(new.item_type, ''),
+                    1, COALESCE(new.total_amount, 0))
+            ON CONFLICT(month, directorate, item_type) DO UPDATE SET
+                item_count = item_count + 1,
+                total_amount = total_amount + excluded.total_amount;
+        END
+        ''',
+        # الشهر المؤرشف مغلق: لا تضاف إليه بنود جديدة في القاعدة الرئيسية
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_financial_items_closed_month BEFORE INSERT ON financial_items
+        WHEN EXISTS (SELECT 1 FROM financial_archives WHERE month = new.month)
+        BEGIN
+            SELECT RAISE(ABORT, 'الشهر مؤرشف ومغلق');
+        END
+        ''',
+        _rebuild_financial_summary,
+    )),
+    (11, 'فهارس البحث تكتب من دوال الإضافة', (
+        _recreate_search_indexes,
+    )),
+]
+
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+# قواعد كشف التناقضات. كل قاعدة تحتوي على:
+#   mask: دالة تعيد قناعاً منطقياً على إطار الموظفين كاملاً (تنفيذ متجه)
+#   sql: شرط WHERE مكافئ لتنفيذ القاعدة داخل قاعدة البيانات (اختياري)
+#   issue: نص ثابت أو دالة تعيد عمود النصوص للصفوف المطابقة
+DISCREPANCY_RULES = [
+    {
+        'name': 'low_attendance',
+        'mask': lambda df: df['attendance_rate'] < 60,
+        'sql': "attendance_rate < 60",
+        'issue': lambda df: 'تواجد ' + df['attendance_rate'].astype(str) + '% منخفض مع احتمال صرف كامل',
+        'level': 'high',
+        'recommendation': 'مراجعة نظام الصرف'
+    },
+    {
+        'name': 'missing_training',
+        'mask': lambda df: df['training_courses'].isna() | (df['training_courses'] == ''),
+        'sql': "(training_courses IS NULL OR training_courses = '')",
+        'issue': 'موظف بدون دورات تدريبية أساسية',
+        'level': 'medium',
+        'recommendation': 'توفير تدريبات أساسية'
+    },
+]
+
+DISCREPANCY_COLUMNS = ['employee_name', 'global_id', 'issue', 'level', 'recommendation']
+
+# بادئة analysis_type لسجلات التناقضات المحفوظة (متبوعة باسم القاعدة)
+DISCREPANCY_ANALYSIS_PREFIX = 'discrepancy:'
+
+# المعدلات المالية المعتمدة (المبالغ اليومية لكل موظف، والشهر 30 يوماً)
+FINANCIAL_RATES = {
+    'basic_salary': 40000,
+    'days': 30,
+    'feeding_rate': 2500,
+    'in_kind_share': 0.8,
+    'housing_rate': 15,
+    'health_rate': 15,
+    'rent_rate': 40,
+    'electricity_rate': 0.5,
+    'water_rate': 0.5,
+    'stationery_rate': 0.5,
+    'cleaning_rate': 0.5,
+    'maintenance_rate': 150,
+}
+
+# معادلات بنود المسير الشهري لكل موظف. المتغيرات المتاحة: المعدلات أعلاه
+# و attendance (نسبة التواجد) و employee_count. يمكن تعديلها من جدول الإعدادات
+PAYROLL_FORMULAS = {
+    'الرواتب': 'basic_salary / days * attendance / 100 * days',
+    'التغذية': 'feeding_rate * days * attendance / 100',
+    'الإسكان': 'housing_rate * days',
+    'الصحية': 'health_rate * days',
+    'الإيجارات': 'rent_rate * days',
+    'الكهرباء': 'electricity_rate * days',
+    'الماء': 'water_rate * days',
+    'القرطاسية': 'stationery_rate * days',
+    'النظافة': 'cleaning_rate * days',
+    'الصيانة': 'maintenance_rate * days',
+}
+
+# معايير احتساب العهد: الاحتياج = عدد الموظفين × per_employee + base
+ASSET_STANDARDS = {
+    'خفيفة': {'per_employee': 0.5, 'base': 10},
+    'متوسطة': {'per_employee': 0.2, 'base': 5},
+    'ثقيلة': {'per_employee': 0.1, 'base': 2},
+    'تواصلية': {'per_employee': 0.3, 'base': 8},
+    'استهلاكية': {'per_employee': 2.0, 'base': 20}
+}
+DEFAULT_ASSET_STANDARD = {'per_employee': 0.1, 'base': 5}
+
+# نوع حركة الرصيد الافتتاحي في asset_ledger (لا يغير الرصيد لأنه مسجل مسبقاً)
+ASSET_OPENING_MOVEMENT = 'رصيد افتتاحي'
+
+# أنواع الإعدادات التي تغير المعدلات والمعادلات والمعايير
+RATE_SETTING_TYPE = 'معدل مالي'
+FORMULA_SETTING_TYPE = 'معادلة مالية'
+ASSET_STANDARD_SETTING_TYPE = 'معيار عهد'
+
+# أنواع قيم الإعدادات: النوع المحفوظ في settings.value_type -> أنواع بايثون المقابلة
+# (bool قبل int لأن True من نوع int أيضاً). النصوص تحفظ كما هي والبقية بصيغة JSON
+SETTING_VALUE_TYPES = (
+    ('bool', (bool,)),
+    ('int', (int,)),
+    ('float', (float,)),
+    ('json', (dict, list, tuple)),
+)
+
+
+def _encode_setting(value):
+    """تحويل قيمة إعداد إلى (النص المحفوظ, نوعه)"""
+    for value_type, python_types in SETTING_VALUE_TYPES:
+        if isinstance(value, python_types):
+            return json.dumps(value, ensure_ascii=False), value_type
+    return str(value), 'str'
+
+
+def _decode_setting(text, value_type):
+    """إعادة قيمة الإعداد بنوعها الأصلي"""
+    if value_type in (None, 'str') or text is None:
+        return text
+    return json.loads(text)
+
+
+# نوع البنود التي يكتبها الإقفال الشهري في financial_items
+PAYROLL_ITEM_TYPE = 'إقفال شهري'
+
+# الدوال المسموح بها داخل المعادلات -> اسم دالة numpy (كلها تعمل على أعمدة كاملة)
+FORMULA_FUNCTIONS = {
+    'min': 'minimum',
+    'max': 'maximum',
+    'abs': 'abs',
+    'round': 'round',
+    'where': 'where',
+}
+
+# أسماء عقد ast المسموح بها (أسماء لا أصناف حتى لا يستورد ast عند تحميل الوحدة)
+_FORMULA_NODES = frozenset((
+    'Expression', 'BinOp', 'UnaryOp', 'Compare', 'Call', 'Name', 'Load', 'Constant',
+    'Add', 'Sub', 'Mult', 'Div', 'FloorDiv', 'Mod', 'Pow', 'USub', 'UAdd',
+    'Lt', 'LtE', 'Gt', 'GtE', 'Eq', 'NotEq',
+))
+
+
+class FinancialFormula:
+    """معادلة مالية محللة ومترجمة مرة واحدة وتقيم على أعمدة كاملة"""
+
+    def __init__(self, text):
+        tree = ast.parse(text.strip(), mode='eval')
+        for node in ast.walk(tree):
+            if type(node).__name__ not in _FORMULA_NODES:
+                raise ValueError(f"عنصر غير مسموح في المعادلة: {type(node).__name__}")
+            if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                raise ValueError(f"قيمة غير رقمية في المعادلة: {node.value!r}")
+            if isinstance(node, ast.Call) and (
+                    not isinstance(node.func, ast.Name) or node.func.id not in FORMULA_FUNCTIONS or node.keywords):
+                raise ValueError("استدعاء دالة غير مسموح في المعادلة")
+        self.text = text
+        self.names = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)} - set(FORMULA_FUNCTIONS)
+        self.code = compile(tree, '<formula>', 'eval')
+
+    def evaluate(self, variables):
+        """تقييم المعادلة؛ المتغيرات قيم مفردة أو أعمدة (Series/ndarray)"""
+        missing = self.names - set(variables)
+        if missing:
+            raise ValueError(f"متغيرات غير معروفة في المعادلة: {', '.join(sorted(missing))}")
+        functions = {name: getattr(np, function) for name, function in FORMULA_FUNCTIONS.items()}
+        return eval(self.code, {'__builtins__': {}, **functions}, variables)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_formula(text):
+    """تحليل المعادلة مرة واحدة لكل نص"""
+    return FinancialFormula(text)
+
+
+class Instrumentation:
+    """عدادات الأداء: عدد الاستدعاءات وزمنها لكل دالة عامة ولكل جملة SQL
+
+    الجمل تجمع حسب نصها (بعد ضغط المسافات)، والصفوف هي المتأثرة بالكتابة أو
+    المقروءة بـ fetchall/fetchmany. عند تحديد slow_query_ms تسجل الجمل الأبطأ
+    منه في سجل الاستعلامات البطيئة وتكتب تحذيراً في logger.
+    """
+
+    def __init__(self, slow_query_ms=None, max_slow_queries=100):
+        self.slow_query_ms = slow_query_ms
+        self.max_slow_queries = max_slow_queries
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """تصفير جميع العدادات"""
+        with self._lock:
+            self._methods = {}
+            self._queries = {}
+            self._slow_queries = collections.deque(maxlen=self.max_slow_queries)
+
+    @staticmethod
+    def _add(table, key, elapsed, rows=0, calls=1, failed=False):
+        entry = table.get(key)
+        if entry is None:
+            entry = table[key] = {'calls': 0, 'errors': 0, 'rows': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+        elapsed_ms = elapsed * 1000
+        entry['calls'] += calls
+        entry['errors'] += failed
+        entry['rows'] += rows
+        entry['total_ms'] += elapsed_ms
+        entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+
+    def record_method(self, name, elapsed, failed=False):
+        with self._lock:
+            self._add(self._methods, name, elapsed, failed=failed)
+
+    def record_query(self, sql, elapsed, rows=0, calls=1):
+        key = ' '.join(sql.split())
+        with self._lock:
+            self._add(self._queries, key, elapsed, rows=rows, calls=calls)
+        if self.slow_query_ms is not None and elapsed * 1000 >= self.slow_query_ms:
+            entry = {'sql': key, 'duration_ms': elapsed * 1000, 'rows': rows, 'at': datetime.now().isoformat()}
+            with self._lock:
+                self._slow_queries.append(entry)
+            logger.warning("🐢 استعلام بطيء (%.1f ms): %s", entry['duration_ms'], key[:200], extra=entry)
+
+    def stats(self):
+        """نسخة من العدادات مع متوسط الزمن، مرتبة تنازلياً حسب الزمن الكلي"""
+        def summary(table):
+            items = sorted(table.items(), key=lambda item: item[1]['total_ms'], reverse=True)
+            return {
+                key: dict(entry, avg_ms=entry['total_ms'] / entry['calls'] if entry['calls'] else 0.0)
+                for key, entry in items
+            }
+
+        with self._lock:
+            return {
+                'methods': summary(self._methods),
+                'queries': summary(self._queries),
+                'slow_queries': list(self._slow_queries),
+            }
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """مؤشر يسجل زمن التنفيذ والجلب وعدد الصفوف لكل جملة"""
+
+    _sql = None
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._sql = sql
+            self.connection.instrumentation.record_query(
+                sql, time.perf_counter() - started, max(self.rowcount, 0)
+            )
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._sql = sql
+            self.connection.instrumentation.record_query(
+                sql, time.perf_counter() - started, max(self.rowcount, 0)
+            )
+
+    def _fetched(self, rows, started):
+        # زمن الجلب يضاف لنفس الجملة دون احتسابه استدعاءً جديداً
+        if self._sql is not None:
+            self.connection.instrumentation.record_query(
+                self._sql, time.perf_counter() - started, len(rows), calls=0
+            )
+        return rows
 
+    def fetchall(self):
+        started = time.perf_counter()
+        return self._fetched(super().fetchall(), started)
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        return self._fetched(rows, started)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """اتصال تمر جميع جمله عبر InstrumentedCursor"""
+
+    instrumentation = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _timed_method(function):
+    """تغليف دالة لتسجيل زمنها في self.instrumentation إن وجد"""
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        instrumentation = self.__dict__.get('instrumentation')
+        if instrumentation is None:
+            return function(self, *args, **kwargs)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = function(self, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            instrumentation.record_method(name, time.perf_counter() - started, failed)
+    return wrapper
+
+
+# inspect.CO_GENERATOR: يفحص مباشرة لأن instrument_methods تعمل عند تحميل الوحدة
+_CO_GENERATOR = 0x20
+
+
+def instrument_methods(cls):
+    """تسجيل زمن كل الدوال العامة في الصنف (عدا المولدات ودوال الإحصاءات نفسها)"""
+    for name, function in list(vars(cls).items()):
+        if (name.startswith('_') or name in ('stats', 'reset_stats')
+                or not isinstance(function, FunctionType) or function.__code__.co_flags & _CO_GENERATOR):
+            continue
+        setattr(cls, name, _timed_method(function))
+    return cls
+
+
+class ConnectionManager:
+    """إدارة اتصالات SQLite: قراء متزامنون بوضع WAL وكاتب واحد عبر طابور
+
+    كل خيط يستعير اتصال قراءة من المجمع طوال عملية القراءة (والقراءات
+    المتداخلة في نفس الخيط تعيد استخدامه). جميع عمليات الكتابة ترسل إلى خيط
+    كاتب واحد يجمع ما ينتظر في الطابور في معاملة واحدة (group commit)، وكل
+    عملية داخل SAVEPOINT خاص بها فلا يلغي فشلها العمليات الأخرى.
+    قاعدة ':memory:' لا يمكن مشاركتها بين اتصالات، فتنفذ كل العمليات فيها
+    على اتصال واحد محمي بقفل. مع read_only=True لا ينشأ كاتب أصلاً.
+    """
+
+    def __init__(self, db_name, pool_size=4, busy_timeout=5.0, batch_size=64,
+                 cache_size_kb=65536, mmap_size=256 * 1024 * 1024, synchronous='NORMAL',
+                 read_only=False, instrumentation=None):
+        self.db_name = db_name
+        self.read_only = read_only
+        # عند تمريره تستخدم اتصالات InstrumentedConnection لتسجيل زمن الجمل
+        self.instrumentation = instrumentation
+        self.pool_size = pool_size
+        self.busy_timeout = busy_timeout
+        self.batch_size = batch_size
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.synchronous = synchronous
+        self.inline = db_name == ':memory:'
+
+        self._local = threading.local()
+        self._idle_readers = queue.LifoQueue()
+        self._reader_slots = threading.BoundedSemaphore(max(1, pool_size))
+        self._inline_lock = threading.RLock()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._writes = queue.Queue()
+        self._writer_thread = None
+
+        if read_only and not self.inline:
+            self._writer = None
+            return
+        self._writer = self._connect()
+        if not self.inline:
+            self._writer.execute("PRAGMA journal_mode = WAL")
+            self._writer_thread = threading.Thread(
+                target=self._writer_loop, name='construction-program-writer', daemon=True
+            )
+            self._writer_thread.start()
+
+    def _connect(self, read_only=False):
+        """فتح اتصال جديد مع الإعدادات المعتمدة"""
+        conn = sqlite3.connect(
+            self.db_name, timeout=self.busy_timeout, check_same_thread=False, isolation_level=None,
+            factory=InstrumentedConnection if self.instrumentation is not None else sqlite3.Connection
+        )
+        if self.instrumentation is not None:
+            conn.instrumentation = self.instrumentation
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}")
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        conn.execute(f"PRAGMA cache_size = {-int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        if read_only:
+            conn.execute("PRAGMA query_only = ON")
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def read(self):
+        """استعارة اتصال قراءة للخيط الحالي"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+
+        if self.inline:
+            with self._inline_lock:
+                self._local.conn = self._writer
+                try:
+                    yield self._writer
+                finally:
+                    self._local.conn = None
+            return
+
+        self._reader_slots.acquire()
+        try:
+            try:
+                conn = self._idle_readers.get_nowait()
+            except queue.Empty:
+                conn = self._connect(read_only=True)
+            self._local.conn = conn
+            try:
+                yield conn
+            finally:
+                self._local.conn = None
+                self._idle_readers.put(conn)
+        finally:
+            self._reader_slots.release()
+
+    @contextlib.contextmanager
+    def dedicated_reader(self):
+        """اتصال قراءة خاص خارج المجمع للمكررات الطويلة التي قد تنتقل بين الخيوط"""
+        if self.inline:
+            with self.read() as conn:
+                yield conn
+            return
+        conn = self._connect(read_only=True)
+        try:
+            yield conn
+        finally:
+            with self._connections_lock:
+                self._connections.remove(conn)
+            conn.close()
+
+    def write(self, operation):
+        """تنفيذ عملية كتابة operation(conn) عبر الكاتب وانتظار نتيجتها"""
+        if self.inline or threading.current_thread() is self._writer_thread:
+            with self._inline_lock:
+                if self._writer.in_transaction:
+                    # كتابة متداخلة داخل عملية كتابة جارية
+                    return operation(self._writer)
+                previous = getattr(self._local, 'conn', None)
+                self._local.conn = self._writer
+                try:
+                    return self._run_batch([(operation, None)])
+                finally:
+                    self._local.conn = previous
+
+        if self.read_only:
+            raise sqlite3.OperationalError("قاعدة البيانات مفتوحة للقراءة فقط")
+        if self._writer_thread is None:
+            raise sqlite3.ProgrammingError("تم إغلاق الاتصال بقاعدة البيانات")
+        future = futures.Future()
+        self._writes.put((operation, future, False))
+        return future.result()
+
+    def run_exclusive(self, operation):
+        """تنفيذ operation(conn) على اتصال الكاتب خارج أي معاملة (مثل الاستعادة)
+
+        تنتظر العملية دورها في طابور الكاتب بعد ما سبقها من كتابات، ولا
+        تجمع مع غيرها، فتدير معاملاتها بنفسها.
+        """
+        if self.inline or threading.current_thread() is self._writer_thread:
+            with self._inline_lock:
+                if self._writer.in_transaction:
+                    raise sqlite3.OperationalError("لا يمكن تنفيذ عملية حصرية داخل معاملة كتابة")
+                return operation(self._writer)
+
+        if self.read_only:
+            raise sqlite3.OperationalError("قاعدة البيانات مفتوحة للقراءة فقط")
+        if self._writer_thread is None:
+            raise sqlite3.ProgrammingError("تم إغلاق الاتصال بقاعدة البيانات")
+        future = futures.Future()
+        self._writes.put((operation, future, True))
+        return future.result()
+
+    def _writer_loop(self):
+        """خيط الكاتب: يسحب العمليات المنتظرة ويثبتها في معاملة واحدة"""
+        # القراءات داخل عمليات الكتابة ترى التعديلات غير المثبتة بعد
+        self._local.conn = self._writer
+        pending = None
+        while True:
+            item, pending = pending or self._writes.get(), None
+            if item is None:
+                return
+            operation, future, exclusive = item
+            if exclusive:
+                self._run_exclusive(operation, future)
+                continue
+            batch = [(operation, future)]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                if item[2]:
+                    # العملية الحصرية تنتظر تثبيت الدفعة الحالية
+                    pending = item
+                    break
+                batch.append(item[:2])
+            self._run_batch(batch)
+            if stop:
+                return
+
+    def _run_exclusive(self, operation, future):
+        """تنفيذ عملية حصرية من خيط الكاتب"""
+        conn = self._writer
+        try:
+            future.set_result(operation(conn))
+        except BaseException as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            future.set_exception(e)
+
+    def _run_batch(self, batch):
+        """تنفيذ دفعة عمليات في معاملة واحدة، كل عملية في SAVEPOINT خاص"""
+        conn = self._writer
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for operation, future in batch:
+                conn.execute("SAVEPOINT write_operation")
+                try:
+                    result = operation(conn)
+                    conn.execute("RELEASE write_operation")
+                    results.append((future, result, None))
+                except BaseException as e:
+                    conn.execute("ROLLBACK TO write_operation")
+                    conn.execute("RELEASE write_operation")
+                    results.append((future, None, e))
+            conn.execute("COMMIT")
+        except BaseException as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            results = [(future, None, e) for _, future in batch]
+
+        for future, result, error in results:
+            if future is None:
+                # تنفيذ مباشر (قاعدة في الذاكرة أو من خيط الكاتب)
+                if error is not None:
+                    raise error
+                return result
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        """إيقاف الكاتب وإغلاق جميع الاتصالات"""
+        if self._writer_thread is not None:
+            self._writes.put(None)
+            self._writer_thread.join()
+            self._writer_thread = None
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+
+
+class AnalysisSnapshot:
+    """لقطة بيانات لطلب تحليل واحد
+
+    تقرأ موظفي كل مديرية مرة واحدة وتشاركها بين جميع دوال التحليل، فلا
+    تتغير البيانات بين خطوات التقرير الواحد.
+    """
+
+    def __init__(self, program):
+        self.program = program
+        self.taken_at = datetime.now()
+        self._employees = {}
+
+    def employees(self, directorate=None):
+        """موظفو المديرية (أو الجميع) كما قرئوا أول مرة داخل هذه اللقطة"""
+        key = directorate or None
+        if key not in self._employees:
+            if key is not None and None in self._employees:
+                # إذا حملت الشركة كاملة نكتفي بالتصفية بدل قراءة جديدة
+                everyone = self._employees[None]
+                self._employees[key] = everyone[everyone['directorate'] == key]
+            else:
+                self._employees[key] = self.program.get_employees(key)
+        return self._employees[key]
+
+
+# معاملات السيناريو غير المعدلات المالية: (الاسم, القيمة الافتراضية)
+SCENARIO_PARAMETERS = (
+    ('attendance_change', 0.0),   # تغير نسبة التواجد بالمئة (-10 = انخفاض 10%)
+    ('headcount_change', 0.0),    # تغير عدد الموظفين بالمئة
+    ('directorates', None),       # المديريات التي يطبق عليها التغيران (None = الجميع)
+)
+
+
+def scenario_grid(**axes):
+    """كل تراكيب قيم المحاور كقائمة سيناريوهات
+
+    مثال: scenario_grid(feeding_rate=[2500, 3000], attendance_change=[0, -10])
+    يعطي أربعة سيناريوهات. المحور ذو القيمة المفردة يثبت في كل السيناريوهات.
+    """
+    names = list(axes)
+    values = [value if isinstance(value, (list, range)) else [value] for value in axes.values()]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+class ScenarioSimulator:
+    """محاكاة سيناريوهات "ماذا لو" للمسير والجهوزية على دفعات
+
+    تحمل الموظفين مرة واحدة مجمعين إلى مجموعات (المديرية، نسبة التواجد،
+    نشط أم لا) مع عدد كل مجموعة، في مصفوفات NumPy صغيرة. كل دفعة سيناريوهات
+    تقيم معادلات المسير كمصفوفة (سيناريو × مجموعة) وتجمع لكل مديرية بضرب
+    مصفوفات، فلا يعاد قراءة البيانات ولا الحساب موظفاً موظفاً.
+    """
+
+    # حد عناصر مصفوفة (سيناريو × مجموعة) في الدفعة الواحدة
+    max_cells = 2_000_000
+
+    def __init__(self, program, month=None):
+        self.month = month or datetime.now().strftime('%Y-%m')
+        self.rates = dict(program.get_financial_rates())
+        self.formulas = program.get_payroll_formulas()
+        # التواجد الفعلي للشهر، ومن لا سجل له يؤخذ تواجده الحالي (كما في run_payroll)
+        groups = program._read_sql('''
+        SELECT COALESCE(e.directorate, '') AS directorate,
+               COALESCE(100.0 * m.days_present / m.days_recorded, e.attendance_rate, 0) AS attendance,
+               e.status = 'active' AS active,
+               COUNT(*) AS employee_count
+        FROM employees e
+        LEFT JOIN attendance_monthly m
+            ON m.global_id = e.global_id AND m.month = ? AND m.days_recorded > 0
+        GROUP BY 1, 2, 3
+        ''', [self.month])
+        codes, self.directorates = pd.factorize(groups['directorate'], sort=True)
+        self.directorates = list(self.directorates)
+        self.group_directorate = codes.astype(np.intp)
+        self.attendance = groups['attendance'].to_numpy(dtype=float)
+        self.active = groups['active'].fillna(0).to_numpy(dtype=float)
+        self.counts = groups['employee_count'].to_numpy(dtype=float)
+        # مصفوفة انتماء المجموعات للمديريات (مجموعة × مديرية) للتجميع بضرب المصفوفات
+        self.membership = np.zeros((len(groups), len(self.directorates)))
+        self.membership[np.arange(len(groups)), self.group_directorate] = 1.0
+
+    def _parameters(self, scenarios):
+        """مصفوفات المعاملات (سيناريو × 1) ومصفوفة المديريات المتأثرة (سيناريو × مديرية)"""
+        known = set(self.rates) | {name for name, _ in SCENARIO_PARAMETERS} | {'name'}
+        applies = np.ones((len(scenarios), len(self.directorates)), dtype=bool)
+        for row, scenario in enumerate(scenarios):
+            unknown = set(scenario) - known
+            if unknown:
+                raise ValueError(f"معاملات غير معروفة في السيناريو: {', '.join(sorted(unknown))}")
+            selected = scenario.get('directorates')
+            if selected is not None:
+                selected = [selected] if isinstance(selected, str) else selected
+                applies[row] = np.isin(self.directorates, list(selected))
+        rates = {
+            name: np.array([float(scenario.get(name, value)) for scenario in scenarios])[:, None]
+            for name, value in self.rates.items()
+        }
+        changes = {
+            name: np.array([float(scenario.get(name) or default) for scenario in scenarios])[:, None]
+            for name, default in SCENARIO_PARAMETERS if name != 'directorates'
+        }
+        return rates, changes, applies
+
+    def _evaluate(self, scenarios):
+        """مجاميع البنود والجهوزية لكل (سيناريو، مديرية) كمصفوفات (سيناريو × مديرية)"""
+        rates, changes, applies = self._parameters(scenarios)
+        applies = applies[:, self.group_directorate]
+        attendance = np.where(
+            applies, np.clip(self.attendance * (1 + changes['attendance_change'] / 100), 0, 100), self.attendance
+        )
+        weights = self.counts * np.where(applies, np.clip(1 + changes['headcount_change'] / 100, 0, None), 1.0)
+        headcount = weights @ self.membership
+
+        variables = {**rates, 'attendance': attendance, 'employee_count': headcount[:, self.group_directorate]}
+        totals = {}
+        for name, formula in self.formulas.items():
+            amount = np.broadcast_to(formula.evaluate(variables), attendance.shape)
+            totals[name] = (amount * weights) @ self.membership
+        totals['التغذية_العينية'] = totals['التغذية'] * rates['in_kind_share']
+        totals['التغذية_النقدية'] = totals['التغذية'] - totals['التغذية_العينية']
+        totals['العمال_المطلوبون'] = headcount
+        totals['العمال_الجاهزون'] = (weights * self.active) @ self.membership
+        return totals
+
+    def run(self, scenarios, by_directorate=False):
+        """تقييم السيناريوهات وإرجاع جدول مقارنة
+
+        السيناريو قاموس يعدل أياً من المعدلات المالية (feeding_rate...) ومعه
+        attendance_change و headcount_change و directorates و name. أول صف هو
+        الأساس (بلا تعديل)، ولكل سيناريو الإجمالي والجهوزية والفرق عن الأساس.
+        مع by_directorate=True يكون صف لكل (سيناريو، مديرية).
+        """
+        scenarios = [{'name': 'الأساس'}] + [dict(scenario) for scenario in scenarios]
+        chunk_size = max(1, self.max_cells // max(1, len(self.counts)))
+        chunks = [self._evaluate(scenarios[start:start + chunk_size])
+                  for start in range(0, len(scenarios), chunk_size)]
+        totals = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+
+        items = [name for name in self.formulas if name != 'التغذية'] + ['التغذية', 'التغذية_العينية', 'التغذية_النقدية']
+        grand_total = sum(totals[name] for name in self.formulas)
+        if by_directorate:
+            table = pd.DataFrame({
+                'scenario': np.repeat(np.arange(len(scenarios)), len(self.directorates)),
+                'directorate': np.tile(self.directorates, len(scenarios)),
+            })
+            flatten = np.ravel
+        else:
+            table = pd.DataFrame({'scenario': np.arange(len(scenarios))})
+            totals = {name: values.sum(axis=1) for name, values in totals.items()}
+            grand_total = grand_total.sum(axis=1)
+            flatten = np.asarray
+
+        names = [scenario.get('name') or f"سيناريو {index}" for index, scenario in enumerate(scenarios)]
+        table.insert(1, 'name', np.asarray(names, dtype=object)[table['scenario']])
+        for name, default in SCENARIO_PARAMETERS:
+            values = [scenario.get(name, default) for scenario in scenarios]
+            if name == 'directorates':
+                values = ['، '.join([value] if isinstance(value, str) else value) if value else 'الكل'
+                          for value in values]
+            table[name] = np.asarray(values, dtype=object)[table['scenario']]
+        for name in sorted({key for scenario in scenarios for key in scenario} & set(self.rates)):
+            values = [float(scenario.get(name, self.rates[name])) for scenario in scenarios]
+            table[name] = np.asarray(values)[table['scenario']]
+
+        for name in items:
+            table[name] = flatten(totals[name])
+        table['الإجمالي'] = flatten(grand_total)
+        table['العمال_المطلوبون'] = flatten(totals['العمال_المطلوبون'])
+        table['العمال_الجاهزون'] = flatten(totals['العمال_الجاهزون'])
+        required = table['العمال_المطلوبون']
+        table['نسبة_الجهوزية'] = (100 * table['العمال_الجاهزون'] / required.where(required > 0)).fillna(0)
+        # التجهيزات كما في analyze_readiness: المطلوب ضعف العمال والجاهز مثلهم
+        table['التجهيزات_المطلوبة'] = required * 2
+
+        baseline = table.loc[table['scenario'] == 0, 'الإجمالي'].to_numpy()
+        baseline = np.tile(baseline, len(scenarios))
+        table['الفرق_عن_الأساس'] = table['الإجمالي'] - baseline
+        table['نسبة_الفرق'] = 100 * table['الفرق_عن_الأساس'] / np.where(baseline != 0, baseline, np.nan)
+        return table
+
+
+@instrument_methods
 class ConstructionProgram:
-    def __init__(self, db_name="construction_program.db"):
+    def __init__(self, db_name="construction_program.db", cache_ttl=None, pool_size=4, busy_timeout=5.0,
+                 read_only=False, instrument=True, slow_query_ms=None):
         self.db_name = db_name
-        self.conn = None
+        # عدادات الأداء (stats) وسجل الاستعلامات البطيئة؛ instrument=False يعطلها كلياً
+        self.instrumentation = Instrumentation(slow_query_ms) if instrument else None
+        # مجمع الاتصالات والكاتب الوحيد (ينشأ في setup_database)
+        self.db = None
+        self.pool_size = pool_size
+        self.busy_timeout = busy_timeout
+        # للقراءة فقط: لا إنشاء جداول ولا ترحيلات ولا كاتب (عمليات التحليل المتوازية)
+        self.read_only = read_only
+        self.discrepancy_rules = list(DISCREPANCY_RULES)
+        # مدة صلاحية ذاكرة الموظفين المؤقتة بالثواني (None لتعطيلها)
+        self.cache_ttl = cache_ttl
+        self._employees_cache = {}
+        # يزيد مع كل إبطال؛ القارئ لا يملأ الذاكرة إلا إذا لم يتغير منذ بدأ القراءة
+        self._employees_version = 0
+        self._employees_lock = threading.Lock()
+        # المعدلات والمعادلات المترجمة، تبطل عند حفظ الإعدادات
+        self._financial_cache = {}
+        # كل الإعدادات ({النوع: {الاسم: القيمة}}, {الاسم: أحدث قيمة})، تحمل عند أول قراءة وتبطل عند الحفظ
+        self._settings_cache = None
+        # يزيد مع كل إبطال؛ القارئ لا يملأ الذاكرتين إلا إذا لم يتغير منذ بدأ القراءة
+        self._settings_version = 0
+        self._settings_lock = threading.Lock()
         self.setup_database()
 
     def setup_database(self):
         """إنشاء وتجهيز قاعدة البيانات"""
-        try:
-            self.conn = sqlite3.connect(self.db_name)
-            cursor = self.conn.cursor()
+        def create_tables(conn):
+            cursor = conn.cursor()
 
             # جدول الهيكل التنظيمي
             cursor.execute('''
@@ -119,11 +1671,65 @@ class ConstructionProgram:
             )
             ''')
 
-            self.conn.commit()
-            print("✅ تم إنشاء قاعدة البيانات بنجاح")
+        try:
+            self.db = ConnectionManager(
+                self.db_name, pool_size=self.pool_size, busy_timeout=self.busy_timeout,
+                read_only=self.read_only, instrumentation=self.instrumentation
+            )
+            # القاعدة المحدثة مسبقاً لا تحتاج جمل الإنشاء ولا الترحيلات
+            if self.read_only or self.get_schema_version() >= SCHEMA_VERSION:
+                return
+            self.db.write(create_tables)
+            self.migrate_database()
+            logger.info("✅ تم إنشاء قاعدة البيانات بنجاح")
 
         except Exception as e:
-            print(f"❌ خطأ في إنشاء قاعدة البيانات: {e}")
+            logger.error("❌ خطأ في إنشاء قاعدة البيانات: %s", e)
+
+    def get_schema_version(self):
+        """جلب إصدار مخطط قاعدة البيانات المخزن"""
+        return self._fetchone("PRAGMA user_version")[0]
+
+    def _fetchall(self, query, params=()):
+        """تنفيذ استعلام قراءة وإرجاع جميع الصفوف"""
+        with self.db.read() as conn:
+            return conn.execute(query, params).fetchall()
+
+    def _fetchone(self, query, params=()):
+        """تنفيذ استعلام قراءة وإرجاع أول صف"""
+        with self.db.read() as conn:
+            return conn.execute(query, params).fetchone()
+
+    def _read_sql(self, query, params=()):
+        """قراءة نتيجة استعلام كـ DataFrame من اتصال قراءة"""
+        with self.db.read() as conn:
+            return pd.read_sql_query(query, conn, params=list(params))
+
+    def migrate_database(self):
+        """ترقية قاعدة البيانات الحالية إلى آخر إصدار للمخطط
+
+        كل ترحيل ينفذ في معاملة مستقلة مع تحديث رقم الإصدار، فإذا فشل
+        تبقى القاعدة على آخر إصدار مكتمل.
+        """
+        current_version = self.get_schema_version()
+        for version, description, steps in SCHEMA_MIGRATIONS:
+            if version <= current_version:
+                continue
+
+            def apply_migration(conn, version=version, steps=steps):
+                cursor = conn.cursor()
+                for step in steps:
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
+                # PRAGMA لا يقبل معاملات مربوطة، والإصدار رقم صحيح من الكود
+                cursor.execute(f"PRAGMA user_version = {int(version)}")
+
+            self.db.write(apply_migration)
+            current_version = version
+            logger.info("✅ تمت ترقية قاعدة البيانات إلى الإصدار %s: %s", version, description)
+        return current_version
 
     # ██████████████████████████████████████████████████████████████████████████████
     # ████████████████████████████ الجانب البشري ███████████████████████████████████
@@ -132,15 +1738,15 @@ class ConstructionProgram:
     def add_employee(self, employee_data):
         """إضافة موظف جديد"""
         try:
-            cursor = self.conn.cursor()
             query = '''
             INSERT INTO employees (
                 global_id, functional_id, full_name, position, level,
                 qualification, training_courses, personal_equipment, equipment_notes,
-                company, directorate, department, administration, branch, section
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                directorate, org_unit_id
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             '''
-            cursor.execute(query, (
+            org_path = tuple(employee_data[level] for level in ORG_LEVELS)
+            values = (
                 employee_data['global_id'],
                 employee_data['functional_id'],
                 employee_data['full_name'],
@@ -150,76 +1756,436 @@ class ConstructionProgram:
                 employee_data.get('training_courses', ''),
                 employee_data.get('personal_equipment', ''),
                 employee_data.get('equipment_notes', ''),
-                employee_data['company'],
-                employee_data['directorate'],
-                employee_data['department'],
-                employee_data['administration'],
-                employee_data['branch'],
-                employee_data['section']
-            ))
-            self.conn.commit()
-            print("✅ تم إضافة الموظف بنجاح")
+                employee_data['directorate']
+            )
+
+            def insert(conn):
+                cursor = conn.cursor()
+                org_unit_id = _org_unit_ids(cursor, [org_path])[org_path]
+                cursor.execute(query, values + (org_unit_id,))
+                _index_search_rows(cursor, 'employees', 'id', [cursor.lastrowid])
+
+            self.db.write(insert)
+            self.invalidate_employees_cache()
+            logger.info("✅ تم إضافة الموظف بنجاح")
             return True
         except Exception as e:
-            print(f"❌ خطأ في إضافة الموظف: {e}")
+            logger.error("❌ خطأ في إضافة الموظف: %s", e)
             return False
 
     def get_employees(self, directorate=None):
-        """جلب بيانات الموظفين"""
+        """جلب بيانات الموظفين
+
+        عند تفعيل cache_ttl يعاد الإطار المخزن نفسه دون نسخ، فلا يجوز تعديله.
+        """
         try:
+            key = directorate or None
+            if self.cache_ttl is not None:
+                cached = self._employees_cache.get(key)
+                if cached and time.monotonic() - cached[0] < self.cache_ttl:
+                    return cached[1]
+
+            version = self._employees_version
             if directorate:
-                query = "SELECT * FROM employees WHERE directorate = ? ORDER BY created_at DESC"
-                df = pd.read_sql_query(query, self.conn, params=[directorate])
+                query = "SELECT * FROM employee_records WHERE directorate = ? ORDER BY created_at DESC"
+                df = self._read_sql(query, [directorate])
             else:
-                query = "SELECT * FROM employees ORDER BY created_at DESC"
-                df = pd.read_sql_query(query, self.conn)
+                query = "SELECT * FROM employee_records ORDER BY created_at DESC"
+                df = self._read_sql(query)
+
+            if self.cache_ttl is not None:
+                # قراءة بدأت قبل كتابة انتهت أثناءها قد تحمل بيانات قديمة فلا تحفظ
+                with self._employees_lock:
+                    if self._employees_version == version:
+                        self._employees_cache[key] = (time.monotonic(), df)
             return df
         except Exception as e:
-            print(f"❌ خطأ في جلب بيانات الموظفين: {e}")
+            logger.error("❌ خطأ في جلب بيانات الموظفين: %s", e)
             return pd.DataFrame()
 
+    def invalidate_employees_cache(self):
+        """إبطال الذاكرة المؤقتة للموظفين بعد أي تعديل"""
+        with self._employees_lock:
+            self._employees_version += 1
+            self._employees_cache.clear()
+
+    def snapshot(self):
+        """إنشاء لقطة بيانات لتقرير واحد"""
+        return AnalysisSnapshot(self)
+
+    def _snapshot_employees(self, directorate, snapshot):
+        """موظفو المديرية من اللقطة إن وجدت وإلا من قاعدة البيانات"""
+        if snapshot is not None:
+            return snapshot.employees(directorate)
+        return self.get_employees(directorate)
+
     def update_employee_attendance(self, global_id, attendance_rate):
         """تحديث نسبة تواجد الموظف"""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
+            self.db.write(lambda conn: conn.execute(
                 "UPDATE employees SET attendance_rate = ? WHERE global_id = ?",
                 (attendance_rate, global_id)
-            )
-            self.conn.commit()
-            print(f"✅ تم تحديث تواجد الموظف {global_id} إلى {attendance_rate}%")
+            ))
+            self.invalidate_employees_cache()
+            logger.info("✅ تم تحديث تواجد الموظف %s إلى %s%%", global_id, attendance_rate)
             return True
         except Exception as e:
-            print(f"❌ خطأ في تحديث التواجد: {e}")
+            logger.error("❌ خطأ في تحديث التواجد: %s", e)
             return False
 
+    def _normalize_employee_row(self, row):
+        """تحويل صف خام (CSV/Excel/قاموس) إلى قيم جاهزة للإدخال مع التحقق"""
+        missing = [field for field in EMPLOYEE_REQUIRED_FIELDS if field not in row]
+        if missing:
+            raise ValueError(f"حقول ناقصة: {', '.join(missing)}")
+
+        values = []
+        for field in EMPLOYEE_FIELDS:
+            value = row.get(field)
+            # None و NaN (من pandas/Excel) تعامل كقيمة فارغة
+            if value is None or value != value:
+                value = ''
+            values.append(str(value).strip())
+
+        if not values[0]:
+            raise ValueError("الرقم العام (global_id) فارغ")
+        if not values[2]:
+            raise ValueError("الاسم الكامل (full_name) فارغ")
+        return tuple(values)
+
+    def _iter_employee_rows(self, source):
+        """قراءة صفوف الموظفين تدفقياً من ملف CSV أو Excel أو أي iterable"""
+        if isinstance(source, pd.DataFrame):
+            yield from source.to_dict('records')
+            return
+
+        if not isinstance(source, (str, os.PathLike)):
+            yield from source
+            return
+
+        extension = os.path.splitext(str(source))[1].lower()
+        if extension == '.csv':
+            with open(source, newline='', encoding='utf-8-sig') as f:
+                yield from csv.DictReader(f)
+        elif extension in ('.xlsx', '.xlsm'):
+            # وضع القراءة فقط في openpyxl يقرأ الصفوف دون تحميل الملف كاملاً
+            from openpyxl import load_workbook
+            workbook = load_workbook(source, read_only=True, data_only=True)
+            try:
+                rows = workbook.active.iter_rows(values_only=True)
+                header = [str(cell).strip() if cell is not None else '' for cell in next(rows, ())]
+                for cells in rows:
+                    yield dict(zip(header, cells))
+            finally:
+                workbook.close()
+        else:
+            raise ValueError(f"صيغة ملف غير مدعومة: {extension}")
+
+    def add_employees_bulk(self, employees, chunk_size=1000):
+        """إضافة مجموعة موظفين دفعة واحدة داخل معاملة واحدة
+
+        يتم الإدخال على دفعات بـ executemany، ويعامل تكرار global_id كتحديث
+        للسجل الموجود. أخطاء التحقق تسجل لكل صف دون إيقاف الدفعة. مسارات
+        الهيكل تحول إلى org_unit_id مرة لكل مسار مختلف في الدفعة.
+        """
+        columns = ', '.join(EMPLOYEE_COLUMNS)
+        placeholders = ', '.join('?' for _ in EMPLOYEE_COLUMNS)
+        updates = ', '.join(f"{column} = excluded.{column}" for column in EMPLOYEE_COLUMNS[1:])
+        query = f'''
+        INSERT INTO employees ({columns}) VALUES ({placeholders})
+        ON CONFLICT(global_id) DO UPDATE SET {updates}
+        '''
+        stored = [EMPLOYEE_FIELDS.index(column) for column in EMPLOYEE_COLUMNS[:-1]]
+        org = [EMPLOYEE_FIELDS.index(level) for level in ORG_LEVELS]
+
+        report = {'processed': 0, 'imported': 0, 'errors': [], 'elapsed': 0.0, 'rows_per_second': 0.0}
+        started = time.perf_counter()
+
+        def flush(cursor, chunk):
+            org_unit_ids = _org_unit_ids(cursor, [tuple(values[i] for i in org) for _, values in chunk])
+            chunk = [
+                (row_number, (*(values[i] for i in stored), org_unit_ids[tuple(values[i] for i in org)]))
+                for row_number, values in chunk
+            ]
+            cursor.execute("SAVEPOINT employees_chunk")
+            try:
+                cursor.executemany(query, [values for _, values in chunk])
+                report['imported'] += len(chunk)
+            except sqlite3.Error:
+                # فشلت الدفعة: نعيدها صفاً صفاً لتحديد الصفوف المخالفة فقط
+                cursor.execute("ROLLBACK TO employees_chunk")
+                for row_number, values in chunk:
+                    try:
+                        cursor.execute(query, values)
+                        report['imported'] += 1
+                    except sqlite3.Error as e:
+                        report['errors'].append({'row': row_number, 'global_id': values[0], 'error': str(e)})
+            cursor.execute("RELEASE employees_chunk")
+            # فهرس البحث للدفعة كاملة (المضافون والمحدثون) في نفس المعاملة
+            _index_search_rows(cursor, 'employees', 'global_id', [values[0] for _, values in chunk])
+
+        def import_rows(conn):
+            cursor = conn.cursor()
+            chunk = []
+            for row_number, row in enumerate(employees, start=1):
+                report['processed'] += 1
+                try:
+                    chunk.append((row_number, self._normalize_employee_row(row)))
+                except (ValueError, TypeError, AttributeError) as e:
+                    global_id = row.get('global_id') if isinstance(row, dict) else None
+                    report['errors'].append({'row': row_number, 'global_id': global_id, 'error': str(e)})
+                    continue
+                if len(chunk) >= chunk_size:
+                    flush(cursor, chunk)
+                    chunk = []
+            if chunk:
+                flush(cursor, chunk)
+
+        try:
+            self.db.write(import_rows)
+            self.invalidate_employees_cache()
+        except Exception as e:
+            report['imported'] = 0
+            logger.error("❌ خطأ في الإضافة الجماعية للموظفين: %s", e)
+            return report
+
+        report['elapsed'] = time.perf_counter() - started
+        if report['elapsed'] > 0:
+            report['rows_per_second'] = report['imported'] / report['elapsed']
+        logger.info("✅ تم استيراد %s موظف (%.0f صف/ثانية) مع %s خطأ",
+                    report['imported'], report['rows_per_second'], len(report['errors']))
+        return report
+
+    def import_employees(self, path_or_iterable, chunk_size=1000):
+        """استيراد الموظفين من ملف CSV/Excel أو من أي iterable من القواميس"""
+        try:
+            rows = self._iter_employee_rows(path_or_iterable)
+            return self.add_employees_bulk(rows, chunk_size=chunk_size)
+        except Exception as e:
+            logger.error("❌ خطأ في استيراد الموظفين: %s", e)
+            return {'processed': 0, 'imported': 0, 'errors': [], 'elapsed': 0.0, 'rows_per_second': 0.0}
+
+    def _normalize_attendance_event(self, event):
+        """تحويل حركة تواجد إلى (global_id, التاريخ, حاضر, المصدر) مع التحقق"""
+        global_id = str(event.get('global_id') or '').strip()
+        if not global_id:
+            raise ValueError("الرقم العام (global_id) فارغ")
+
+        event_date = event.get('date')
+        if hasattr(event_date, 'strftime'):
+            event_date = event_date.strftime('%Y-%m-%d')
+        else:
+            event_date = datetime.strptime(str(event_date or '').strip()[:10], '%Y-%m-%d').strftime('%Y-%m-%d')
+
+        present = event.get('present', True)
+        if isinstance(present, str):
+            value = present.strip().lower()
+            if value in ('1', 'true', 'yes', 'حاضر'):
+                present = 1
+            elif value in ('0', 'false', 'no', 'غائب'):
+                present = 0
+            else:
+                raise ValueError(f"قيمة حضور غير معروفة: {present}")
+        else:
+            present = 1 if present else 0
+
+        return global_id, event_date, present, event.get('source')
+
+    def record_attendance_bulk(self, events, chunk_size=5000):
+        """تسجيل حركات التواجد اليومية دفعة واحدة داخل معاملة واحدة
+
+        كل حركة قاموس فيه global_id و date و present (افتراضياً حاضر) و source.
+        حركات global_id غير الموجود في employees ترفض كأخطاء صفوف ولا تسجل.
+        تكرار نفس الموظف في نفس اليوم يحدث الحركة السابقة. المجاميع الشهرية
+        تحدثها المشغلات تدريجياً، ثم تحدث attendance_rate للموظفين المتأثرين
+        فقط من آخر شهر مسجل لكل منهم.
+        """
+        query = '''
+        INSERT INTO attendance_events (global_id, event_date, present, source)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(global_id, event_date) DO UPDATE SET
+            present = excluded.present,
+            source = excluded.source
+        '''
+        report = {'processed': 0, 'recorded': 0, 'errors': [], 'elapsed': 0.0, 'rows_per_second': 0.0}
+        started = time.perf_counter()
+        touched = set()
+        known = set()
+
+        def flush(cursor, chunk):
+            # الموظفون الموجودون من الدفعة، بحد 900 معامل لكل استعلام
+            unchecked = list({values[0] for _, values in chunk} - known)
+            for start in range(0, len(unchecked), 900):
+                part = unchecked[start:start + 900]
+                known.update(row[0] for row in cursor.execute(
+                    f"SELECT global_id FROM employees WHERE global_id IN ({', '.join('?' for _ in part)})", part
+                ))
+            rows = []
+            for row_number, values in chunk:
+                if values[0] in known:
+                    rows.append(values)
+                    touched.add(values[0])
+                else:
+                    report['errors'].append({'row': row_number, 'global_id': values[0],
+                                             'error': f"موظف غير موجود: {values[0]}"})
+            cursor.executemany(query, rows)
+            report['recorded'] += len(rows)
+
+        def record_events(conn):
+            cursor = conn.cursor()
+            chunk = []
+            for row_number, event in enumerate(events, start=1):
+                report['processed'] += 1
+                try:
+                    values = self._normalize_attendance_event(event)
+                except (ValueError, TypeError, AttributeError) as e:
+                    report['errors'].append({'row': row_number, 'error': str(e)})
+                    continue
+                chunk.append((row_number, values))
+                if len(chunk) >= chunk_size:
+                    flush(cursor, chunk)
+                    chunk = []
+            if chunk:
+                flush(cursor, chunk)
+            report['errors'].sort(key=lambda error: error['row'])
+
+            # تحديث النسبة الحالية للموظفين المتأثرين من آخر شهر لديهم
+            cursor.executemany('''
+            UPDATE employees SET attendance_rate = (
+                SELECT 100.0 * days_present / days_recorded FROM attendance_monthly m
+                WHERE m.global_id = employees.global_id AND m.days_recorded > 0
+                ORDER BY m.month DESC LIMIT 1
+            )
+            WHERE global_id = ? AND EXISTS (
+                SELECT 1 FROM attendance_monthly m
+                WHERE m.global_id = employees.global_id AND m.days_recorded > 0
+            )
+            ''', ((global_id,) for global_id in touched))
+
+        try:
+            self.db.write(record_events)
+            self.invalidate_employees_cache()
+        except Exception as e:
+            report['recorded'] = 0
+            logger.error("❌ خطأ في تسجيل التواجد: %s", e)
+            return report
+
+        report['elapsed'] = time.perf_counter() - started
+        if report['elapsed'] > 0:
+            report['rows_per_second'] = report['recorded'] / report['elapsed']
+        logger.info("✅ تم تسجيل %s حركة تواجد (%.0f صف/ثانية) مع %s خطأ",
+                    report['recorded'], report['rows_per_second'], len(report['errors']))
+        return report
+
+    def get_monthly_attendance(self, month, directorate=None):
+        """نسب التواجد الفعلية لشهر معين من التجميع الشهري (global_id -> النسبة)"""
+        query = '''
+        SELECT m.global_id, 100.0 * m.days_present / m.days_recorded AS attendance_rate
+        FROM attendance_monthly m
+        '''
+        params = [month]
+        if directorate:
+            query += " JOIN employees e ON e.global_id = m.global_id WHERE m.month = ? AND e.directorate = ?"
+            params.append(directorate)
+        else:
+            query += " WHERE m.month = ?"
+        query += " AND m.days_recorded > 0"
+        df = self._read_sql(query, params)
+        return df.set_index('global_id')['attendance_rate']
+
     # ██████████████████████████████████████████████████████████████████████████████
     # ████████████████████████████ الجانب المالي ███████████████████████████████████
     # ██████████████████████████████████████████████████████████████████████████████
 
-    def calculate_salary(self, employee_count, attendance_rate, basic_salary=40000):
-        """حساب الرواتب"""
+    def _cached_financial(self, key, build):
+        """قيمة key من ذاكرة الحسابات المالية، أو تبنى بـ build() وتحفظ
+
+        لا تحفظ القيمة إن حفظت إعدادات أثناء بنائها، فلا تبقى قيم قديمة بعد الإبطال.
+        """
+        value = self._financial_cache.get(key)
+        if value is None:
+            version = self._settings_version
+            value = build()
+            with self._settings_lock:
+                if self._settings_version == version:
+                    self._financial_cache[key] = value
+        return value
+
+    def get_financial_rates(self):
+        """المعدلات المالية الحالية: القيم الافتراضية مع ما عدل في الإعدادات"""
+        def build():
+            rates = dict(FINANCIAL_RATES)
+            for name, value in self.get_settings(RATE_SETTING_TYPE).items():
+                rates[name] = float(value)
+            return rates
+        return self._cached_financial('rates', build)
+
+    def get_payroll_formulas(self):
+        """معادلات بنود المسير مترجمة (اسم البند -> FinancialFormula)"""
+        def build():
+            texts = dict(PAYROLL_FORMULAS)
+            texts.update(self.get_settings(FORMULA_SETTING_TYPE))
+            return {name: compile_formula(text) for name, text in texts.items()}
+        return self._cached_financial('formulas', build)
+
+    def get_asset_standards(self):
+        """معايير احتساب العهد مع ما عدل منها في الإعدادات"""
+        def build():
+            standards = {name: dict(standard) for name, standard in ASSET_STANDARDS.items()}
+            for name, value in self.get_settings(ASSET_STANDARD_SETTING_TYPE).items():
+                # المعايير المحفوظة قبل أنواع القيم نصوص JSON
+                standards[name] = json.loads(value) if isinstance(value, str) else dict(value)
+            return standards
+        return self._cached_financial('asset_standards', build)
+
+    def evaluate_formula(self, formula, **variables):
+        """تقييم معادلة نصية بالمعدلات الحالية مع متغيرات إضافية"""
+        return compile_formula(formula).evaluate({**self.get_financial_rates(), **variables})
+
+    def calculate_salary(self, employee_count, attendance_rate, basic_salary=None):
+        """حساب الرواتب لجميع الموظفين"""
+        if basic_salary is None:
+            basic_salary = self.get_financial_rates()['basic_salary']
         net_salary = (basic_salary / 30) * (attendance_rate / 100) * 30
-        return net_salary
+        return employee_count * net_salary
 
     def calculate_feeding(self, employee_count, attendance_rate):
         """حساب التغذية"""
-        total_feeding = employee_count * 2500 * 30 * (attendance_rate / 100)
-        in_kind = total_feeding * 0.8  # عيني
-        cash = total_feeding * 0.2     # نقدي
+        rates = self.get_financial_rates()
+        total_feeding = employee_count * rates['feeding_rate'] * rates['days'] * (attendance_rate / 100)
+        in_kind = total_feeding * rates['in_kind_share']  # عيني
+        cash = total_feeding - in_kind                     # نقدي
         return total_feeding, in_kind, cash
 
+    def _payroll_columns(self, attendance, employee_count=None):
+        """حساب بنود المسير لكل موظف كأعمدة متجهة من عمود التواجد
+
+        employee_count عدد موظفي مديرية كل صف (عمود بنفس الفهرس)، والافتراضي
+        عدد الصفوف كلها عندما تكون من مديرية أو وحدة واحدة.
+        """
+        rates = self.get_financial_rates()
+        if employee_count is None:
+            employee_count = len(attendance)
+        variables = {**rates, 'attendance': attendance, 'employee_count': employee_count}
+        columns = pd.DataFrame(
+            {name: formula.evaluate(variables) for name, formula in self.get_payroll_formulas().items()},
+            index=attendance.index
+        )
+        # تقسيم التغذية إلى عيني ونقدي
+        columns['التغذية_العينية'] = columns['التغذية'] * rates['in_kind_share']
+        columns['التغذية_النقدية'] = columns['التغذية'] - columns['التغذية_العينية']
+        return columns
+
     def add_financial_item(self, item_data):
         """إضافة بند مالي"""
         try:
-            cursor = self.conn.cursor()
             query = '''
             INSERT INTO financial_items (
                 item_name, item_type, amount, calculation_formula,
                 employee_count, attendance_rate, total_amount, month, directorate
             ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             '''
-            cursor.execute(query, (
+            values = (
                 item_data['item_name'],
                 item_data['item_type'],
                 item_data['amount'],
@@ -229,39 +2195,388 @@ class ConstructionProgram:
                 item_data['total_amount'],
                 item_data['month'],
                 item_data['directorate']
-            ))
-            self.conn.commit()
-            print("✅ تم إضافة البند المالي بنجاح")
+            )
+            self.db.write(lambda conn: conn.execute(query, values))
+            logger.info("✅ تم إضافة البند المالي بنجاح")
             return True
         except Exception as e:
-            print(f"❌ خطأ في إضافة البند المالي: {e}")
+            logger.error("❌ خطأ في إضافة البند المالي: %s", e)
             return False
 
-    def calculate_all_financials(self, directorate, month):
+    def calculate_all_financials(self, directorate, month, snapshot=None):
         """حساب جميع البنود المالية"""
         try:
-            employees = self.get_employees(directorate)
-            employee_count = len(employees)
-            avg_attendance = employees['attendance_rate'].mean() if not employees.empty else 0
-
-            financial_report = {
-                'الرواتب': self.calculate_salary(employee_count, avg_attendance),
-                'التغذية': self.calculate_feeding(employee_count, avg_attendance),
-                'الإسكان': employee_count * 15 * 30,
-                'الصحية': employee_count * 15 * 30,
-                'الإيجارات': employee_count * 40 * 30,
-                'الكهرباء': employee_count * 0.5 * 30,
-                'الماء': employee_count * 0.5 * 30,
-                'القرطاسية': employee_count * 0.5 * 30,
-                'النظافة': employee_count * 0.5 * 30,
-                'الصيانة': employee_count * 150 * 30
-            }
+            employees = self._snapshot_employees(directorate, snapshot)
+            if not employees.empty:
+                # التواجد الفعلي للشهر المطلوب، ومن لا سجل له يؤخذ تواجده الحالي
+                monthly = self.get_monthly_attendance(month, directorate)
+                attendance = employees['global_id'].map(monthly).fillna(employees['attendance_rate'])
+            else:
+                attendance = pd.Series(dtype=float)
 
-            return financial_report
+            return self._financial_report(attendance)
         except Exception as e:
-            print(f"❌ خطأ في الحسابات المالية: {e}")
+            logger.error("❌ خطأ في الحسابات المالية: %s", e)
             return {}
 
+    def _financial_report(self, attendance):
+        """مجاميع البنود المالية لعمود تواجد (التغذية كـ (الإجمالي، العيني، النقدي))"""
+        totals = self._payroll_columns(attendance).sum()
+        financial_report = {name: float(totals[name]) for name in self.get_payroll_formulas()}
+        financial_report['التغذية'] = (
+            float(totals['التغذية']),
+            float(totals['التغذية_العينية']),
+            float(totals['التغذية_النقدية'])
+        )
+        return financial_report
+
+    def run_payroll(self, months, directorates=None, write=True):
+        """الإقفال الشهري: حساب المسير لكل موظف ولكل مديرية وشهر دفعة واحدة
+
+        يقرأ الموظفين وتواجدهم الشهري مرة واحدة، ويحسب البنود كعمليات أعمدة،
+        ثم يجمعها حسب (المديرية، الشهر). عند write=True تستبدل بنود الإقفال
+        السابقة لنفس الأشهر والمديريات في financial_items داخل معاملة واحدة.
+        """
+        if isinstance(months, str):
+            months = [months]
+        months = list(months)
+        try:
+            query = "SELECT global_id, directorate, attendance_rate FROM employees"
+            params = []
+            if directorates:
+                directorates = list(directorates)
+                query += f" WHERE directorate IN ({', '.join('?' for _ in directorates)})"
+                params.extend(directorates)
+            employees = self._read_sql(query, params)
+            employees['directorate'] = employees['directorate'].fillna('')
+            # المعادلات التي تقسم على employee_count تعني عدد موظفي المديرية لا الشركة
+            employee_counts = employees.groupby('directorate')['global_id'].transform('size')
+
+            monthly = self._read_sql(
+                f'''
+                SELECT global_id, month, 100.0 * days_present / days_recorded AS attendance_rate
+                FROM attendance_monthly
+                WHERE month IN ({', '.join('?' for _ in months)}) AND days_recorded > 0
+                ''',
+                months
+            )
+
+            results = []
+            for month in months:
+                # شهر واحد في كل مرة حتى تبقى الذاكرة بحجم عدد الموظفين
+                month_rates = monthly.loc[monthly['month'] == month].set_index('global_id')['attendance_rate']
+                attendance = employees['global_id'].map(month_rates).fillna(employees['attendance_rate']).fillna(0)
+                items = self._payroll_columns(attendance, employee_counts)
+                items['directorate'] = employees['directorate']
+                items['attendance_rate'] = attendance
+                grouped = items.groupby('directorate', sort=True)
+                summary = grouped.sum()
+                summary['attendance_rate'] = grouped['attendance_rate'].mean()
+                summary['employee_count'] = grouped.size()
+                summary['month'] = month
+                results.append(summary.reset_index())
+
+            payroll = pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+            if write and not payroll.empty:
+                self._write_payroll(payroll)
+            return payroll
+        except Exception as e:
+            logger.error("❌ خطأ في الإقفال الشهري: %s", e)
+            return pd.DataFrame()
+
+    def _write_payroll(self, payroll):
+        """كتابة نتائج الإقفال في financial_items دفعة واحدة"""
+        formulas = {name: formula.text for name, formula in self.get_payroll_formulas().items()}
+        items = [name for name in formulas if name != 'التغذية']
+        items += ['التغذية_العينية', 'التغذية_النقدية']
+        long = payroll.melt(
+            id_vars=['directorate', 'month', 'employee_count', 'attendance_rate'],
+            value_vars=items, var_name='item_name', value_name='total_amount'
+        )
+        formulas['التغذية_العينية'] = f"({formulas['التغذية']}) * in_kind_share"
+        formulas['التغذية_النقدية'] = f"({formulas['التغذية']}) * (1 - in_kind_share)"
+        long['calculation_formula'] = long['item_name'].map(formulas)
+        long['amount'] = long['total_amount'] / long['employee_count']
+
+        def write_items(conn):
+            cursor = conn.cursor()
+            cursor.executemany(
+                "DELETE FROM financial_items WHERE month = ? AND directorate = ? AND item_type = ?",
+                [(month, directorate, PAYROLL_ITEM_TYPE)
+                 for directorate, month in payroll[['directorate', 'month']].itertuples(index=False)]
+            )
+            cursor.executemany('''
+            INSERT INTO financial_items (
+                item_name, item_type, amount, calculation_formula,
+                employee_count, attendance_rate, total_amount, month, directorate
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [
+                (row.item_name, PAYROLL_ITEM_TYPE, float(row.amount), row.calculation_formula,
+                 int(row.employee_count), float(row.attendance_rate), float(row.total_amount),
+                 row.month, row.directorate)
+                for row in long.itertuples(index=False)
+            ])
+
+        self.db.write(write_items)
+        logger.info("✅ تم إقفال %s (مديرية × شهر) وكتابة %s بنداً مالياً", len(payroll), len(long))
+
+    def recalculate_financial_items(self, month=None):
+        """إعادة حساب البنود المالية من معادلاتها المخزنة في calculation_formula
+
+        كل معادلة مختلفة تترجم مرة واحدة وتقيم على أعمدة جميع بنودها معاً
+        (attendance و employee_count من البند)، والبنود ذات الوصف النصي تتجاوز.
+        """
+        try:
+            query = '''
+            SELECT id, calculation_formula, employee_count, attendance_rate
+            FROM financial_items WHERE calculation_formula IS NOT NULL AND calculation_formula != ''
+            '''
+            params = []
+            if month:
+                query += " AND month = ?"
+                params.append(month)
+            items = self._read_sql(query, params)
+            rates = self.get_financial_rates()
+            known = set(rates) | {'attendance', 'employee_count'}
+
+            updates = []
+            for text, group in items.groupby('calculation_formula'):
+                try:
+                    formula = compile_formula(text)
+                except (SyntaxError, ValueError):
+                    continue
+                # وصف من كلمة واحدة (مثل 'يومي') يترجم كمتغير لكنه ليس معادلة
+                if not formula.names <= known:
+                    continue
+                counts = group['employee_count'].fillna(0)
+                amount = formula.evaluate({
+                    **rates,
+                    'attendance': group['attendance_rate'].fillna(0),
+                    'employee_count': counts
+                })
+                amount = pd.Series(np.broadcast_to(amount, len(group)), index=group.index)
+                updates.extend(zip(amount.astype(float), (amount * counts).astype(float), group['id'].astype(int)))
+
+            rows = [(float(a), float(t), int(i)) for a, t, i in updates]
+            self.db.write(lambda conn: conn.executemany(
+                "UPDATE financial_items SET amount = ?, total_amount = ? WHERE id = ?", rows
+            ))
+            logger.info("✅ تم إعادة حساب %s بنداً مالياً", len(updates))
+            return len(updates)
+        except Exception as e:
+            logger.error("❌ خطأ في إعادة حساب البنود المالية: %s", e)
+            return 0
+
+    def get_financial_summary(self, months=None, directorate=None, item_type=None):
+        """الملخص الشهري المجمع (شهر × مديرية × نوع بند) بما فيه الأشهر المؤرشفة"""
+        query = "SELECT * FROM financial_monthly_summary"
+        conditions, params = [], []
+        if months:
+            months = [months] if isinstance(months, str) else list(months)
+            conditions.append(f"month IN ({', '.join('?' for _ in months)})")
+            params.extend(months)
+        if directorate:
+            conditions.append("directorate = ?")
+            params.append(directorate)
+        if item_type:
+            conditions.append("item_type = ?")
+            params.append(item_type)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return self._read_sql(query + " ORDER BY month, directorate, item_type", params)
+
+    def compare_financial_years(self, year, previous_year=None, directorate=None):
+        """مقارنة سنة بسابقتها لكل شهر ونوع بند من الملخص الشهري
+
+        يقرأ صفوف السنتين فقط من المفتاح الأساسي للملخص، دون البنود ولا ملفات
+        الأرشيف. الأعمدة: الشهر، النوع، current، previous، change، change_pct.
+        """
+        try:
+            year = int(year)
+            previous_year = int(previous_year or year - 1)
+            query = '''
+            SELECT substr(month, 6, 2) AS month, item_type,
+                   SUM(CASE WHEN substr(month, 1, 4) = ? THEN total_amount ELSE 0 END) AS current,
+                   SUM(CASE WHEN substr(month, 1, 4) = ? THEN total_amount ELSE 0 END) AS previous
+            FROM financial_monthly_summary
+            WHERE ((month >= ? AND month < ?) OR (month >= ? AND month < ?))
+            '''
+            params = [str(year), str(previous_year),
+                      f"{year}-", f"{year}-~", f"{previous_year}-", f"{previous_year}-~"]
+            if directorate:
+                query += " AND directorate = ?"
+                params.append(directorate)
+            comparison = self._read_sql(query + " GROUP BY 1, 2 ORDER BY 1, 2", params)
+            comparison['change'] = comparison['current'] - comparison['previous']
+            comparison['change_pct'] = (
+                100 * comparison['change'] / comparison['previous'].where(comparison['previous'] != 0)
+            )
+            return comparison
+        except Exception as e:
+            logger.error("❌ خطأ في مقارنة السنوات المالية: %s", e)
+            return pd.DataFrame()
+
+    def scenario_simulator(self, month=None):
+        """محاكي سيناريوهات محمل ببيانات الشهر، لتقييم عدة دفعات دون إعادة القراءة"""
+        return ScenarioSimulator(self, month)
+
+    def simulate_scenarios(self, scenarios, month=None, by_directorate=False):
+        """تقييم سيناريوهات "ماذا لو" للمسير والجهوزية دفعة واحدة (انظر ScenarioSimulator.run)
+
+        مثال: انخفاض التواجد 10% في ثلاث مديريات مع رفع التغذية إلى 3000:
+        simulate_scenarios([{'attendance_change': -10, 'directorates': [...], 'feeding_rate': 3000}])
+        """
+        try:
+            return self.scenario_simulator(month).run(scenarios, by_directorate=by_directorate)
+        except Exception as e:
+            logger.error("❌ خطأ في محاكاة السيناريوهات: %s", e)
+            return pd.DataFrame()
+
+    def _archive_path(self, year, archive_dir=None):
+        """مسار ملف أرشيف السنة بجوار القاعدة (أو في archive_dir)"""
+        stem = os.path.splitext(os.path.basename(self.db_name))[0]
+        directory = archive_dir or os.path.dirname(os.path.abspath(self.db_name))
+        return os.path.join(directory, f"{stem}_archive_{year}.db")
+
+    def _resolve_archive_path(self, path):
+        """المسار المسجل في financial_archives نسبي لمجلد القاعدة إن أمكن"""
+        return os.path.join(os.path.dirname(os.path.abspath(self.db_name)), path)
+
+    def archive_financial_months(self, before=None, archive_dir=None):
+        """نقل بنود الأشهر المغلقة (قبل before، افتراضياً الشهر الحالي) إلى ملفات أرشيف سنوية
+
+        لكل سنة: تنسخ البنود إلى ملف الأرشيف المرفق (ATTACH) وتثبت هناك أولاً،
+        ثم تسجل الأشهر في financial_archives وتحذف من القاعدة الرئيسية في معاملة
+        ثانية؛ فإن توقفت العملية بينهما تبقى البيانات في الرئيسية وتعاد الأرشفة
+        بأمان. الملخص الشهري لا يتغير، والأشهر المؤرشفة تبقى مقروءة عبر
+        get_financial_items.
+        """
+        before = before or datetime.now().strftime('%Y-%m')
+        report = {'months': [], 'items': 0, 'archives': [], 'elapsed': 0.0}
+        started = time.perf_counter()
+
+        try:
+            if self.db.inline:
+                raise ValueError("الأرشفة تحتاج قاعدة بيانات في ملف")
+            months = [row[0] for row in self._fetchall(
+                "SELECT DISTINCT month FROM financial_items WHERE month < ? AND month GLOB ? ORDER BY month",
+                (before, ARCHIVABLE_MONTH_GLOB)
+            )]
+            years = collections.defaultdict(list)
+            for month in months:
+                years[month[:4]].append(month)
+
+            for year, year_months in years.items():
+                path = self._archive_path(year, archive_dir)
+                # مسار نسبي حتى تبقى القاعدة وأرشيفها صالحين بعد نقلهما معاً
+                registered = os.path.relpath(path, os.path.dirname(os.path.abspath(self.db_name)))
+                placeholders = ', '.join('?' for _ in year_months)
+
+                def archive(conn, path=path, registered=registered, year_months=year_months,
+                            placeholders=placeholders):
+                    conn.execute("ATTACH DATABASE ? AS archive", (path,))
+                    try:
+                        conn.execute(FINANCIAL_ARCHIVE_TABLE.format(schema='archive'))
+                        conn.execute(
+                            "CREATE INDEX IF NOT EXISTS archive.idx_financial_month_directorate "
+                            "ON financial_items (month, directorate)"
+                        )
+                        conn.execute("BEGIN IMMEDIATE")
+                        conn.execute(
+                            f"INSERT OR IGNORE INTO archive.financial_items "
+                            f"SELECT * FROM main.financial_items WHERE month IN ({placeholders})",
+                            year_months
+                        )
+                        conn.execute("COMMIT")
+                        conn.execute("BEGIN IMMEDIATE")
+                        conn.execute(f'''
+                        INSERT INTO main.financial_archives (month, path, item_count)
+                        SELECT month, ?, COUNT(*) FROM archive.financial_items
+                        WHERE month IN ({placeholders}) GROUP BY month
+                        ON CONFLICT(month) DO UPDATE SET
+                            path = excluded.path, item_count = excluded.item_count, archived_at = CURRENT_TIMESTAMP
+                        ''', [registered, *year_months])
+                        moved = conn.execute(
+                            f"DELETE FROM main.financial_items WHERE month IN ({placeholders})", year_months
+                        ).rowcount
+                        conn.execute("COMMIT")
+                        return moved
+                    finally:
+                        if conn.in_transaction:
+                            conn.execute("ROLLBACK")
+                        conn.execute("DETACH DATABASE archive")
+
+                report['items'] += self.db.run_exclusive(archive)
+                report['months'].extend(year_months)
+                report['archives'].append(path)
+        except Exception as e:
+            logger.error("❌ خطأ في أرشفة الأشهر المالية: %s", e)
+            return report
+
+        report['elapsed'] = time.perf_counter() - started
+        logger.info("✅ تم أرشفة %s شهراً (%s بنداً)", len(report['months']), report['items'])
+        return report
+
+    def _financial_items_query(self, months=None, directorate=None):
+        """استعلام البنود المالية من الرئيسية والأرشيف: (الاستعلام, المعاملات, {المخطط: ملف الأرشيف})
+
+        لا تدخل إلا ملفات الأرشيف التي تحتوي الأشهر المطلوبة، وبدون months كامل التاريخ.
+        """
+        if months is not None:
+            months = [months] if isinstance(months, str) else list(months)
+        archived = collections.defaultdict(list)
+        for month, path in self._fetchall("SELECT month, path FROM financial_archives ORDER BY month"):
+            if months is None or month in months:
+                archived[self._resolve_archive_path(path)].append(month)
+
+        def select(schema, schema_months):
+            query = f"SELECT * FROM {schema}.financial_items"
+            conditions, params = [], []
+            if schema_months is not None:
+                conditions.append(f"month IN ({', '.join('?' for _ in schema_months)})")
+                params.extend(schema_months)
+            if directorate:
+                conditions.append("directorate = ?")
+                params.append(directorate)
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            return query, params
+
+        parts = [select('main', months)]
+        schemas = {f"archive_{index}": path for index, path in enumerate(archived)}
+        for schema, schema_months in zip(schemas, archived.values()):
+            parts.append(select(schema, schema_months))
+        query = " UNION ALL ".join(part for part, _ in parts) + " ORDER BY month, directorate, id"
+        params = [param for _, part_params in parts for param in part_params]
+        return query, params, schemas
+
+    @contextlib.contextmanager
+    def _attached_archives(self, conn, schemas):
+        """إرفاق ملفات الأرشيف {المخطط: المسار} بالاتصال طوال الكتلة ثم فصلها"""
+        attached = []
+        try:
+            for schema, path in schemas.items():
+                conn.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+                attached.append(schema)
+            yield conn
+        finally:
+            for schema in attached:
+                conn.execute(f"DETACH DATABASE {schema}")
+
+    def get_financial_items(self, months=None, directorate=None):
+        """البنود المالية من القاعدة الرئيسية وملفات الأرشيف معاً
+
+        ترفق (ATTACH) ملفات الأرشيف التي تحتوي الأشهر المطلوبة فقط، وتجمع
+        النتائج في استعلام واحد. بدون months تقرأ كامل التاريخ.
+        """
+        try:
+            query, params, schemas = self._financial_items_query(months, directorate)
+            with self.db.read() as conn, self._attached_archives(conn, schemas):
+                return pd.read_sql_query(query, conn, params=params)
+        except Exception as e:
+            logger.error("❌ خطأ في جلب البنود المالية: %s", e)
+            return pd.DataFrame()
+
     # ██████████████████████████████████████████████████████████████████████████████
     # ████████████████████████████ العهد والموارد ██████████████████████████████████
     # ██████████████████████████████████████████████████████████████████████████████
@@ -269,178 +2584,874 @@ class ConstructionProgram:
     def add_asset(self, asset_data):
         """إضافة عهدة جديدة"""
         try:
-            cursor = self.conn.cursor()
             query = '''
             INSERT INTO assets (
                 asset_name, asset_type, current_quantity, required_quantity,
                 missing_quantity, calculation_standard, location, status
             ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             '''
-            cursor.execute(query, (
+            # missing_quantity يشتقه المشغل من المطلوب والحالي
+            values = (
                 asset_data['asset_name'],
                 asset_data['asset_type'],
                 asset_data['current_quantity'],
                 asset_data['required_quantity'],
-                asset_data['missing_quantity'],
+                asset_data.get('missing_quantity'),
                 asset_data['calculation_standard'],
                 asset_data['location'],
                 asset_data['status']
-            ))
-            self.conn.commit()
-            print("✅ تم إضافة العهدة بنجاح")
+            )
+
+            def insert(conn):
+                cursor = conn.cursor()
+                cursor.execute(query, values)
+                _index_search_rows(cursor, 'assets', 'id', [cursor.lastrowid])
+
+            self.db.write(insert)
+            logger.info("✅ تم إضافة العهدة بنجاح")
             return True
         except Exception as e:
-            print(f"❌ خطأ في إضافة العهدة: {e}")
+            logger.error("❌ خطأ في إضافة العهدة: %s", e)
             return False
 
-    def calculate_assets_need(self, directorate, asset_type):
+    def calculate_assets_need(self, directorate, asset_type, snapshot=None):
         """احتساب احتياجات العهد"""
         try:
-            employee_count = len(self.get_employees(directorate))
-
-            standards = {
-                'خفيفة': {'per_employee': 0.5, 'base': 10},
-                'متوسطة': {'per_employee': 0.2, 'base': 5},
-                'ثقيلة': {'per_employee': 0.1, 'base': 2},
-                'تواصلية': {'per_employee': 0.3, 'base': 8},
-                'استهلاكية': {'per_employee': 2.0, 'base': 20}
-            }
+            if snapshot is not None:
+                employee_count = len(snapshot.employees(directorate))
+            else:
+                # بدون لقطة نأخذ العدد الجاهز من جدول التجميع
+                employee_count = self.get_employee_totals(directorate)['total']
 
-            standard = standards.get(asset_type, {'per_employee': 0.1, 'base': 5})
+            standard = self.get_asset_standards().get(asset_type, DEFAULT_ASSET_STANDARD)
             required_quantity = int(employee_count * standard['per_employee'] + standard['base'])
 
             return required_quantity
         except Exception as e:
-            print(f"❌ خطأ في احتساب الاحتياجات: {e}")
+            logger.error("❌ خطأ في احتساب الاحتياجات: %s", e)
             return 0
 
     def update_asset_quantity(self, asset_name, new_quantity, location):
-        """تحديث كمية العهدة"""
+        """تحديث كمية العهدة (تسجل كحركة جرد بالفرق في سجل الحركات)"""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "UPDATE assets SET current_quantity = ? WHERE asset_name = ? AND location = ?",
+            self.db.write(lambda conn: conn.execute('''
+                INSERT INTO asset_ledger (asset_id, quantity_change, reason)
+                SELECT id, ? - COALESCE(current_quantity, 0), 'جرد'
+                FROM assets WHERE asset_name = ? AND location = ?
+                ''',
                 (new_quantity, asset_name, location)
-            )
-            self.conn.commit()
-            print(f"✅ تم تحديث كمية {asset_name} إلى {new_quantity}")
+            ))
+            logger.info("✅ تم تحديث كمية %s إلى %s", asset_name, new_quantity)
             return True
         except Exception as e:
-            print(f"❌ خطأ في تحديث الكمية: {e}")
+            logger.error("❌ خطأ في تحديث الكمية: %s", e)
             return False
 
+    def record_asset_movements(self, movements, chunk_size=5000):
+        """تسجيل حركات العهد (صرف، استلام، نقل...) دفعة واحدة في السجل
+
+        كل حركة قاموس فيه asset_id أو (asset_name و location)، و quantity_change
+        (موجب للاستلام وسالب للصرف)، و reason و reference اختياريان. الأرصدة
+        والنواقص في assets تحدثها المشغلات حركة بحركة.
+        """
+        query = '''
+        INSERT INTO asset_ledger (asset_id, quantity_change, reason, reference)
+        VALUES (?, ?, ?, ?)
+        '''
+        report = {'processed': 0, 'recorded': 0, 'errors': [], 'elapsed': 0.0}
+        started = time.perf_counter()
+
+        def record(conn):
+            cursor = conn.cursor()
+            asset_ids = {
+                (name, location): asset_id for asset_id, name, location in
+                cursor.execute("SELECT MIN(id), asset_name, location FROM assets GROUP BY asset_name, location")
+            }
+            # الأرقام الصريحة قد تشير إلى أي صف، لا إلى أول صف لكل (اسم، موقع) فقط
+            known_ids = {asset_id for asset_id, in cursor.execute("SELECT id FROM assets")}
+            chunk = []
+            for row_number, movement in enumerate(movements, start=1):
+                report['processed'] += 1
+                try:
+                    asset_id = movement.get('asset_id') or asset_ids.get(
+                        (movement.get('asset_name'), movement.get('location'))
+                    )
+                    if asset_id not in known_ids:
+                        raise ValueError("عهدة غير موجودة")
+                    quantity_change = int(movement['quantity_change'])
+                except (ValueError, TypeError, KeyError) as e:
+                    report['errors'].append({'row': row_number, 'error': str(e)})
+                    continue
+                chunk.append((asset_id, quantity_change, movement.get('reason'), movement.get('reference')))
+                if len(chunk) >= chunk_size:
+                    cursor.executemany(query, chunk)
+                    report['recorded'] += len(chunk)
+                    chunk = []
+            if chunk:
+                cursor.executemany(query, chunk)
+                report['recorded'] += len(chunk)
+
+        try:
+            self.db.write(record)
+        except Exception as e:
+            report['recorded'] = 0
+            logger.error("❌ خطأ في تسجيل حركات العهد: %s", e)
+            return report
+
+        report['elapsed'] = time.perf_counter() - started
+        logger.info("✅ تم تسجيل %s حركة عهد مع %s خطأ", report['recorded'], len(report['errors']))
+        return report
+
+    def get_asset_ledger(self, asset_name=None, location=None):
+        """سجل حركات العهد مع الرصيد التراكمي بعد كل حركة"""
+        query = '''
+        SELECT l.id, a.asset_name, a.location, l.movement_type, l.quantity_change,
+               SUM(l.quantity_change) OVER (PARTITION BY l.asset_id ORDER BY l.id) AS balance,
+               l.reason, l.reference, l.created_at
+        FROM asset_ledger l JOIN assets a ON a.id = l.asset_id
+        '''
+        conditions, params = [], []
+        if asset_name:
+            conditions.append("a.asset_name = ?")
+            params.append(asset_name)
+        if location:
+            conditions.append("a.location = ?")
+            params.append(location)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return self._read_sql(query + " ORDER BY l.id", params)
+
+    def compute_asset_shortages(self, write=True):
+        """حساب المطلوب والموجود والنقص لكل (موقع × نوع عهدة) في مرور واحد
+
+        عدد الموظفين لكل مديرية يقرأ مرة واحدة من جدول التجميع، والكميات
+        الحالية بتجميع واحد على assets، ثم يحسب المطلوب بمعايير العهد كعمليات
+        أعمدة. عند write=True يستبدل محتوى جدول asset_shortages بالنتيجة.
+        """
+        try:
+            headcount = self._read_sql('''
+            SELECT directorate AS location, SUM(employee_count) AS employee_count
+            FROM employee_rollups WHERE directorate != '' GROUP BY directorate
+            ''')
+            current = self._read_sql('''
+            SELECT location, asset_type, SUM(COALESCE(current_quantity, 0)) AS current_quantity
+            FROM assets WHERE location IS NOT NULL AND asset_type IS NOT NULL
+            GROUP BY location, asset_type
+            ''')
+            standards = self.get_asset_standards()
+
+            # dtype=object حتى لا تصبح القوائم الفارغة float64 فيفشل الدمج على قاعدة فارغة
+            locations = pd.DataFrame(
+                {'location': sorted(set(headcount['location']) | set(current['location']))}, dtype=object)
+            types = pd.DataFrame(
+                {'asset_type': sorted(set(standards) | set(current['asset_type']))}, dtype=object)
+            shortages = (
+                locations.merge(types, how='cross')
+                .merge(headcount, on='location', how='left')
+                .merge(current, on=['location', 'asset_type'], how='left')
+                .fillna({'employee_count': 0, 'current_quantity': 0})
+            )
+            per_employee = shortages['asset_type'].map(
+                lambda asset_type: standards.get(asset_type, DEFAULT_ASSET_STANDARD)['per_employee'])
+            base = shortages['asset_type'].map(
+                lambda asset_type: standards.get(asset_type, DEFAULT_ASSET_STANDARD)['base'])
+            shortages['employee_count'] = shortages['employee_count'].astype(int)
+            shortages['current_quantity'] = shortages['current_quantity'].astype(int)
+            shortages['required_quantity'] = (shortages['employee_count'] * per_employee + base).astype(int)
+            shortages['missing_quantity'] = (
+                shortages['required_quantity'] - shortages['current_quantity']).clip(lower=0)
+            shortages = shortages[['location', 'asset_type', 'employee_count',
+                                   'required_quantity', 'current_quantity', 'missing_quantity']]
+
+            if write:
+                rows = [tuple(row) for row in shortages.itertuples(index=False)]
+
+                def write_shortages(conn):
+                    conn.execute("DELETE FROM asset_shortages")
+                    conn.executemany('''
+                    INSERT INTO asset_shortages (
+                        location, asset_type, employee_count, required_quantity, current_quantity, missing_quantity
+                    ) VALUES (?, ?, ?, ?, ?, ?)
+                    ''', [(location, asset_type, int(count), int(required), int(current), int(missing))
+                          for location, asset_type, count, required, current, missing in rows])
+
+                self.db.write(write_shortages)
+                logger.info("✅ تم حساب نواقص %s (موقع × نوع عهدة)", len(rows))
+            return shortages
+        except Exception as e:
+            logger.error("❌ خطأ في حساب نواقص العهد: %s", e)
+            return pd.DataFrame()
+
+    def get_asset_shortages(self, location=None, only_missing=True):
+        """آخر نواقص محسوبة من asset_shortages مرتبة من الأكبر نقصاً"""
+        query = "SELECT * FROM asset_shortages"
+        conditions, params = [], []
+        if location:
+            conditions.append("location = ?")
+            params.append(location)
+        if only_missing:
+            conditions.append("missing_quantity > 0")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return self._read_sql(query + " ORDER BY missing_quantity DESC, location, asset_type", params)
+
     # ██████████████████████████████████████████████████████████████████████████████
     # ████████████████████████████ التحليل والمباينة ████████████████████████████████
     # ██████████████████████████████████████████████████████████████████████████████
 
-    def analyze_discrepancies(self, directorate, month):
-        """كشف التناقضات بين الجوانب"""
-        try:
-            employees = self.get_employees(directorate)
-
-            discrepancies = []
-            for _, employee in employees.iterrows():
-                attendance = employee['attendance_rate']
-
-                if attendance < 60:
-                    discrepancy = {
-                        'employee_name': employee['full_name'],
-                        'global_id': employee['global_id'],
-                        'issue': f'تواجد {attendance}% منخفض مع احتمال صرف كامل',
-                        'level': 'high',
-                        'recommendation': 'مراجعة نظام الصرف'
-                    }
-                    discrepancies.append(discrepancy)
-
-                if not employee['training_courses']:
-                    discrepancy = {
-                        'employee_name': employee['full_name'],
-                        'global_id': employee['global_id'],
-                        'issue': 'موظف بدون دورات تدريبية أساسية',
-                        'level': 'medium',
-                        'recommendation': 'توفير تدريبات أساسية'
-                    }
-                    discrepancies.append(discrepancy)
-
-            return discrepancies
-        except Exception as e:
-            print(f"❌ خطأ في التحليل: {e}")
-            return []
-
-    def analyze_readiness(self, directorate):
+    def add_discrepancy_rule(self, rule):
+        """إضافة قاعدة جديدة لكشف التناقضات"""
+        missing = [key for key in ('name', 'mask', 'issue', 'level', 'recommendation') if key not in rule]
+        if missing:
+            raise ValueError(f"قاعدة ناقصة: {', '.join(missing)}")
+        self.discrepancy_rules.append(rule)
+
+    def _build_discrepancies(self, employees, rules):
+        """تطبيق القواعد كأقنعة منطقية على إطار الموظفين دون المرور صفاً صفاً"""
+        frames = []
+        for order, rule in enumerate(rules):
+            matched = employees.loc[rule['mask'](employees).fillna(False).astype(bool)]
+            if matched.empty:
+                continue
+            issue = rule['issue'](matched) if callable(rule['issue']) else rule['issue']
+            frames.append(pd.DataFrame({
+                'employee_name': matched['full_name'],
+                'global_id': matched['global_id'],
+                'issue': issue,
+                'level': rule['level'],
+                'recommendation': rule['recommendation'],
+                '_rule': order
+            }))
+
+        if not frames:
+            return pd.DataFrame(columns=DISCREPANCY_COLUMNS)
+
+        # نفس ترتيب النسخة السابقة: حسب الموظف ثم حسب ترتيب القاعدة
+        result = pd.concat(frames)
+        result['_row'] = result.index
+        result = result.sort_values(['_row', '_rule'], kind='stable')
+        return result[DISCREPANCY_COLUMNS].reset_index(drop=True)
+
+    def analyze_discrepancies(self, directorate, month, as_frame=False, snapshot=None):
+        """كشف التناقضات بين الجوانب
+
+        يعيد قائمة قواميس افتراضياً، أو DataFrame عند as_frame=True.
+        """
+        try:
+            employees = self._snapshot_employees(directorate, snapshot)
+            result = self._build_discrepancies(employees, self.discrepancy_rules)
+            return result if as_frame else result.to_dict('records')
+        except Exception as e:
+            logger.error("❌ خطأ في التحليل: %s", e)
+            return pd.DataFrame(columns=DISCREPANCY_COLUMNS) if as_frame else []
+
+    def iter_discrepancies(self, directorate=None, chunksize=10000):
+        """كشف التناقضات داخل قاعدة البيانات وإرجاعها على دفعات (DataFrame لكل دفعة)
+
+        القواعد التي تملك شرط sql تنفذ كـ WHERE فلا يقرأ إلا الموظفون المخالفون،
+        والنتائج مرتبة حسب القاعدة ثم حسب الموظف.
+        """
+        for rule in self.discrepancy_rules:
+            conditions = []
+            params = []
+            if directorate:
+                conditions.append("directorate = ?")
+                params.append(directorate)
+            if rule.get('sql'):
+                conditions.append(f"({rule['sql']})")
+
+            query = "SELECT * FROM employee_records"
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            query += " ORDER BY created_at DESC"
+
+            # اتصال خاص لأن المكرر قد يستأنف من خيط آخر
+            with self.db.dedicated_reader() as conn:
+                for chunk in pd.read_sql_query(query, conn, params=params, chunksize=chunksize):
+                    result = self._build_discrepancies(chunk, [rule])
+                    if not result.empty:
+                        yield result
+
+    def update_discrepancy_records(self, full=False, chunksize=10000):
+        """تحديث التناقضات المحفوظة في analysis_records تدريجياً
+
+        لكل قاعدة رقم تسلسلي لآخر تعديل فحصته (analysis_state)، فلا يقرأ إلا
+        الموظفون الذين أضيفوا أو عدلوا بعده. النتائج تحفظ (upsert) سجلاً لكل
+        (موظف، قاعدة)، ومن فحص ولم يعد مخالفاً يحذف سجله. القاعدة الجديدة تبدأ
+        من الصفر فتفحص الجميع مرة واحدة. full=True يعيد الفحص الكامل ويحذف
+        سجلات القواعد التي لم تعد موجودة.
+        """
+        report = {'checked': 0, 'found': 0, 'resolved': 0, 'elapsed': 0.0}
+        started = time.perf_counter()
+        types = {DISCREPANCY_ANALYSIS_PREFIX + rule['name']: rule for rule in self.discrepancy_rules}
+
+        def save_chunk(conn, checked, matches, last_seq):
+            cursor = conn.cursor()
+            for analysis_type, found in matches.items():
+                cursor.executemany('''
+                INSERT INTO analysis_records (
+                    analysis_type, employee_id, human_data, discrepancy_level, recommendations
+                ) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(employee_id, analysis_type) DO UPDATE SET
+                    human_data = excluded.human_data,
+                    discrepancy_level = excluded.discrepancy_level,
+                    recommendations = excluded.recommendations,
+                    created_at = CURRENT_TIMESTAMP
+                ''', [
+                    (analysis_type, int(row.employee_id), json.dumps({
+                        'employee_name': row.employee_name, 'global_id': row.global_id, 'issue': row.issue
+                    }, ensure_ascii=False), row.level, row.recommendation)
+                    for row in found.itertuples(index=False)
+                ])
+                # من فحص بهذه القاعدة ولم يعد مخالفاً
+                resolved = set(checked[analysis_type]) - set(found['employee_id'].tolist())
+                if resolved:
+                    cursor.executemany(
+                        "DELETE FROM analysis_records WHERE analysis_type = ? AND employee_id = ?",
+                        [(analysis_type, employee_id) for employee_id in resolved]
+                    )
+                    report['resolved'] += max(cursor.rowcount, 0)
+            cursor.executemany('''
+            INSERT INTO analysis_state (analysis_type, last_seq) VALUES (?, ?)
+            ON CONFLICT(analysis_type) DO UPDATE SET last_seq = MAX(last_seq, excluded.last_seq)
+            ''', [(analysis_type, last_seq) for analysis_type in matches])
+
+        try:
+            if full:
+                def reset_state(conn):
+                    conn.execute(
+                        "DELETE FROM analysis_state WHERE analysis_type LIKE ?",
+                        (DISCREPANCY_ANALYSIS_PREFIX + '%',)
+                    )
+                    conn.execute(
+                        f"DELETE FROM analysis_records WHERE analysis_type LIKE ? "
+                        f"AND analysis_type NOT IN ({', '.join('?' for _ in types)})",
+                        (DISCREPANCY_ANALYSIS_PREFIX + '%', *types)
+                    )
+                self.db.write(reset_state)
+
+            watermarks = dict(self._fetchall(
+                "SELECT analysis_type, last_seq FROM analysis_state WHERE analysis_type LIKE ?",
+                (DISCREPANCY_ANALYSIS_PREFIX + '%',)
+            ))
+            watermarks = {analysis_type: watermarks.get(analysis_type, 0) for analysis_type in types}
+            if not watermarks:
+                return report
+            since = min(watermarks.values())
+
+            # اتصال خاص لأن الكتابة بين الدفعات تمر عبر خيط الكاتب
+            with self.db.dedicated_reader() as conn:
+                chunks = pd.read_sql_query(
+                    "SELECT * FROM employee_records WHERE change_seq > ? ORDER BY change_seq",
+                    conn, params=[since], chunksize=chunksize
+                )
+                for chunk in chunks:
+                    if chunk.empty:
+                        continue
+                    checked, matches = {}, {}
+                    for analysis_type, rule in types.items():
+                        # كل قاعدة تفحص فقط ما تغير بعد آخر فحص لها
+                        rows = chunk.loc[chunk['change_seq'] > watermarks[analysis_type]]
+                        found = self._build_discrepancies(rows, [rule])
+                        found['employee_id'] = found['global_id'].map(dict(zip(rows['global_id'], rows['id'])))
+                        checked[analysis_type] = rows['id'].tolist()
+                        matches[analysis_type] = found
+                        report['checked'] += len(rows)
+                        report['found'] += len(found)
+                    last_seq = int(chunk['change_seq'].max())
+                    self.db.write(lambda conn: save_chunk(conn, checked, matches, last_seq))
+        except Exception as e:
+            logger.error("❌ خطأ في تحديث سجلات التناقضات: %s", e)
+            return report
+
+        report['elapsed'] = time.perf_counter() - started
+        logger.info("✅ تم فحص %s (موظف × قاعدة) وحفظ %s تناقضاً", report['checked'], report['found'])
+        return report
+
+    def get_discrepancy_records(self, directorate=None):
+        """التناقضات المحفوظة في analysis_records (بعد update_discrepancy_records)"""
+        query = '''
+        SELECT e.full_name AS employee_name, e.global_id, e.directorate,
+               substr(r.analysis_type, ?) AS rule, json_extract(r.human_data, '$.issue') AS issue,
+               r.discrepancy_level AS level, r.recommendations AS recommendation, r.created_at
+        FROM analysis_records r JOIN employees e ON e.id = r.employee_id
+        WHERE r.analysis_type LIKE ?
+        '''
+        params = [len(DISCREPANCY_ANALYSIS_PREFIX) + 1, DISCREPANCY_ANALYSIS_PREFIX + '%']
+        if directorate:
+            query += " AND e.directorate = ?"
+            params.append(directorate)
+        query += " ORDER BY e.id, r.analysis_type"
+        return self._read_sql(query, params)
+
+    def analyze_readiness(self, directorate, snapshot=None):
         """تحليل الجهوزية"""
         try:
-            employees = self.get_employees(directorate)
-            total_employees = len(employees)
-            active_employees = len(employees[employees['status'] == 'active'])
-
-            readiness_report = {
-                'العمال': {
-                    'required': total_employees,
-                    'ready': active_employees,
-                    'percentage': (active_employees / total_employees * 100) if total_employees > 0 else 0
-                },
-                'التجهيزات': {
-                    'required': total_employees * 2,
-                    'ready': total_employees * 1,
-                    'percentage': 50
-                }
-            }
+            if snapshot is not None:
+                employees = snapshot.employees(directorate)
+                total_employees = len(employees)
+                active_employees = len(employees[employees['status'] == 'active'])
+            else:
+                # بدون لقطة نقرأ الأعداد الجاهزة من جدول التجميع
+                totals = self.get_employee_totals(directorate)
+                total_employees = totals['total']
+                active_employees = totals['active']
 
-            return readiness_report
+            return self._readiness_report(total_employees, active_employees)
         except Exception as e:
-            print(f"❌ خطأ في تحليل الجهوزية: {e}")
+            logger.error("❌ خطأ في تحليل الجهوزية: %s", e)
             return {}
 
-    def comprehensive_analysis(self, directorate):
+    def _readiness_report(self, total_employees, active_employees):
+        """تقرير الجهوزية من عدد الموظفين والنشطين منهم"""
+        readiness_report = {
+            'العمال': {
+                'required': total_employees,
+                'ready': active_employees,
+                'percentage': (active_employees / total_employees * 100) if total_employees > 0 else 0
+            },
+            'التجهيزات': {
+                'required': total_employees * 2,
+                'ready': total_employees * 1,
+                'percentage': 50
+            }
+        }
+
+        return readiness_report
+
+    def comprehensive_analysis(self, directorate, month=None):
         """تحليل شامل"""
         try:
+            # لقطة واحدة: قراءة واحدة لموظفي المديرية لكل أجزاء التقرير
+            snapshot = self.snapshot()
+            employees = snapshot.employees(directorate)
+            month = month or snapshot.taken_at.strftime('%Y-%m')
+
             analysis = {
-                'الموظفين': len(self.get_employees(directorate)),
-                'متوسط_التواجد': self.get_employees(directorate)['attendance_rate'].mean(),
-                'التناقضات': self.analyze_discrepancies(directorate, datetime.now().strftime('%Y-%m')),
-                'الجهوزية': self.analyze_readiness(directorate),
-                'الحسابات_المالية': self.calculate_all_financials(directorate, datetime.now().strftime('%Y-%m'))
+                'الموظفين': len(employees),
+                'متوسط_التواجد': employees['attendance_rate'].mean(),
+                'التناقضات': self.analyze_discrepancies(directorate, month, snapshot=snapshot),
+                'الجهوزية': self.analyze_readiness(directorate, snapshot=snapshot),
+                'الحسابات_المالية': self.calculate_all_financials(directorate, month, snapshot=snapshot)
             }
 
             return analysis
         except Exception as e:
-            print(f"❌ خطأ في التحليل الشامل: {e}")
+            logger.error("❌ خطأ في التحليل الشامل: %s", e)
+            return {}
+
+    def analyze_all_directorates(self, workers=None, month=None, directorates=None):
+        """التحليل الشامل لجميع المديريات موزعاً على مجمع عمليات
+
+        كل عملية تفتح البرنامج للقراءة فقط باتصالاتها الخاصة، وتحلل المديريات
+        واحدة تلو الأخرى (الأكبر أولاً حتى تتوازن الأحمال). ثم تدمج النتائج في
+        تقرير واحد: تحليل كل مديرية، والتناقضات مجمعة، والإجماليات.
+        workers=1 أو قاعدة ':memory:' يعني التنفيذ في العملية الحالية، وكذلك
+        القواعد المخصصة التي لا تقبل التسلسل (pickle) مثل دوال lambda.
+        """
+        month = month or datetime.now().strftime('%Y-%m')
+        try:
+            if directorates is None:
+                rows = self._fetchall('''
+                SELECT directorate, SUM(employee_count) AS employee_count FROM employee_rollups
+                WHERE employee_count > 0
+                GROUP BY directorate ORDER BY employee_count DESC, directorate
+                ''')
+                directorates = [directorate for directorate, _ in rows if directorate]
+            directorates = list(directorates)
+            workers = workers or os.cpu_count() or 1
+
+            parallel = workers > 1 and len(directorates) > 1 and not self.db.inline
+            if parallel:
+                # القواعد المدمجة ترسل بأسمائها لأن دوالها لا تقبل التسلسل (pickle)
+                builtin = {id(rule): rule['name'] for rule in DISCREPANCY_RULES}
+                rules = [builtin.get(id(rule), rule) for rule in self.discrepancy_rules]
+                try:
+                    pickle.dumps(rules)
+                except Exception as e:
+                    # عمليات spawn لا تستطيع استقبال هذه القواعد
+                    logger.warning("⚠️ قواعد تحليل لا تقبل التسلسل، التحليل في العملية الحالية: %s", e)
+                    parallel = False
+
+            if not parallel:
+                results = [(directorate, self.comprehensive_analysis(directorate, month))
+                           for directorate in directorates]
+            else:
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(
+                    max_workers=min(workers, len(directorates)),
+                    initializer=_init_analysis_worker,
+                    initargs=(self.db_name, rules, self.busy_timeout)
+                ) as executor:
+                    results = list(executor.map(
+                        _analyze_directorate_worker, directorates, [month] * len(directorates)
+                    ))
+
+            return self._merge_analyses(results, month)
+        except Exception as e:
+            logger.error("❌ خطأ في تحليل المديريات: %s", e)
+            return {}
+
+    def _merge_analyses(self, results, month):
+        """دمج تحاليل المديريات في تقرير واحد مع الإجماليات"""
+        report = {'الشهر': month, 'المديريات': {}, 'التناقضات': [], 'الإجمالي': {}}
+        total_employees = 0
+        attendance_sum = 0.0
+        readiness = {}
+        financials = {}
+
+        for directorate, analysis in results:
+            report['المديريات'][directorate] = analysis
+            if not analysis:
+                continue
+            employee_count = analysis['الموظفين']
+            total_employees += employee_count
+            if employee_count:
+                attendance_sum += analysis['متوسط_التواجد'] * employee_count
+            report['التناقضات'].extend(
+                dict(discrepancy, directorate=directorate) for discrepancy in analysis['التناقضات']
+            )
+            for name, values in analysis['الجهوزية'].items():
+                merged = readiness.setdefault(name, {'required': 0, 'ready': 0})
+                merged['required'] += values['required']
+                merged['ready'] += values['ready']
+            for name, value in analysis['الحسابات_المالية'].items():
+                if isinstance(value, tuple):
+                    previous = financials.get(name, (0.0,) * len(value))
+                    financials[name] = tuple(a + b for a, b in zip(previous, value))
+                else:
+                    financials[name] = financials.get(name, 0.0) + value
+
+        for values in readiness.values():
+            values['percentage'] = (values['ready'] / values['required'] * 100) if values['required'] > 0 else 0
+
+        report['الإجمالي'] = {
+            'الموظفين': total_employees,
+            'متوسط_التواجد': attendance_sum / total_employees if total_employees else 0,
+            'عدد_التناقضات': len(report['التناقضات']),
+            'الجهوزية': readiness,
+            'الحسابات_المالية': financials,
+        }
+        return report
+
+    # ██████████████████████████████████████████████████████████████████████████████
+    # ████████████████████████████ الهيكل التنظيمي ██████████████████████████████████
+    # ██████████████████████████████████████████████████████████████████████████████
+
+    def find_org_unit(self, *names):
+        """رقم الوحدة من أسماء مسارها بدءاً من الشركة، مثل (الشركة، المديرية، الشعبة)"""
+        row = self._fetchone("SELECT id FROM org_units WHERE path = ?", (ORG_PATH_SEPARATOR.join(names),))
+        return row[0] if row else None
+
+    def get_org_units(self, level=None, parent_id=None):
+        """وحدات الهيكل التنظيمي (كلها أو مستوى معين أو أبناء وحدة)"""
+        query = "SELECT id, parent_id, level, name, replace(path, char(31), ' / ') AS path FROM org_units"
+        conditions, params = [], []
+        if level:
+            conditions.append("level = ?")
+            params.append(level)
+        if parent_id is not None:
+            conditions.append("parent_id = ?")
+            params.append(parent_id)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return self._read_sql(query + " ORDER BY path", params)
+
+    def get_org_totals(self, level):
+        """إجماليات كل وحدات المستوى level لكامل شجرة كل منها (العدد والنشطون والتواجد)
+
+        مثلاً get_org_totals('branch') يعطي عدد موظفي كل فرع بكل أقسامه عبر
+        جدول الإغلاق والفهارس، دون مقارنة نصوص.
+        """
+        return self._read_sql('''
+        SELECT u.id, u.name, replace(u.path, char(31), ' / ') AS path,
+               COUNT(e.id) AS employee_count,
+               COALESCE(SUM(e.status = 'active'), 0) AS active_count,
+               COALESCE(AVG(e.attendance_rate), 0) AS avg_attendance
+        FROM org_units u
+        JOIN org_closure c ON c.ancestor_id = u.id
+        LEFT JOIN employees e ON e.org_unit_id = c.descendant_id
+        WHERE u.level = ?
+        GROUP BY u.id
+        ORDER BY u.path
+        ''', [level])
+
+    def analyze_org_unit(self, unit_id, month=None):
+        """تحليل وحدة بكامل شجرتها: الموظفون والتواجد والجهوزية والحسابات المالية"""
+        try:
+            month = month or datetime.now().strftime('%Y-%m')
+            unit = self._fetchone(
+                "SELECT level, replace(path, char(31), ' / ') FROM org_units WHERE id = ?", (unit_id,)
+            )
+            if unit is None:
+                raise ValueError(f"وحدة غير موجودة: {unit_id}")
+
+            employees = self._read_sql('''
+            SELECT e.global_id, e.status, e.attendance_rate, 100.0 * m.days_present / m.days_recorded AS month_rate
+            FROM org_closure c
+            JOIN employees e ON e.org_unit_id = c.descendant_id
+            LEFT JOIN attendance_monthly m
+                ON m.global_id = e.global_id AND m.month = ? AND m.days_recorded > 0
+            WHERE c.ancestor_id = ?
+            ''', [month, unit_id])
+            # التواجد الفعلي للشهر، ومن لا سجل له يؤخذ تواجده الحالي
+            attendance = employees['month_rate'].fillna(employees['attendance_rate']).fillna(0)
+            employee_count = len(employees)
+
+            return {
+                'الوحدة': unit[1],
+                'المستوى': unit[0],
+                'الموظفين': employee_count,
+                'متوسط_التواجد': float(attendance.mean()) if employee_count else 0,
+                'الجهوزية': self._readiness_report(employee_count, int((employees['status'] == 'active').sum())),
+                'الحسابات_المالية': self._financial_report(attendance)
+            }
+        except Exception as e:
+            logger.error("❌ خطأ في تحليل الوحدة التنظيمية: %s", e)
             return {}
 
+    # ██████████████████████████████████████████████████████████████████████████████
+    # ████████████████████████████ البحث ████████████████████████████████████████████
+    # ██████████████████████████████████████████████████████████████████████████████
+
+    def _search(self, table, columns, text, conditions, params, limit, offset, source=None):
+        """بحث مرتب بالصلة في فهرس الجدول مع شروط إضافية على صفوفه وترقيم صفحات
+
+        source جدول أو عرض تقرأ منه الأعمدة بدل الجدول نفسه (بنفس أرقام id).
+        """
+        fts_table, indexed = SEARCH_INDEXES[table]
+        match = _search_match_query(text)
+        if not match:
+            return pd.DataFrame(columns=[*columns, 'rank'])
+        weights = ', '.join(str(weight) for _, _, weight in indexed)
+        query = f'''
+        SELECT {', '.join(f't.{column}' for column in columns)}, bm25({fts_table}, {weights}) AS rank
+        FROM {fts_table} JOIN {source or table} t ON t.id = {fts_table}.rowid
+        WHERE {fts_table} MATCH ?
+        '''
+        for condition in conditions:
+            query += f" AND t.{condition}"
+        return self._read_sql(query + " ORDER BY rank LIMIT ? OFFSET ?", [match, *params, limit, offset])
+
+    def search_employees(self, text, directorate=None, limit=20, offset=0):
+        """البحث عن موظفين بجزء من الاسم أو الوظيفة أو المؤهل أو التجهيزات
+
+        لا يتأثر البحث بالهمزات والتاء المربوطة والألف المقصورة والتشكيل،
+        وكل كلمة تطابق بدايات الكلمات. النتائج مرتبة بالأقرب (rank الأصغر).
+        """
+        try:
+            conditions, params = [], []
+            if directorate:
+                conditions.append("directorate = ?")
+                params.append(directorate)
+            return self._search('employees', (
+                'id', 'global_id', 'functional_id', 'full_name', 'position',
+                'qualification', 'directorate', 'section', 'status'
+            ), text, conditions, params, limit, offset, source='employee_records')
+        except Exception as e:
+            logger.error("❌ خطأ في البحث عن الموظفين: %s", e)
+            return pd.DataFrame()
+
+    def search_assets(self, text, location=None, limit=20, offset=0):
+        """البحث في العهد بالاسم أو النوع أو الموقع أو معيار الاحتساب"""
+        try:
+            conditions, params = [], []
+            if location:
+                conditions.append("location = ?")
+                params.append(location)
+            return self._search('assets', (
+                'id', 'asset_name', 'asset_type', 'location',
+                'current_quantity', 'required_quantity', 'missing_quantity', 'status'
+            ), text, conditions, params, limit, offset)
+        except Exception as e:
+            logger.error("❌ خطأ في البحث في العهد: %s", e)
+            return pd.DataFrame()
+
+    def rebuild_search_index(self):
+        """إعادة بناء فهارس البحث بالكامل
+
+        بعد تعديل جدول التوحيد، أو بعد إضافة صفوف أو تعديل نصوصها بجمل SQL
+        مباشرة دون دوال البرنامج (الفهرس يكتب من دوال الإضافة لا من مشغلات).
+        """
+        def rebuild(conn):
+            cursor = conn.cursor()
+            for table, (fts_table, _) in SEARCH_INDEXES.items():
+                cursor.execute(f"DELETE FROM {fts_table}")
+                _index_search_rows(cursor, table)
+                cursor.execute(f"INSERT INTO {fts_table} ({fts_table}) VALUES ('optimize')")
+
+        try:
+            self.db.write(rebuild)
+            logger.info("✅ تم إعادة بناء فهارس البحث")
+            return True
+        except Exception as e:
+            logger.error("❌ خطأ في إعادة بناء فهارس البحث: %s", e)
+            return False
+
     # ██████████████████████████████████████████████████████████████████████████████
     # ████████████████████████████ الواجهة والتقارير ████████████████████████████████
     # ██████████████████████████████████████████████████████████████████████████████
 
-    def generate_report(self, report_type, directorate=None):
-        """إنشاء التقارير"""
+    def _report_query(self, report_type, directorate=None, months=None):
+        """استعلام التقرير ومعاملاته حسب نوعه (بشري / ملخص مالي / عهد)"""
+        table, column = REPORT_TABLES[report_type]
+        query = f"SELECT * FROM {table}"
+        conditions, params = [], []
+        if directorate:
+            conditions.append(f"{column} = ?")
+            params.append(directorate)
+        if months and table == 'financial_monthly_summary':
+            months = [months] if isinstance(months, str) else list(months)
+            conditions.append(f"month IN ({', '.join('?' for _ in months)})")
+            params.extend(months)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        if table == 'employee_records':
+            query += " ORDER BY created_at DESC"
+        elif table == 'financial_monthly_summary':
+            query += " ORDER BY month, directorate, item_type"
+        return query, params
+
+    def generate_report(self, report_type, directorate=None, months=None, detailed=False):
+        """إنشاء التقارير
+
+        التقرير المالي يقرأ من الملخص الشهري (financial_monthly_summary) للأشهر
+        months (شهر أو قائمة أشهر، وبدونها كل الأشهر)، بما فيها المؤرشفة. بنوده
+        واحداً واحداً مع detailed=True، وعندها ترفق ملفات الأرشيف للأشهر المطلوبة
+        فقط، أو كلها إذا لم تحدد months (مسح كامل التاريخ).
+        """
         try:
+            if report_type == 'مالي' and not detailed:
+                report_type = 'ملخص مالي'
             if report_type == 'بشري':
                 return self.get_employees(directorate)
             elif report_type == 'مالي':
-                query = "SELECT * FROM financial_items"
-                if directorate:
-                    query += " WHERE directorate = ?"
-                return pd.read_sql_query(query, self.conn, params=[directorate])
-                return pd.read_sql_query(query, self.conn)
-            elif report_type == 'عهد':
-                query = "SELECT * FROM assets"
-                if directorate:
-                    query += " WHERE location = ?"
-                return pd.read_sql_query(query, self.conn, params=[directorate])
-                return pd.read_sql_query(query, self.conn)
+                return self.get_financial_items(months, directorate)
+            elif report_type in ('ملخص مالي', 'عهد'):
+                return self._read_sql(*self._report_query(report_type, directorate, months))
             elif report_type == 'تحليل':
                 return self.analyze_discrepancies(directorate, datetime.now().strftime('%Y-%m'))
         except Exception as e:
-            print(f"❌ خطأ في إنشاء التقرير: {e}")
+            logger.error("❌ خطأ في إنشاء التقرير: %s", e)
             return pd.DataFrame()
 
+    def iter_report(self, report_type, directorate=None, chunksize=10000, months=None, detailed=False):
+        """التقرير نفسه على دفعات (DataFrame لكل دفعة) دون تحميله كاملاً في الذاكرة
+
+        months و detailed للتقرير المالي كما في generate_report.
+        """
+        if report_type == 'تحليل':
+            yield from self.iter_discrepancies(directorate, chunksize=chunksize)
+            return
+        if report_type == 'مالي' and not detailed:
+            report_type = 'ملخص مالي'
+        schemas = {}
+        if report_type == 'مالي':
+            query, params, schemas = self._financial_items_query(months, directorate)
+        else:
+            query, params = self._report_query(report_type, directorate, months)
+        # اتصال خاص لأن المكرر قد يستأنف من خيط آخر
+        with self.db.dedicated_reader() as conn, self._attached_archives(conn, schemas):
+            yield from pd.read_sql_query(query, conn, params=params, chunksize=chunksize)
+
+    def export_report(self, report_type, directorate=None, fmt=None, dest=None,
+                      chunksize=10000, progress=None, months=None, detailed=False):
+        """تصدير التقرير تدفقياً إلى CSV أو JSONL أو Parquet
+
+        يقرأ التقرير على دفعات (iter_report) ويكتب كل دفعة فور وصولها، فلا
+        تتجاوز الذاكرة حجم دفعة واحدة مهما كبر الجدول. الصيغة تستنتج من امتداد
+        dest إن لم تحدد. يكتب الملف باسم مؤقت ثم يستبدل عند النجاح فلا يبقى
+        ملف ناقص. progress(rows_written) يستدعى بعد كل دفعة. months و detailed
+        للتقرير المالي كما في generate_report.
+        """
+        if report_type == 'مالي' and not detailed:
+            report_type = 'ملخص مالي'
+        fmt = (fmt or os.path.splitext(str(dest))[1].lstrip('.')).lower()
+        report = {'rows': 0, 'chunks': 0, 'dest': dest, 'elapsed': 0.0}
+        started = time.perf_counter()
+        temp_path = f"{dest}.tmp"
+
+        try:
+            if fmt not in ('csv', 'jsonl', 'parquet'):
+                raise ValueError(f"صيغة تصدير غير مدعومة: {fmt}")
+
+            if fmt == 'parquet':
+                # pyarrow اختياري ولا يلزم إلا لتصدير Parquet
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                writer = None
+                try:
+                    for chunk in self.iter_report(report_type, directorate, chunksize=chunksize, months=months,
+                                                 detailed=detailed):
+                        if writer is None:
+                            table = pa.Table.from_pandas(chunk, preserve_index=False)
+                            table = table.cast(self._parquet_schema(report_type, table.schema))
+                            writer = pq.ParquetWriter(temp_path, table.schema)
+                        else:
+                            table = pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False)
+                        writer.write_table(table)
+                        report['rows'] += len(chunk)
+                        report['chunks'] += 1
+                        if progress:
+                            progress(report['rows'])
+                finally:
+                    if writer is not None:
+                        writer.close()
+            else:
+                # utf-8-sig حتى يفتح Excel النصوص العربية في CSV بشكل صحيح
+                encoding = 'utf-8-sig' if fmt == 'csv' else 'utf-8'
+                with open(temp_path, 'w', newline='', encoding=encoding) as f:
+                    for chunk in self.iter_report(report_type, directorate, chunksize=chunksize, months=months,
+                                                 detailed=detailed):
+                        if fmt == 'csv':
+                            chunk.to_csv(f, header=report['chunks'] == 0, index=False)
+                        else:
+                            chunk.to_json(f, orient='records', lines=True, force_ascii=False, date_format='iso')
+                        report['rows'] += len(chunk)
+                        report['chunks'] += 1
+                        if progress:
+                            progress(report['rows'])
+
+            if os.path.exists(temp_path):
+                os.replace(temp_path, dest)
+        except Exception as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            logger.error("❌ خطأ في تصدير التقرير: %s", e)
+            return report
+
+        report['elapsed'] = time.perf_counter() - started
+        logger.info("✅ تم تصدير %s صف إلى %s", report['rows'], dest)
+        return report
+
+    def _parquet_schema(self, report_type, schema):
+        """مخطط ملف Parquet من أول دفعة مع ترقية الأعمدة الفارغة كلها فيها
+
+        العمود الذي كل قيمه NULL في الدفعة الأولى يستنتج نوعه null فتفشل
+        الدفعات التالية، لذا يأخذ نوعه المعلن في الجدول (نص إن لم يعرف).
+        """
+        import pyarrow as pa
+        declared = {}
+        if report_type in REPORT_TABLES:
+            table = REPORT_TABLES[report_type][0]
+            declared = {name: column_type.upper() for _, name, column_type, *_ in
+                        self._fetchall(f"PRAGMA table_info({table})")}
+        arrow_types = {'INTEGER': pa.int64(), 'REAL': pa.float64()}
+        return pa.schema([
+            field.with_type(arrow_types.get(declared.get(field.name), pa.large_string()))
+            if pa.types.is_null(field.type) else field
+            for field in schema
+        ], metadata=schema.metadata)
+
     def show_dashboard(self):
         """عرض لوحة التحكم"""
         try:
-            employees_count = len(self.get_employees())
-            assets_count = len(pd.read_sql_query("SELECT * FROM assets", self.conn))
-            financial_items_count = len(pd.read_sql_query("SELECT * FROM financial_items", self.conn))
+            counts = self.get_table_counts()
+            employees_count = counts.get('employees', 0)
+            assets_count = counts.get('assets', 0)
+            # بنود الأشهر المؤرشفة نقلت من financial_items لكنها تبقى ضمن العدد
+            archived_count = self._fetchone("SELECT COALESCE(SUM(item_count), 0) FROM financial_archives")[0]
+            financial_items_count = counts.get('financial_items', 0) + archived_count
 
             print("\n" + "="*60)
             print("🏗️  لوحة تحكم برنامج السهولة في البناء")
@@ -451,46 +3462,395 @@ class ConstructionProgram:
             print("="*60)
 
         except Exception as e:
-            print(f"❌ خطأ في عرض اللوحة: {e}")
+            logger.error("❌ خطأ في عرض اللوحة: %s", e)
+
+    def get_table_counts(self):
+        """أعداد الصفوف من جدول التجميع دون مسح الجداول"""
+        return dict(self._fetchall("SELECT table_name, row_count FROM table_counts"))
+
+    def get_employee_totals(self, directorate=None):
+        """إجمالي الموظفين والنشطين ومجموع التواجد من جدول التجميع"""
+        query = '''
+        SELECT COALESCE(SUM(employee_count), 0),
+               COALESCE(SUM(CASE WHEN status = 'active' THEN employee_count END), 0),
+               COALESCE(SUM(attendance_sum), 0)
+        FROM employee_rollups
+        '''
+        params = []
+        if directorate:
+            query += " WHERE directorate = ?"
+            params.append(directorate)
+        total, active, attendance_sum = self._fetchone(query, params)
+        return {'total': total, 'active': active, 'attendance_sum': attendance_sum}
+
+    def rebuild_rollups(self):
+        """إعادة حساب جداول التجميع بعد التعديلات الجماعية"""
+        try:
+            def rebuild(conn):
+                _rebuild_rollups(conn.cursor())
+                _rebuild_financial_summary(conn.cursor())
+
+            self.db.write(rebuild)
+            logger.info("✅ تم إعادة حساب جداول التجميع")
+            return True
+        except Exception as e:
+            logger.error("❌ خطأ في إعادة حساب جداول التجميع: %s", e)
+            return False
 
     # ██████████████████████████████████████████████████████████████████████████████
-    # ████████████████████████████ الإعدادات ███████████████████████████████████████
+    # ████████████████████████████ النسخ الاحتياطي █████████████████████████████████
     # ██████████████████████████████████████████████████████████████████████████████
 
-    def save_setting(self, setting_type, setting_name, setting_value):
-        """حفظ الإعدادات"""
+    def backup(self, dest, compress=None, verify=True, pages=1024, sleep=0.005, progress=None):
+        """نسخة احتياطية متسقة أثناء التشغيل عبر واجهة النسخ في SQLite
+
+        تنسخ الصفحات على دفعات من pages صفحة مع استراحة sleep ثانية بينها،
+        من معاملة قراءة واحدة فتكون النسخة لقطة متسقة ولا تتوقف الكتابات
+        (وضع WAL). تضغط بـ gzip إذا انتهى dest بـ .gz أو مع compress=True،
+        ويفحص integrity_check النسخة قبل استبدال الملف النهائي.
+        progress(المنسوخ, الإجمالي) يستدعى بعد كل دفعة. ملفات أرشيف الأشهر المالية
+        لا تتغير بعد إنشائها ولا تشملها النسخة، فتنسخ مع القاعدة كملفات عادية.
+        """
+        compress = str(dest).endswith('.gz') if compress is None else compress
+        report = {'dest': dest, 'pages': 0, 'bytes': 0, 'compressed': compress, 'elapsed': 0.0}
+        started = time.perf_counter()
+        temp_path = f"{dest}.tmp"
+        copy_path = f"{dest}.db.tmp" if compress else temp_path
+
+        def step(status, remaining, total):
+            report['pages'] = total - remaining
+            if progress:
+                progress(total - remaining, total)
+
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "INSERT OR REPLACE INTO settings (setting_type, setting_name, setting_value) VALUES (?, ?, ?)",
-                (setting_type, setting_name, setting_value)
+            with self.db.dedicated_reader() as source:
+                target = sqlite3.connect(copy_path)
+                try:
+                    owns_transaction = not source.in_transaction
+                    if owns_transaction:
+                        # تثبيت لقطة القراءة حتى لا يعاد النسخ عند كل كتابة جديدة
+                        source.execute("BEGIN")
+                        source.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+                    try:
+                        source.backup(target, pages=pages, progress=step, sleep=sleep)
+                    finally:
+                        if owns_transaction:
+                            source.execute("COMMIT")
+                    # النسخة ملف واحد مستقل لا يحتاج ملفات WAL
+                    target.execute("PRAGMA journal_mode = DELETE")
+                    if verify:
+                        self._check_integrity(target)
+                finally:
+                    target.close()
+
+            if compress:
+                with open(copy_path, 'rb') as f, gzip.open(temp_path, 'wb', compresslevel=6) as out:
+                    shutil.copyfileobj(f, out, 1024 * 1024)
+                os.remove(copy_path)
+            os.replace(temp_path, dest)
+            report['bytes'] = os.path.getsize(dest)
+        except Exception as e:
+            for path in {temp_path, copy_path}:
+                if os.path.exists(path):
+                    os.remove(path)
+            logger.error("❌ خطأ في النسخ الاحتياطي: %s", e)
+            return report
+
+        report['elapsed'] = time.perf_counter() - started
+        logger.info("✅ تم النسخ الاحتياطي إلى %s (%s صفحة)", dest, report['pages'])
+        return report
+
+    def restore(self, src, verify=True):
+        """استعادة القاعدة من نسخة احتياطية (مضغوطة أو لا) دون إغلاق البرنامج
+
+        تفحص النسخة أولاً، ثم تنسخ صفحاتها إلى القاعدة الحالية عبر الكاتب بعد
+        تثبيت ما سبقها من كتابات. القراءات الجارية تكمل على لقطتها والقراءات
+        التالية ترى البيانات المستعادة. النسخ الأقدم ترقى إلى آخر إصدار للمخطط.
+        """
+        report = {'src': src, 'pages': 0, 'elapsed': 0.0}
+        started = time.perf_counter()
+        temp_path = f"{self.db_name}.restore.tmp"
+        compressed = str(src).endswith('.gz')
+
+        try:
+            if compressed:
+                with gzip.open(src, 'rb') as f, open(temp_path, 'wb') as out:
+                    shutil.copyfileobj(f, out, 1024 * 1024)
+            # للقراءة فقط: مسار خاطئ يفشل بدل إنشاء قاعدة فارغة تستعاد
+            source_path = os.path.abspath(temp_path if compressed else src)
+            source = sqlite3.connect(
+                f"file:{urllib_parse.quote(source_path)}?mode=ro", uri=True, check_same_thread=False
             )
-            self.conn.commit()
-            print(f"✅ تم حفظ الإعداد: {setting_name}")
+            try:
+                if verify:
+                    self._check_integrity(source)
+                report['pages'] = source.execute("PRAGMA page_count").fetchone()[0]
+                self.db.run_exclusive(lambda conn: source.backup(conn))
+            finally:
+                source.close()
+        except Exception as e:
+            logger.error("❌ خطأ في استعادة النسخة الاحتياطية: %s", e)
+            return report
+        finally:
+            if compressed and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        self.invalidate_employees_cache()
+        self._invalidate_settings_caches()
+        self.migrate_database()
+        report['elapsed'] = time.perf_counter() - started
+        logger.info("✅ تم استعادة القاعدة من %s", src)
+        return report
+
+    def _check_integrity(self, conn):
+        """فحص سلامة قاعدة (PRAGMA integrity_check) ورفع خطأ بأول المشاكل"""
+        problems = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+        if problems != ['ok']:
+            raise sqlite3.DatabaseError("فشل فحص السلامة: " + '; '.join(problems[:5]))
+
+    # ██████████████████████████████████████████████████████████████████████████████
+    # ████████████████████████████ الإعدادات ███████████████████████████████████████
+    # ██████████████████████████████████████████████████████████████████████████████
+
+    def save_setting(self, setting_type, setting_name, setting_value):
+        """حفظ الإعدادات (القيمة تحفظ بنوعها: نص أو رقم أو منطقي أو قاموس/قائمة)"""
+        if self.save_settings([(setting_type, setting_name, setting_value)]):
+            logger.info("✅ تم حفظ الإعداد: %s", setting_name)
             return True
+        return False
+
+    def save_settings(self, settings):
+        """حفظ مجموعة إعدادات [(النوع, الاسم, القيمة), ...] في معاملة واحدة
+
+        الإعداد الموجود بنفس (النوع, الاسم) تحدث قيمته في مكانها. المعدلات
+        والمعادلات ومعايير العهد يتحقق منها أولاً، وأي مخالفة تلغي الحفظ كله.
+        """
+        query = '''
+        INSERT INTO settings (setting_type, setting_name, setting_value, value_type, updated_at)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(setting_type, setting_name) DO UPDATE SET
+            setting_value = excluded.setting_value,
+            value_type = excluded.value_type,
+            updated_at = excluded.updated_at
+        '''
+        try:
+            settings = list(settings)
+            self._validate_settings(settings)
+            rows = [(setting_type, setting_name, *_encode_setting(setting_value))
+                    for setting_type, setting_name, setting_value in settings]
+            self.db.write(lambda conn: conn.executemany(query, rows))
         except Exception as e:
-            print(f"❌ خطأ في حفظ الإعداد: {e}")
+            logger.error("❌ خطأ في حفظ الإعدادات: %s", e)
             return False
+        finally:
+            self._invalidate_settings_caches()
+        return True
+
+    def _validate_settings(self, settings):
+        """التحقق من الإعدادات المالية قبل حفظها (ترفع ValueError عند المخالفة)
+
+        المعدل يجب أن يتحول إلى رقم. المعادلة يجب أن تترجم ولا تستخدم إلا
+        المعدلات (الحالية أو المحفوظة معها) و attendance و employee_count.
+        معيار العهد قاموس (أو نص JSON) فيه per_employee و base رقميان.
+        """
+        rates = set(self.get_financial_rates())
+        rates.update(name for setting_type, name, _ in settings if setting_type == RATE_SETTING_TYPE)
+        known = rates | {'attendance', 'employee_count'}
+        for setting_type, name, value in settings:
+            if setting_type == RATE_SETTING_TYPE:
+                try:
+                    float(value)
+                except (TypeError, ValueError):
+                    raise ValueError(f"المعدل {name} ليس رقماً: {value!r}") from None
+            elif setting_type == FORMULA_SETTING_TYPE:
+                try:
+                    formula = compile_formula(str(value))
+                except (SyntaxError, ValueError) as e:
+                    raise ValueError(f"معادلة البند {name} غير صالحة: {e}") from None
+                unknown = formula.names - known
+                if unknown:
+                    raise ValueError(f"أسماء غير معروفة في معادلة البند {name}: {', '.join(sorted(unknown))}")
+            elif setting_type == ASSET_STANDARD_SETTING_TYPE:
+                try:
+                    standard = json.loads(value) if isinstance(value, str) else value
+                    float(standard['per_employee'])
+                    float(standard['base'])
+                except (TypeError, ValueError, KeyError):
+                    raise ValueError(f"معيار العهدة {name} يحتاج per_employee و base رقميين") from None
+
+    def _invalidate_settings_caches(self):
+        """إبطال ذاكرتي الإعدادات والحسابات المالية بعد أي كتابة في settings"""
+        with self._settings_lock:
+            self._settings_version += 1
+            self._settings_cache = None
+            self._financial_cache.clear()
+
+    def _load_settings(self):
+        """كل الإعدادات من الذاكرة، أو من قاعدة البيانات في أول قراءة بعد الحفظ
+
+        تعيد ({النوع: {الاسم: القيمة}}, {الاسم: القيمة}) والثاني لكل اسم قيمة
+        آخر إعداد حدث بهذا الاسم أياً كان نوعه.
+        """
+        cached = self._settings_cache
+        if cached is None:
+            version = self._settings_version
+            settings, latest = {}, {}
+            # الترتيب بوقت آخر تحديث (ثم بالرقم عند التساوي) يجعل الأحدث آخراً في latest
+            for setting_type, setting_name, text, value_type in self._fetchall('''
+                SELECT setting_type, setting_name, setting_value, value_type FROM settings
+                ORDER BY COALESCE(updated_at, created_at), id
+            '''):
+                value = _decode_setting(text, value_type)
+                settings.setdefault(setting_type, {})[setting_name] = value
+                latest[setting_name] = value
+            cached = (settings, latest)
+            # قراءة بدأت قبل حفظ انتهى أثناءها قد تحمل قيماً قديمة فلا تحفظ
+            with self._settings_lock:
+                if self._settings_version == version:
+                    self._settings_cache = cached
+        return cached
+
+    def get_settings(self, setting_type=None):
+        """إعدادات نوع معين {الاسم: القيمة}، أو كلها {النوع: {الاسم: القيمة}}"""
+        try:
+            settings, _ = self._load_settings()
+            if setting_type is not None:
+                return dict(settings.get(setting_type, {}))
+            return {name: dict(values) for name, values in settings.items()}
+        except Exception as e:
+            logger.error("❌ خطأ في جلب الإعدادات: %s", e)
+            return {}
+
+    def get_setting(self, setting_name, setting_type=None, default=None):
+        """جلب الإعدادات (بالاسم، أو بالنوع والاسم عند تشابه الأسماء)
 
-    def get_setting(self, setting_name):
-        """جلب الإعدادات"""
+        بدون النوع تعاد قيمة آخر إعداد حدث بهذا الاسم بين كل الأنواع.
+        """
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "SELECT setting_value FROM settings WHERE setting_name = ?",
-                (setting_name,)
-            )
-            result = cursor.fetchone()
-            return result[0] if result else None
+            settings, latest = self._load_settings()
+            if setting_type is not None:
+                return settings.get(setting_type, {}).get(setting_name, default)
+            return latest.get(setting_name, default)
         except Exception as e:
-            print(f"❌ خطأ في جلب الإعداد: {e}")
-            return None
+            logger.error("❌ خطأ في جلب الإعداد: %s", e)
+            return default
+
+    def stats(self):
+        """إحصاءات الأداء: لكل دالة عامة ولكل جملة SQL عدد الاستدعاءات والصفوف والزمن
+
+        تعيد {'methods': ..., 'queries': ..., 'slow_queries': [...]}، أو قاموساً
+        فارغاً إذا أنشئ البرنامج بـ instrument=False.
+        """
+        return self.instrumentation.stats() if self.instrumentation else {}
+
+    def reset_stats(self):
+        """تصفير إحصاءات الأداء"""
+        if self.instrumentation:
+            self.instrumentation.reset()
 
     def close_connection(self):
         """إغلاق الاتصال بقاعدة البيانات"""
-        if self.conn:
-            self.conn.close()
-            print("✅ تم إغلاق الاتصال بقاعدة البيانات")
+        if self.db:
+            self.db.close()
+            logger.info("✅ تم إغلاق الاتصال بقاعدة البيانات")
+
+
+# برنامج القراءة الخاص بكل عملية في analyze_all_directorates
+_analysis_worker_program = None
+
+
+def _init_analysis_worker(db_name, rules, busy_timeout):
+    """تهيئة عملية تحليل: فتح البرنامج للقراءة فقط مرة واحدة لكل عملية"""
+    global _analysis_worker_program
+    builtin = {rule['name']: rule for rule in DISCREPANCY_RULES}
+    _analysis_worker_program = ConstructionProgram(
+        db_name, pool_size=1, busy_timeout=busy_timeout, read_only=True
+    )
+    _analysis_worker_program.discrepancy_rules = [
+        builtin[rule] if isinstance(rule, str) else rule for rule in rules
+    ]
+
+
+def _analyze_directorate_worker(directorate, month):
+    """تحليل مديرية واحدة داخل عملية التحليل"""
+    return directorate, _analysis_worker_program.comprehensive_analysis(directorate, month)
+
+
+class AsyncConstructionProgram:
+    """واجهة asyncio فوق ConstructionProgram لخدمات الويب غير المتزامنة
+
+    كل دالة عامة في البرنامج متاحة هنا كدالة تنتظر (await) بنفس الاسم
+    والمعاملات، وتنفذ في مجمع خيوط محدود فلا تحجب حلقة الأحداث. عدد
+    الاستدعاءات الجارية في نفس الوقت محدود بـ max_concurrency والبقية تنتظر
+    دورها دون أن تشغل خيطاً. الدوال المولدة (iter_report و iter_discrepancies)
+    تصبح مكررات غير متزامنة تقرأ دفعة واحدة في كل خطوة.
+
+        async with AsyncConstructionProgram(db_name='construction_program.db') as program:
+            employees = await program.get_employees('مديرية الشمال')
+            async for chunk in program.iter_report('مالي'):
+                ...
+    """
+
+    def __init__(self, program=None, max_workers=None, max_concurrency=None, **program_options):
+        self.program = program if program is not None else ConstructionProgram(**program_options)
+        # خيط لكل اتصال قراءة في المجمع يكفي، والزيادة تنتظر على المجمع نفسه
+        self.max_workers = max_workers or self.program.pool_size
+        self.max_concurrency = max_concurrency or self.max_workers
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix='construction-program-async'
+        )
+        self._limit = asyncio.Semaphore(self.max_concurrency)
+
+    async def run(self, function, *args, **kwargs):
+        """تنفيذ دالة متزامنة في مجمع الخيوط ضمن حد التزامن"""
+        async with self._limit:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(function, *args, **kwargs)
+            )
+
+    async def iterate(self, function, *args, **kwargs):
+        """تحويل دالة مولدة متزامنة إلى مكرر غير متزامن (خطوة واحدة في كل استدعاء)"""
+        iterator = await self.run(function, *args, **kwargs)
+        done = object()
+        try:
+            while True:
+                item = await self.run(next, iterator, done)
+                if item is done:
+                    return
+                yield item
+        finally:
+            # إغلاق المولد يحرر اتصال القراءة الخاص به حتى لو توقف المستهلك مبكراً
+            await self.run(iterator.close)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attribute = getattr(self.program, name)
+        if not callable(attribute):
+            return attribute
+
+        if inspect.isgeneratorfunction(attribute):
+            @functools.wraps(attribute)
+            def iterator(*args, **kwargs):
+                return self.iterate(attribute, *args, **kwargs)
+            return iterator
+
+        @functools.wraps(attribute)
+        async def method(*args, **kwargs):
+            return await self.run(attribute, *args, **kwargs)
+        return method
+
+    async def close_connection(self):
+        """إغلاق الاتصال وإيقاف مجمع الخيوط"""
+        await self.run(self.program.close_connection)
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close_connection()
 
 
 # ██████████████████████████████████████████████████████████████████████████████
@@ -571,7 +3931,156 @@ def main():
     program.close_connection()
 
 
+def cli(argv=None):
+    """سطر الأوامر للعمليات المفردة (تحديث تواجد، قراءة إعداد، تصدير...)
+
+    الأوامر البسيطة لا تستورد pandas ولا تنفذ جمل إنشاء الجداول إذا كانت
+    القاعدة على آخر إصدار، فيبقى زمن التشغيل البارد قصيراً.
+    """
+    parser = argparse.ArgumentParser(prog='construction_program', description='برنامج السهولة في البناء')
+    parser.add_argument('--db', default='construction_program.db', help='مسار قاعدة البيانات')
+    parser.add_argument('-q', '--quiet', action='store_true', help='إخفاء رسائل النجاح')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('dashboard', help='عرض لوحة التحكم')
+    commands.add_parser('schema-version', help='إصدار مخطط قاعدة البيانات')
+
+    command = commands.add_parser('get-setting', help='قراءة إعداد')
+    command.add_argument('name')
+    command.add_argument('--type', help='نوع الإعداد عند تشابه الأسماء')
+
+    command = commands.add_parser('set-setting', help='حفظ إعداد')
+    command.add_argument('type')
+    command.add_argument('name')
+    command.add_argument('value')
+    command.add_argument('--json', action='store_true', help='قراءة القيمة كـ JSON (رقم، منطقي، قاموس...)')
+
+    command = commands.add_parser('update-attendance', help='تحديث نسبة تواجد موظف')
+    command.add_argument('global_id')
+    command.add_argument('rate', type=float)
+
+    command = commands.add_parser('record-attendance', help='تسجيل حضور أو غياب موظف في يوم')
+    command.add_argument('global_id')
+    command.add_argument('date', help='YYYY-MM-DD')
+    command.add_argument('--absent', action='store_true', help='تسجيل غياب بدل حضور')
+
+    command = commands.add_parser('update-asset', help='تحديث كمية عهدة في موقع')
+    command.add_argument('name')
+    command.add_argument('quantity', type=int)
+    command.add_argument('location')
+
+    command = commands.add_parser('import-employees', help='استيراد موظفين من CSV أو Excel')
+    command.add_argument('path')
+
+    command = commands.add_parser('search', help='البحث عن موظفين أو عهد')
+    command.add_argument('text')
+    command.add_argument('--assets', action='store_true', help='البحث في العهد بدل الموظفين')
+    command.add_argument('--limit', type=int, default=20)
+    command.add_argument('--offset', type=int, default=0)
+
+    command = commands.add_parser('simulate', help='محاكاة سيناريوهات المسير والجهوزية')
+    command.add_argument('--month', help='YYYY-MM (افتراضياً الشهر الحالي)')
+    command.add_argument('--vary', action='append', default=[], metavar='NAME=V1,V2,...',
+                         help='قيم معامل أو معدل مالي (يتكرر، وتؤخذ كل التراكيب)')
+    command.add_argument('--directorates', help='المديريات المتأثرة مفصولة بفواصل (افتراضياً الجميع)')
+    command.add_argument('--by-directorate', action='store_true', help='صف لكل (سيناريو، مديرية)')
+    command.add_argument('--output', help='حفظ الجدول في ملف CSV بدل عرضه')
+
+    command = commands.add_parser('archive-financials', help='نقل الأشهر المالية المغلقة إلى ملفات أرشيف')
+    command.add_argument('--before', help='YYYY-MM (افتراضياً الشهر الحالي)')
+
+    command = commands.add_parser('backup', help='نسخة احتياطية أثناء التشغيل (.gz للضغط)')
+    command.add_argument('dest')
+    command.add_argument('--no-verify', dest='verify', action='store_false', help='تخطي فحص السلامة')
+
+    command = commands.add_parser('restore', help='استعادة القاعدة من نسخة احتياطية')
+    command.add_argument('src')
+    command.add_argument('--no-verify', dest='verify', action='store_false', help='تخطي فحص السلامة')
+
+    command = commands.add_parser('export', help='تصدير تقرير إلى CSV أو JSONL أو Parquet')
+    command.add_argument('report_type', choices=['بشري', 'مالي', 'ملخص مالي', 'عهد', 'تحليل'])
+    command.add_argument('dest')
+    command.add_argument('--directorate')
+    command.add_argument('--format', dest='fmt', choices=['csv', 'jsonl', 'parquet'])
+    command.add_argument('--month', dest='months', action='append', help='شهر التقرير المالي YYYY-MM (يتكرر)')
+    command.add_argument('--detailed', action='store_true', help='بنود التقرير المالي بدل الملخص الشهري')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format='%(message)s')
+
+    # عملية واحدة قصيرة: اتصال قراءة واحد يكفي ولا حاجة لعدادات الأداء
+    program = ConstructionProgram(args.db, pool_size=1, instrument=False)
+    try:
+        if args.command == 'dashboard':
+            program.show_dashboard()
+            return 0
+        if args.command == 'schema-version':
+            print(program.get_schema_version())
+            return 0
+        if args.command == 'get-setting':
+            value = program.get_setting(args.name, args.type)
+            if value is None:
+                return 1
+            print(value if isinstance(value, str) else json.dumps(value, ensure_ascii=False))
+            return 0
+        if args.command == 'set-setting':
+            value = json.loads(args.value) if args.json else args.value
+            return 0 if program.save_setting(args.type, args.name, value) else 1
+        if args.command == 'update-attendance':
+            return 0 if program.update_employee_attendance(args.global_id, args.rate) else 1
+        if args.command == 'record-attendance':
+            report = program.record_attendance_bulk(
+                [{'global_id': args.global_id, 'date': args.date, 'present': not args.absent, 'source': 'cli'}]
+            )
+            return 0 if report['recorded'] and not report['errors'] else 1
+        if args.command == 'update-asset':
+            return 0 if program.update_asset_quantity(args.name, args.quantity, args.location) else 1
+        if args.command == 'import-employees':
+            report = program.import_employees(args.path)
+            return 0 if report['imported'] and not report['errors'] else 1
+        if args.command == 'search':
+            search = program.search_assets if args.assets else program.search_employees
+            results = search(args.text, limit=args.limit, offset=args.offset)
+            if results.empty:
+                return 1
+            print(results.drop(columns='rank').to_string(index=False))
+            return 0
+        if args.command == 'simulate':
+            axes = {}
+            for option in args.vary:
+                name, _, values = option.partition('=')
+                axes[name.strip()] = [float(value) for value in values.split(',') if value.strip()]
+            if args.directorates:
+                axes['directorates'] = [[name.strip() for name in args.directorates.split(',')]]
+            results = program.simulate_scenarios(scenario_grid(**axes), args.month, args.by_directorate)
+            if results.empty:
+                return 1
+            if args.output:
+                results.to_csv(args.output, index=False, encoding='utf-8-sig')
+            else:
+                print(results.to_string(index=False))
+            return 0
+        if args.command == 'archive-financials':
+            return 0 if program.archive_financial_months(args.before)['elapsed'] else 1
+        if args.command == 'backup':
+            return 0 if program.backup(args.dest, verify=args.verify)['elapsed'] else 1
+        if args.command == 'restore':
+            return 0 if program.restore(args.src, verify=args.verify)['elapsed'] else 1
+        if args.command == 'export':
+            report = program.export_report(args.report_type, args.directorate, args.fmt, args.dest,
+                                           months=args.months, detailed=args.detailed)
+            # المدة لا تسجل إلا عند نجاح التصدير
+            return 0 if report['elapsed'] else 1
+    finally:
+        program.close_connection()
+    return 1
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(cli())
+    # التشغيل المباشر يعرض رسائل البرنامج كما هي
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     print("🚀 بدء تشغيل برنامج السهولة في البناء...")
     main()
     print("\n🎉 اكتمل تشغيل البرنامج بنجاح!")
@@ -0,0 +1,1173 @@
+# -*- coding: utf-8 -*-
+"""
+اختبارات برنامج السهولة في البناء
+"""
+import asyncio
+import contextlib
+import inspect
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import tracemalloc
+
+import pandas as pd
+import pytest
+
+import benchmark_construction_program as benchmark
+from construction_program import (
+    ASSET_STANDARD_SETTING_TYPE, AsyncConstructionProgram, ConstructionProgram,
+    EMPLOYEE_ORG_FIELDS, FORMULA_SETTING_TYPE, ORG_LEVELS, RATE_SETTING_TYPE, SCHEMA_VERSION,
+    cli, compile_formula, normalize_ar_many, scenario_grid,
+)
+
+
+def make_employee(index, **overrides):
+    """موظف تجريبي بمسار تنظيمي كامل"""
+    employee = {
+        'global_id': f'RSA-{index:04d}',
+        'functional_id': f'{index:03d}',
+        'full_name': f'أحمد محمد {index}',
+        'position': 'كهربائي' if index % 2 else 'سباك',
+        'level': 'م4',
+        'qualification': 'دبلوم كهرباء',
+        'training_courses': 'السلامة في المشاريع' if index % 3 else '',
+        'personal_equipment': 'خوذة أمان',
+        'equipment_notes': '',
+        'company': 'الشركة المعمارية العالمية',
+        'directorate': 'مديرية الرياض' if index % 2 else 'مديرية جدة',
+        'department': 'شعبة المشاريع',
+        'administration': 'إدارة المشاريع',
+        'branch': f'فرع {index % 3}',
+        'section': f'قسم {index % 4}',
+    }
+    employee.update(overrides)
+    return employee
+
+
+@pytest.fixture
+def program(tmp_path):
+    program = ConstructionProgram(str(tmp_path / 'program.db'))
+    yield program
+    program.close_connection()
+
+
+# مخطط القاعدة قبل الترحيلات كما أنشأته النسخة الأولى من البرنامج
+BASELINE_SCHEMA = '''
+CREATE TABLE organizational_structure (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    company TEXT NOT NULL,
+    directorate TEXT NOT NULL,
+    department TEXT NOT NULL,
+    administration TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    section TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE employees (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    global_id TEXT UNIQUE,
+    functional_id TEXT,
+    full_name TEXT NOT NULL,
+    position TEXT,
+    level TEXT,
+    qualification TEXT,
+    training_courses TEXT,
+    personal_equipment TEXT,
+    equipment_notes TEXT,
+    company TEXT,
+    directorate TEXT,
+    department TEXT,
+    administration TEXT,
+    branch TEXT,
+    section TEXT,
+    attendance_rate REAL DEFAULT 0,
+    status TEXT DEFAULT 'active',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE financial_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    item_name TEXT NOT NULL,
+    item_type TEXT,
+    amount REAL,
+    calculation_formula TEXT,
+    employee_count INTEGER,
+    attendance_rate REAL,
+    total_amount REAL,
+    month TEXT,
+    directorate TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE assets (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    asset_name TEXT NOT NULL,
+    asset_type TEXT,
+    current_quantity INTEGER,
+    required_quantity INTEGER,
+    missing_quantity INTEGER,
+    calculation_standard TEXT,
+    location TEXT,
+    status TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE analysis_records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    analysis_type TEXT,
+    employee_id INTEGER,
+    human_data TEXT,
+    financial_data TEXT,
+    logistic_data TEXT,
+    discrepancy_level TEXT,
+    recommendations TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE settings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    setting_type TEXT,
+    setting_name TEXT,
+    setting_value TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+'''
+
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    """قاعدة بالمخطط الأول فيها ستة موظفين وعهدة وإعداد مكرر"""
+    db_name = str(tmp_path / 'baseline.db')
+    employees = [make_employee(index) for index in range(6)]
+    with contextlib.closing(sqlite3.connect(db_name)) as conn:
+        conn.executescript(BASELINE_SCHEMA)
+        conn.executemany(
+            f"INSERT INTO employees ({', '.join(employees[0])}) VALUES ({', '.join('?' for _ in employees[0])})",
+            [tuple(employee.values()) for employee in employees]
+        )
+        # إعداد مكرر يبقى آخره فقط بعد إضافة المفتاح الفريد
+        conn.executemany(
+            "INSERT INTO settings (setting_type, setting_name, setting_value) VALUES (?, ?, ?)",
+            [('عام', 'اللغة', 'en'), ('عام', 'اللغة', 'ar')]
+        )
+        conn.execute("INSERT INTO assets (asset_name, asset_type, current_quantity, required_quantity, location) "
+                     "VALUES ('مولد', 'ثقيلة', 4, 10, 'الرياض')")
+        conn.commit()
+    return db_name
+
+
+def index_names(db_name):
+    with contextlib.closing(sqlite3.connect(db_name)) as conn:
+        return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+
+def make_financial_item(month, directorate='مديرية الرياض', total=100.0):
+    """بند مالي تجريبي"""
+    return {
+        'item_name': 'الرواتب', 'item_type': 'يدوي', 'amount': total / 2, 'calculation_formula': '',
+        'employee_count': 2, 'attendance_rate': 100.0, 'total_amount': total,
+        'month': month, 'directorate': directorate,
+    }
+
+
+def read_frame(db_name, query):
+    """قراءة مباشرة من ملف القاعدة دون المرور بالبرنامج"""
+    with contextlib.closing(sqlite3.connect(db_name)) as conn:
+        return pd.read_sql_query(query, conn)
+
+
+def table_columns(db_name, table):
+    with contextlib.closing(sqlite3.connect(db_name)) as conn:
+        return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def make_asset(name, location, current, required, asset_type='ثقيلة'):
+    """عهدة تجريبية"""
+    return {
+        'asset_name': name, 'asset_type': asset_type, 'current_quantity': current,
+        'required_quantity': required, 'calculation_standard': '', 'location': location, 'status': 'نشط',
+    }
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ الاستيراد ████████████████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+def test_bulk_import_and_reimport(program):
+    employees = [make_employee(index) for index in range(40)]
+    employees.append({'global_id': 'RSA-BAD', 'full_name': 'ناقص'})
+
+    report = program.add_employees_bulk(employees, chunk_size=16)
+    assert report['processed'] == 41
+    assert report['imported'] == 40
+    assert [error['global_id'] for error in report['errors']] == ['RSA-BAD']
+
+    # إعادة الاستيراد بنفس global_id تحدث الصفوف ولا تكررها
+    moved = [make_employee(index, full_name=f'خالد {index}', section='قسم جديد') for index in range(40)]
+    report = program.add_employees_bulk(moved, chunk_size=16)
+    assert report['imported'] == 40 and not report['errors']
+
+    employees = program.get_employees()
+    assert len(employees) == 40
+    assert set(employees['section']) == {'قسم جديد'}
+    assert employees['full_name'].str.startswith('خالد').all()
+
+
+def test_import_csv(program, tmp_path):
+    path = tmp_path / 'employees.csv'
+    employees = [make_employee(index) for index in range(5)]
+    lines = [','.join(employees[0])] + [','.join(employee.values()) for employee in employees]
+    path.write_text('\n'.join(lines), encoding='utf-8-sig')
+
+    report = program.import_employees(str(path))
+    assert report['imported'] == 5
+    assert sorted(program.get_employees()['global_id']) == [employee['global_id'] for employee in employees]
+
+
+def test_import_dataframe_with_missing_values(program):
+    frame = pd.DataFrame([make_employee(1), make_employee(2, training_courses=None)])
+    frame.loc[1, 'equipment_notes'] = float('nan')
+
+    report = program.import_employees(frame)
+    assert report['imported'] == 2 and not report['errors']
+    employees = program.get_employees().set_index('global_id')
+    assert employees.loc['RSA-0002', 'training_courses'] == ''
+    assert employees.loc['RSA-0002', 'equipment_notes'] == ''
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ الترحيلات ████████████████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+def test_migrates_baseline_database(baseline_db):
+    program = ConstructionProgram(baseline_db)
+    try:
+        assert program.get_schema_version() == SCHEMA_VERSION
+        assert len(program.get_employees()) == 6
+        assert program.get_setting('اللغة') == 'ar'
+        assert {'idx_employees_directorate_created', 'idx_settings_type_name'} <= index_names(baseline_db)
+        with contextlib.closing(sqlite3.connect(baseline_db)) as conn:
+            assert conn.execute("PRAGMA integrity_check").fetchone()[0] == 'ok'
+            assert conn.execute("SELECT COUNT(*) FROM settings").fetchone()[0] == 1
+    finally:
+        program.close_connection()
+
+
+def test_reopening_current_database_skips_migrations(program):
+    program.add_employee(make_employee(1))
+    reopened = ConstructionProgram(program.db_name)
+    try:
+        assert reopened.migrate_database() == SCHEMA_VERSION
+        assert len(reopened.get_employees()) == 1
+    finally:
+        reopened.close_connection()
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ التناقضات ████████████████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+def test_discrepancy_rules(program):
+    program.add_employees_bulk([make_employee(index) for index in range(6)])
+    program.update_employee_attendance('RSA-0001', 50)
+    program.update_employee_attendance('RSA-0003', 90)
+    program.update_employee_attendance('RSA-0005', 95)
+
+    # في مديرية الرياض: 1 (تواجد منخفض) و 3 (بدون دورات و تواجد 90) و 5 سليم
+    found = program.analyze_discrepancies('مديرية الرياض', '2024-01')
+    assert sorted((row['global_id'], row['level']) for row in found) == [
+        ('RSA-0001', 'high'), ('RSA-0003', 'medium')
+    ]
+    issues = {row['global_id']: row['issue'] for row in found}
+    assert issues['RSA-0001'].startswith('تواجد 50')
+    assert issues['RSA-0003'] == 'موظف بدون دورات تدريبية أساسية'
+
+    frame = program.analyze_discrepancies('مديرية الرياض', '2024-01', as_frame=True)
+    assert list(frame.columns) == ['employee_name', 'global_id', 'issue', 'level', 'recommendation']
+    assert program.analyze_discrepancies('مديرية غير موجودة', '2024-01') == []
+
+
+def test_custom_rule_matches_sql_scan(program):
+    program.add_employees_bulk([make_employee(index) for index in range(8)])
+    program.add_discrepancy_rule({
+        'name': 'plumbers',
+        'mask': lambda df: df['position'] == 'سباك',
+        'sql': "position = 'سباك'",
+        'issue': lambda df: 'سباك: ' + df['full_name'],
+        'level': 'low',
+        'recommendation': 'مراجعة التوزيع',
+    })
+    with pytest.raises(ValueError):
+        program.add_discrepancy_rule({'name': 'ناقصة'})
+
+    in_memory = program.analyze_discrepancies('مديرية جدة', '2024-01', as_frame=True)
+    scanned = pd.concat(program.iter_discrepancies('مديرية جدة', chunksize=2), ignore_index=True)
+    key = ['global_id', 'level', 'issue']
+    assert sorted(map(tuple, in_memory[key].values)) == sorted(map(tuple, scanned[key].values))
+    # كل موظفي جدة سباكون، وكلهم بتواجد 0
+    assert (in_memory['level'] == 'low').sum() == 4
+    assert (in_memory['level'] == 'high').sum() == 4
+
+
+def test_snapshot_reads_employees_once(program, monkeypatch):
+    program.add_employees_bulk([make_employee(index) for index in range(6)])
+    reads = []
+    get_employees = program.get_employees
+
+    def counted(directorate=None):
+        reads.append(directorate)
+        return get_employees(directorate)
+
+    monkeypatch.setattr(program, 'get_employees', counted)
+
+    report = program.comprehensive_analysis('مديرية الرياض')
+    assert report['الموظفين'] == 3
+    assert reads == ['مديرية الرياض']
+
+    # بعد تحميل الشركة كاملة تصفى المديريات من نفس القراءة
+    reads.clear()
+    snapshot = program.snapshot()
+    assert len(snapshot.employees()) == 6
+    assert len(snapshot.employees('مديرية جدة')) == 3
+    assert len(program.calculate_all_financials('مديرية جدة', '2024-01', snapshot=snapshot)) > 0
+    assert reads == [None]
+
+
+def test_employees_cache_is_invalidated_by_writes(tmp_path):
+    program = ConstructionProgram(str(tmp_path / 'cached.db'), cache_ttl=60)
+    try:
+        program.add_employee(make_employee(1))
+        first = program.get_employees()
+        assert program.get_employees() is first
+
+        program.add_employee(make_employee(2))
+        assert len(program.get_employees()) == 2
+        program.update_employee_attendance('RSA-0002', 70)
+        assert program.get_employees().set_index('global_id').loc['RSA-0002', 'attendance_rate'] == 70
+    finally:
+        program.close_connection()
+
+
+def test_employees_cache_skips_reads_overtaken_by_writes(tmp_path, monkeypatch):
+    program = ConstructionProgram(str(tmp_path / 'cached.db'), cache_ttl=60)
+    try:
+        program.add_employee(make_employee(1))
+        read_sql = program._read_sql
+
+        def read_then_write(*args, **kwargs):
+            # كتابة تنتهي بعد أن قرأ get_employees وقبل أن يملأ الذاكرة
+            df = read_sql(*args, **kwargs)
+            monkeypatch.setattr(program, '_read_sql', read_sql)
+            program.update_employee_attendance('RSA-0001', 70)
+            return df
+
+        monkeypatch.setattr(program, '_read_sql', read_then_write)
+        assert program.get_employees()['attendance_rate'].tolist() == [0]
+        assert program.get_employees()['attendance_rate'].tolist() == [70]
+    finally:
+        program.close_connection()
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ التجميع ██████████████████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+def test_rollups_follow_inserts_and_updates(program):
+    program.add_employees_bulk([make_employee(index) for index in range(10)])
+    program.update_employee_attendance('RSA-0001', 80)
+    program.update_employee_attendance('RSA-0003', 60)
+    program.add_financial_item(make_financial_item('2024-01'))
+
+    assert program.get_table_counts() == {'employees': 10, 'assets': 0, 'financial_items': 1}
+    riyadh = program.get_employee_totals('مديرية الرياض')
+    assert riyadh == {'total': 5, 'active': 5, 'attendance_sum': 140}
+
+    # إعادة البناء من الجداول تعطي نفس القيم المحدثة بالمشغلات
+    assert program.rebuild_rollups()
+    assert program.get_employee_totals('مديرية الرياض') == riyadh
+    assert program.get_employee_totals()['total'] == 10
+
+
+def test_rollups_are_built_for_migrated_database(baseline_db):
+    program = ConstructionProgram(baseline_db)
+    try:
+        assert program.get_table_counts() == {'employees': 6, 'assets': 1, 'financial_items': 0}
+        assert program.get_employee_totals('مديرية جدة')['total'] == 3
+    finally:
+        program.close_connection()
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ التواجد ██████████████████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+def test_attendance_events_roll_up_by_month(program):
+    program.add_employees_bulk([make_employee(1), make_employee(2)])
+    events = [
+        {'global_id': 'RSA-0001', 'date': f'2024-01-{day:02d}', 'present': day % 4 != 0} for day in range(1, 21)
+    ] + [
+        {'global_id': 'RSA-0001', 'date': '2024-02-01', 'present': 'غائب'},
+        {'global_id': 'RSA-0002', 'date': '2024-01-05', 'present': 'حاضر'},
+        {'global_id': 'RSA-0002', 'date': 'ليس تاريخاً'},
+        {'global_id': '', 'date': '2024-01-06'},
+        {'global_id': 'RSA-9999', 'date': '2024-01-06'},
+    ]
+
+    report = program.record_attendance_bulk(events, chunk_size=7)
+    assert report['processed'] == 25 and report['recorded'] == 22
+    assert [error['row'] for error in report['errors']] == [23, 24, 25]
+    assert report['errors'][-1]['global_id'] == 'RSA-9999'
+    assert program._fetchone("SELECT COUNT(*) FROM attendance_events WHERE global_id = 'RSA-9999'")[0] == 0
+
+    january = program.get_monthly_attendance('2024-01')
+    assert january.to_dict() == {'RSA-0001': 75.0, 'RSA-0002': 100.0}
+    assert program.get_monthly_attendance('2024-01', 'مديرية جدة').to_dict() == {'RSA-0002': 100.0}
+
+    # نفس الموظف في نفس اليوم يحدث الحركة، والتواجد الحالي من آخر شهر مسجل
+    program.record_attendance_bulk([{'global_id': 'RSA-0001', 'date': '2024-02-01', 'present': 1}])
+    assert program.get_monthly_attendance('2024-02').to_dict() == {'RSA-0001': 100.0}
+    employees = program.get_employees().set_index('global_id')
+    assert employees.loc['RSA-0001', 'attendance_rate'] == 100.0
+    assert employees.loc['RSA-0002', 'attendance_rate'] == 100.0
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ الجانب المالي ███████████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+def test_payroll_close_per_directorate_and_month(program):
+    program.add_employees_bulk([make_employee(index) for index in range(4)])
+    program.update_employee_attendance('RSA-0003', 50)
+    program.record_attendance_bulk([
+        {'global_id': 'RSA-0001', 'date': f'2024-01-0{day}', 'present': day != 4} for day in range(1, 5)
+    ])
+
+    payroll = program.run_payroll(['2024-01', '2024-02']).set_index(['month', 'directorate'])
+    assert len(payroll) == 4
+    riyadh = payroll.loc[('2024-01', 'مديرية الرياض')]
+    assert riyadh['employee_count'] == 2
+    assert riyadh['attendance_rate'] == 62.5
+    assert riyadh['الرواتب'] == 40000 * 0.75 + 40000 * 0.5
+    assert payroll.loc[('2024-02', 'مديرية جدة'), 'الإسكان'] == 2 * 15 * 30
+
+    # نفس نتيجة الحساب على مستوى المديرية
+    financials = program.calculate_all_financials('مديرية الرياض', '2024-01')
+    assert financials['الرواتب'] == riyadh['الرواتب']
+    assert financials['التغذية'][0] == riyadh['التغذية']
+
+    # إعادة الإقفال تستبدل البنود السابقة لنفس الأشهر والمديريات
+    items_per_close = 4 * 11
+    assert program.get_table_counts()['financial_items'] == items_per_close
+    program.run_payroll(['2024-01', '2024-02'])
+    assert program.get_table_counts()['financial_items'] == items_per_close
+    assert program.run_payroll('2024-03', write=False)['month'].tolist() == ['2024-03', '2024-03']
+    assert program.get_table_counts()['financial_items'] == items_per_close
+
+
+def test_formulas_are_restricted_and_vectorized():
+    for text in ('__import__("os")', 'basic_salary.real', '"نص" * 2', 'open("x")', 'min(a, key=b)'):
+        with pytest.raises(ValueError):
+            compile_formula(text)
+
+    formula = compile_formula('where(attendance > 50, basic_salary, min(basic_salary, 100))')
+    assert formula.names == {'attendance', 'basic_salary'}
+    result = formula.evaluate({'attendance': pd.Series([40, 60]), 'basic_salary': 1000})
+    assert list(result) == [100, 1000]
+    with pytest.raises(ValueError):
+        formula.evaluate({'attendance': 1})
+    assert compile_formula('1 + 2') is compile_formula('1 + 2')
+
+
+def test_settings_drive_rates_formulas_and_standards(program):
+    program.add_employees_bulk([make_employee(index) for index in range(4)])
+    before = program.calculate_all_financials('مديرية الرياض', '2024-01')
+    assert before['الصيانة'] == 2 * 150 * 30
+
+    program.save_setting(RATE_SETTING_TYPE, 'maintenance_rate', '100')
+    program.save_setting(FORMULA_SETTING_TYPE, 'الصيانة', 'maintenance_rate * days + employee_count')
+    after = program.calculate_all_financials('مديرية الرياض', '2024-01')
+    assert after['الصيانة'] == 2 * (100 * 30 + 2)
+    assert program.evaluate_formula('maintenance_rate * 2') == 200
+
+    assert program.calculate_assets_need('مديرية الرياض', 'ثقيلة') == 2
+    program.save_setting(ASSET_STANDARD_SETTING_TYPE, 'ثقيلة', json.dumps({'per_employee': 1, 'base': 3}))
+    assert program.calculate_assets_need('مديرية الرياض', 'ثقيلة') == 5
+
+
+def test_invalid_financial_settings_are_not_saved(program):
+    assert not program.save_setting(FORMULA_SETTING_TYPE, 'الصيانة', '__import__("os")')
+    assert not program.save_setting(FORMULA_SETTING_TYPE, 'الصيانة', 'maintenance_rate * (days')
+    assert not program.save_setting(FORMULA_SETTING_TYPE, 'الصيانة', 'maintenance_rate * unknown_rate')
+    assert not program.save_setting(RATE_SETTING_TYPE, 'basic_salary', 'كثير')
+    assert not program.save_setting(ASSET_STANDARD_SETTING_TYPE, 'ثقيلة', json.dumps({'per_employee': 1}))
+    # مخالفة واحدة تلغي الدفعة كلها
+    assert not program.save_settings([
+        (RATE_SETTING_TYPE, 'basic_salary', 1000),
+        (FORMULA_SETTING_TYPE, 'الرواتب', 'basic_salary * bonus'),
+    ])
+    assert program.get_settings(FORMULA_SETTING_TYPE) == {}
+    assert program.get_settings(RATE_SETTING_TYPE) == {}
+    assert program.get_financial_rates()['basic_salary'] == 40000
+
+    # المعادلة قد تستخدم معدلاً جديداً محفوظاً في نفس الدفعة
+    assert program.save_settings([
+        (RATE_SETTING_TYPE, 'bonus_rate', '0.1'),
+        (FORMULA_SETTING_TYPE, 'الرواتب', 'basic_salary * (1 + bonus_rate) * attendance / 100'),
+    ])
+    assert program.evaluate_formula('bonus_rate * 10') == 1
+
+
+def test_recalculate_financial_items_from_stored_formulas(program):
+    program.add_financial_item(dict(
+        make_financial_item('2024-01'),
+        calculation_formula='basic_salary * attendance / 100', employee_count=2, attendance_rate=50
+    ))
+    program.add_financial_item(dict(make_financial_item('2024-01'), calculation_formula='وصف نصي'))
+    program.add_financial_item(dict(make_financial_item('2024-02'), calculation_formula='days'))
+
+    program.save_setting(RATE_SETTING_TYPE, 'basic_salary', '1000')
+    assert program.recalculate_financial_items('2024-01') == 1
+    items = read_frame(program.db_name, "SELECT * FROM financial_items").set_index('calculation_formula')
+    assert items.loc['basic_salary * attendance / 100', ['amount', 'total_amount']].tolist() == [500, 1000]
+    assert items.loc['وصف نصي', 'total_amount'] == 100
+    assert items.loc['days', 'total_amount'] == 100
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ الاتصالات والتزامن ███████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+def test_concurrent_writers_share_one_writer(program):
+    def add(start):
+        for index in range(start, start + 10):
+            assert program.add_employee(make_employee(index))
+
+    threads = [threading.Thread(target=add, args=(start,)) for start in range(0, 60, 10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(program.get_employees()) == 60
+    assert program.get_table_counts()['employees'] == 60
+
+
+def test_failed_write_rolls_back_only_itself(program):
+    def fail(conn):
+        conn.execute("INSERT INTO settings (setting_type, setting_name, setting_value) VALUES ('عام', 'س', '1')")
+        raise RuntimeError('فشل متعمد')
+
+    with pytest.raises(RuntimeError):
+        program.db.write(fail)
+    assert program.save_setting('عام', 'ص', '2')
+    assert program._fetchall("SELECT setting_name FROM settings") == [('ص',)]
+
+    # اتصالات القراءة لا تقبل الكتابة
+    with program.db.read() as conn:
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("DELETE FROM settings")
+
+
+def test_memory_database_runs_inline():
+    program = ConstructionProgram(':memory:')
+    try:
+        program.add_employees_bulk([make_employee(index) for index in range(3)])
+        assert len(program.get_employees()) == 3
+        assert program.get_table_counts()['employees'] == 3
+    finally:
+        program.close_connection()
+
+
+def test_async_wrapper_runs_calls_concurrently(tmp_path):
+    db_name = str(tmp_path / 'async.db')
+
+    async def scenario():
+        async with AsyncConstructionProgram(db_name=db_name, max_concurrency=2) as program:
+            results = await asyncio.gather(*(program.add_employee(make_employee(index)) for index in range(6)))
+            assert results == [True] * 6
+            assert program.db_name == db_name
+            employees = await program.get_employees('مديرية الرياض')
+            chunks = [chunk async for chunk in program.iter_report('بشري', chunksize=4)]
+            return employees, chunks
+
+    employees, chunks = asyncio.run(scenario())
+    assert len(employees) == 3
+    assert [len(chunk) for chunk in chunks] == [4, 2]
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ التقارير والتصدير ███████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+@pytest.mark.parametrize('fmt', ['csv', 'jsonl'])
+def test_export_report_streams_chunks(program, tmp_path, fmt):
+    program.add_employees_bulk([make_employee(index) for index in range(7)])
+    dest = tmp_path / f'employees.{fmt}'
+    written = []
+
+    report = program.export_report('بشري', dest=str(dest), chunksize=3, progress=written.append)
+    assert (report['rows'], report['chunks']) == (7, 3)
+    assert written == [3, 6, 7]
+    if fmt == 'csv':
+        exported = pd.read_csv(dest, encoding='utf-8-sig')
+    else:
+        exported = pd.read_json(dest, lines=True)
+    assert sorted(exported['global_id']) == [make_employee(index)['global_id'] for index in range(7)]
+    assert set(exported['full_name']) == {make_employee(index)['full_name'] for index in range(7)}
+
+
+def test_export_parquet(program, tmp_path):
+    pytest.importorskip('pyarrow')
+    program.add_employees_bulk([make_employee(index) for index in range(5)])
+    dest = tmp_path / 'employees.parquet'
+
+    report = program.export_report('بشري', 'مديرية جدة', dest=str(dest), chunksize=2)
+    assert report['rows'] == 3
+    assert sorted(pd.read_parquet(dest)['global_id']) == ['RSA-0000', 'RSA-0002', 'RSA-0004']
+
+
+def test_export_unsupported_format_leaves_no_file(program, tmp_path):
+    report = program.export_report('بشري', dest=str(tmp_path / 'employees.xml'))
+    assert report['rows'] == 0
+    assert list(tmp_path.glob('employees.*')) == []
+
+
+def test_parallel_analysis_matches_serial(program):
+    program.add_employees_bulk([make_employee(index) for index in range(9)])
+    program.add_employees_bulk([make_employee(index, directorate='مديرية الدمام') for index in range(9, 12)])
+
+    serial = program.analyze_all_directorates(workers=1, month='2024-01')
+    parallel = program.analyze_all_directorates(workers=2, month='2024-01')
+    assert parallel == serial
+    assert list(serial['المديريات']) == ['مديرية جدة', 'مديرية الرياض', 'مديرية الدمام']
+    assert serial['الإجمالي']['الموظفين'] == 12
+    assert serial['الإجمالي']['عدد_التناقضات'] == len(serial['التناقضات'])
+    directorates = {row['global_id']: row['directorate'] for row in serial['التناقضات']}
+    assert directorates['RSA-0001'] == 'مديرية الرياض'
+    assert directorates['RSA-0009'] == 'مديرية الدمام'
+
+
+def test_parallel_analysis_with_unpicklable_rule_runs_in_process(program, caplog):
+    program.add_employees_bulk([make_employee(index) for index in range(6)])
+    program.add_discrepancy_rule({
+        'name': 'plumbers', 'mask': lambda employees: employees['position'] == 'سباك',
+        'issue': 'سباك', 'level': 'منخفض', 'recommendation': 'مراجعة',
+    })
+
+    with caplog.at_level(logging.WARNING, logger='construction_program'):
+        parallel = program.analyze_all_directorates(workers=2, month='2024-01')
+    assert parallel == program.analyze_all_directorates(workers=1, month='2024-01')
+    assert sum(row['issue'] == 'سباك' for row in parallel['التناقضات']) == 3
+    assert 'لا تقبل التسلسل' in caplog.text
+
+
+def test_discrepancy_records_update_incrementally(program):
+    program.add_employees_bulk([make_employee(index) for index in range(6)])
+
+    report = program.update_discrepancy_records(chunksize=4)
+    assert (report['checked'], report['found']) == (12, 8)
+    assert program.update_discrepancy_records()['checked'] == 0
+
+    # تعديل موظف واحد يعيد فحصه وحده ويحذف التناقض الذي زال
+    program.update_employee_attendance('RSA-0001', 90)
+    report = program.update_discrepancy_records()
+    assert (report['checked'], report['found'], report['resolved']) == (2, 0, 1)
+    records = program.get_discrepancy_records('مديرية الرياض')
+    assert sorted(records['global_id']) == ['RSA-0003', 'RSA-0003', 'RSA-0005']
+    assert set(records.loc[records['global_id'] == 'RSA-0003', 'rule']) == {'low_attendance', 'missing_training'}
+
+    # القاعدة الجديدة تفحص الجميع مرة واحدة
+    program.add_discrepancy_rule({
+        'name': 'plumbers', 'mask': lambda df: df['position'] == 'سباك',
+        'issue': 'سباك', 'level': 'low', 'recommendation': 'مراجعة التوزيع',
+    })
+    report = program.update_discrepancy_records()
+    assert (report['checked'], report['found']) == (6, 3)
+    assert len(program.get_discrepancy_records()) == 10
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ قياس الأداء ██████████████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+def test_stats_count_methods_and_queries(tmp_path, caplog):
+    program = ConstructionProgram(str(tmp_path / 'stats.db'), slow_query_ms=0)
+    try:
+        program.reset_stats()
+        with caplog.at_level(logging.INFO, logger='construction_program'):
+            assert program.add_employee(make_employee(1))
+            program.get_employees()
+            program.get_employees('مديرية الرياض')
+        assert any('✅' in record.getMessage() for record in caplog.records)
+
+        stats = program.stats()
+        assert stats['methods']['add_employee']['calls'] == 1
+        assert stats['methods']['get_employees']['calls'] == 2
+        assert stats['methods']['get_employees']['errors'] == 0
+        inserts = [key for key in stats['queries'] if key.startswith('INSERT INTO employees')]
+        assert inserts and stats['queries'][inserts[0]]['rows'] == 1
+        assert stats['slow_queries'] and {'sql', 'duration_ms', 'rows'} <= set(stats['slow_queries'][0])
+
+        program.reset_stats()
+        assert program.stats() == {'methods': {}, 'queries': {}, 'slow_queries': []}
+    finally:
+        program.close_connection()
+
+
+def test_instrumentation_can_be_disabled(tmp_path):
+    program = ConstructionProgram(str(tmp_path / 'plain.db'), instrument=False)
+    try:
+        assert program.add_employee(make_employee(1))
+        assert len(program.get_employees()) == 1
+        assert program.stats() == {}
+    finally:
+        program.close_connection()
+
+
+def test_benchmark_times_without_tracing_and_stays_quiet(capsys, caplog):
+    tracing = []
+
+    def operation():
+        tracing.append(tracemalloc.is_tracing())
+        benchmark.construction_program.logger.error("❌ رسالة أثناء القياس")
+        print('طباعة أثناء القياس', file=sys.stderr)
+        return [0] * 1000
+
+    result = benchmark.measure('operation', operation, repeat=3)
+    # ثلاث مرات للزمن بلا تتبع ثم مرة منفصلة للذاكرة
+    assert tracing == [False, False, False, True]
+    assert result['rows'] == 1000 and result['peak_python_memory_mb'] > 0
+    assert capsys.readouterr().err == '' and not caplog.records
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ سطر الأوامر ██████████████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+def test_import_does_not_load_pandas():
+    code = "import sys, construction_program; print('pandas' in sys.modules, 'numpy' in sys.modules)"
+    result = subprocess.run(
+        [sys.executable, '-c', code], capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(inspect.getfile(cli))),
+    )
+    assert result.stdout.split() == ['False', 'False']
+
+
+def test_cli_commands(tmp_path, capsys):
+    db_name = str(tmp_path / 'cli.db')
+    assert cli(['--db', db_name, '-q', 'schema-version']) == 0
+    assert capsys.readouterr().out.strip() == str(SCHEMA_VERSION)
+
+    assert cli(['--db', db_name, '-q', 'set-setting', 'عام', 'اللغة', 'ar']) == 0
+    assert cli(['--db', db_name, '-q', 'get-setting', 'اللغة']) == 0
+    assert capsys.readouterr().out.strip() == 'ar'
+    assert cli(['--db', db_name, '-q', 'get-setting', 'غير موجود']) == 1
+
+    program = ConstructionProgram(db_name)
+    try:
+        assert program.add_employee(make_employee(1))
+    finally:
+        program.close_connection()
+    assert cli(['--db', db_name, '-q', 'update-attendance', 'RSA-0001', '90']) == 0
+    assert cli(['--db', db_name, '-q', 'record-attendance', 'RSA-0001', '2024-01-02', '--absent']) == 0
+    # تاريخ بصيغة خاطئة: يرفض الصف ويعاد رمز خطأ
+    assert cli(['--db', db_name, '-q', 'record-attendance', 'RSA-0001', '02/01/2024']) == 1
+    assert cli(['--db', db_name, '-q', 'record-attendance', 'RSA-9999', '2024-01-02']) == 1
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ الهيكل التنظيمي ██████████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+def test_migration_moves_org_text_to_units(baseline_db):
+    program = ConstructionProgram(baseline_db)
+    try:
+        # نصوص الهيكل حذفت من الصفوف وتبقى مقروءة كما كانت عبر الوحدة
+        columns = table_columns(baseline_db, 'employees')
+        assert 'directorate' in columns and 'org_unit_id' in columns
+        assert not set(EMPLOYEE_ORG_FIELDS) & set(columns)
+        migrated = program.get_employees().sort_values('global_id')
+        for index, row in enumerate(migrated.to_dict('records')):
+            employee = make_employee(index)
+            assert {level: row[level] for level in ORG_LEVELS} == {level: employee[level] for level in ORG_LEVELS}
+        report = program.generate_report('بشري', 'مديرية الرياض')
+        assert set(report['section']) == {'قسم 1', 'قسم 3'}
+    finally:
+        program.close_connection()
+
+
+def test_reimport_moves_employees_between_units(program):
+    program.add_employees_bulk([make_employee(index) for index in range(40)])
+    moved = [make_employee(index, section='قسم جديد') for index in range(40)]
+    assert program.add_employees_bulk(moved)['imported'] == 40
+
+    assert set(program.get_employees()['section']) == {'قسم جديد'}
+    assert program.find_org_unit(*(moved[0][level] for level in ORG_LEVELS)) is not None
+    assert program.find_org_unit('الشركة المعمارية العالمية', 'مديرية غير موجودة') is None
+    sections = program.get_org_totals('section')
+    assert sections.loc[sections['name'] == 'قسم جديد', 'employee_count'].sum() == 40
+    assert sections.loc[sections['name'] != 'قسم جديد', 'employee_count'].sum() == 0
+    directorates = program.get_org_totals('directorate').set_index('name')
+    assert directorates.loc['مديرية الرياض', 'employee_count'] == 20
+
+
+def test_analyze_org_unit_covers_subtree(program):
+    program.add_employees_bulk([make_employee(index) for index in range(8)])
+    program.update_employee_attendance('RSA-0001', 80)
+    program.update_employee_attendance('RSA-0003', 60)
+    riyadh = program.find_org_unit('الشركة المعمارية العالمية', 'مديرية الرياض')
+
+    analysis = program.analyze_org_unit(riyadh)
+    assert analysis['المستوى'] == 'directorate'
+    assert analysis['الموظفين'] == 4
+    assert analysis['متوسط_التواجد'] == pytest.approx(35.0)
+    assert program.analyze_org_unit(-1) == {}
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ العهد ████████████████████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+def test_asset_ledger_balances(program):
+    program.add_asset(make_asset('مولد', 'مديرية الرياض', 1, 10))
+    asset_id = program._fetchone("SELECT id FROM assets")[0]
+
+    report = program.record_asset_movements([
+        {'asset_name': 'مولد', 'location': 'مديرية الرياض', 'quantity_change': 3, 'reason': 'استلام'},
+        {'asset_id': asset_id, 'quantity_change': -1, 'reason': 'صرف'},
+        {'asset_id': 9999, 'quantity_change': 1},
+        {'asset_name': 'مولد', 'location': 'مديرية جدة', 'quantity_change': 1},
+    ])
+    assert report['recorded'] == 2
+    assert [error['row'] for error in report['errors']] == [3, 4]
+    assert program._fetchone("SELECT current_quantity, missing_quantity FROM assets") == (3, 7)
+
+    # الجرد يسجل الفرق كحركة
+    assert program.update_asset_quantity('مولد', 5, 'مديرية الرياض')
+    ledger = program.get_asset_ledger('مولد')
+    assert ledger['balance'].tolist() == [1, 4, 3, 5]
+    assert ledger['quantity_change'].tolist()[-1] == 2
+
+    # السجل للإضافة فقط
+    with pytest.raises(sqlite3.DatabaseError):
+        program.db.write(lambda conn: conn.execute("DELETE FROM asset_ledger"))
+
+
+def test_asset_shortages_per_location(program):
+    program.add_employees_bulk([make_employee(index) for index in range(6)])
+    program.add_asset(make_asset('مولد', 'مديرية الرياض', 5, 0))
+
+    shortages = program.compute_asset_shortages()
+    assert len(shortages) == 2 * 5
+    heavy = shortages[shortages['asset_type'] == 'ثقيلة'].set_index('location')
+    assert heavy.loc['مديرية الرياض', ['required_quantity', 'missing_quantity']].tolist() == [2, 0]
+    assert heavy.loc['مديرية جدة', ['required_quantity', 'missing_quantity']].tolist() == [2, 2]
+    assert len(program.get_asset_shortages('مديرية جدة')) == 5
+    assert 'ثقيلة' not in set(program.get_asset_shortages('مديرية الرياض')['asset_type'])
+
+
+def test_asset_shortages_on_empty_database(program):
+    program.db.write(lambda conn: conn.execute(
+        "INSERT INTO asset_shortages (location, asset_type, employee_count, required_quantity, "
+        "current_quantity, missing_quantity) VALUES ('مديرية قديمة', 'ثقيلة', 1, 2, 0, 2)"))
+
+    shortages = program.compute_asset_shortages()
+    assert shortages.empty
+    assert 'missing_quantity' in shortages
+    # النواقص القديمة تمسح حتى لو لم يبق شيء يحسب
+    assert program.get_asset_shortages(only_missing=False).empty
+
+
+def test_migration_opens_asset_ledger(baseline_db):
+    program = ConstructionProgram(baseline_db)
+    try:
+        assert program.get_asset_ledger('مولد')['balance'].tolist() == [4]
+        assert program._fetchone("SELECT missing_quantity FROM assets")[0] == 6
+    finally:
+        program.close_connection()
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ البحث ████████████████████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+def test_search_index_follows_employee_changes(program):
+    program.add_employees_bulk([make_employee(1, full_name='إبراهيم الأحمد'), make_employee(2)])
+
+    # الهمزات والتاء المربوطة لا تؤثر، والكلمة تطابق بدايات الكلمات
+    found = program.search_employees('ابراه')
+    assert found['global_id'].tolist() == ['RSA-0001']
+    assert found['section'].tolist() == ['قسم 1']
+    assert program.search_employees('احمد', directorate='مديرية جدة')['global_id'].tolist() == ['RSA-0002']
+
+    program.add_employees_bulk([make_employee(1, full_name='يوسف الأحمد')])
+    assert program.search_employees('ابراهيم').empty
+    assert program.search_employees('يوسف')['global_id'].tolist() == ['RSA-0001']
+
+    program.db.write(lambda conn: conn.execute("DELETE FROM employees WHERE global_id = 'RSA-0001'"))
+    assert program.search_employees('يوسف').empty
+
+    assert program.rebuild_search_index()
+    assert program.search_employees('أحمد محمد')['global_id'].tolist() == ['RSA-0002']
+
+
+def test_search_assets(program):
+    program.add_asset(make_asset('خلاطة خرسانة', 'مديرية الرياض', 1, 2, asset_type='متوسطة'))
+    program.add_asset(make_asset('مولد كهرباء', 'مديرية جدة', 1, 2))
+
+    assert program.search_assets('خرسانه')['asset_name'].tolist() == ['خلاطة خرسانة']
+    assert program.search_assets('مديرية', location='مديرية جدة')['asset_name'].tolist() == ['مولد كهرباء']
+    program.update_asset_quantity('مولد كهرباء', 4, 'مديرية جدة')
+    assert program.search_assets('مولد')['current_quantity'].tolist() == [4]
+
+
+def test_writers_index_search_rows_without_triggers(program):
+    triggers = {name for name, in program._fetchall("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    assert {'trg_employees_fts_delete', 'trg_assets_fts_delete'} <= triggers
+    assert not {'trg_employees_fts_insert', 'trg_employees_fts_update', 'trg_assets_fts_insert'} & triggers
+    assert normalize_ar_many(['أحمد', 'فاطمة\x1fعلي', '']) == ['احمد', 'فاطمه\x1fعلي', '']
+
+    # الاستيراد يكتب الفهرس لكل دفعة، والتشكيل يوحد مع بقية النص
+    employees = [make_employee(index, full_name=f'مُحمّد {index}') for index in range(25)]
+    program.add_employees_bulk(employees, chunk_size=10)
+    assert len(program.search_employees('محمد', limit=100)) == 25
+
+    # الصفوف المضافة بجمل SQL مباشرة تدخل الفهرس بإعادة بنائه
+    program.db.write(lambda conn: conn.execute("UPDATE employees SET position = 'نجار' WHERE global_id = 'RSA-0001'"))
+    assert program.search_employees('نجار').empty
+    assert program.rebuild_search_index()
+    assert program.search_employees('نجار')['global_id'].tolist() == ['RSA-0001']
+
+
+def test_migration_indexes_existing_rows(baseline_db):
+    program = ConstructionProgram(baseline_db)
+    try:
+        assert len(program.search_employees('احمد')) == 6
+        assert program.search_assets('مولد')['location'].tolist() == ['الرياض']
+    finally:
+        program.close_connection()
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ الإعدادات ███████████████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+def test_settings_keep_their_types(program):
+    values = {'نص': 'ar', 'عدد': 3, 'كسر': 2.5, 'منطقي': True, 'قاموس': {'a': [1, 2]}, 'قائمة': ['x', 'y']}
+    assert program.save_settings([('عام', name, value) for name, value in values.items()])
+    assert program.get_settings('عام') == values
+    assert program.get_setting('منطقي') is True
+    assert program.get_setting('غير موجود', default=7) == 7
+
+    # التحديث في مكانه: نفس الصف ونفس created_at
+    before = read_frame(program.db_name, "SELECT id, created_at FROM settings WHERE setting_name = 'عدد'")
+    assert program.save_setting('عام', 'عدد', 4)
+    after = read_frame(program.db_name, "SELECT id, created_at, value_type FROM settings WHERE setting_name = 'عدد'")
+    assert after[['id', 'created_at']].equals(before)
+    assert after['value_type'].tolist() == ['int']
+    assert program.get_setting('عدد', 'عام') == 4
+
+
+def test_settings_are_read_from_cache(program):
+    program.save_setting('عام', 'اللغة', 'ar')
+    program.get_setting('اللغة')
+    program.reset_stats()
+    for _ in range(5):
+        assert program.get_setting('اللغة') == 'ar'
+    assert not any('settings' in query for query in program.stats()['queries'])
+
+    # الحفظ يبطل الذاكرة ويغير المعدلات المشتقة منها
+    program.save_setting(RATE_SETTING_TYPE, 'basic_salary', 1000)
+    assert program.get_financial_rates()['basic_salary'] == 1000
+    assert program.get_setting('اللغة') == 'ar'
+
+
+def test_cli_typed_settings(tmp_path, capsys):
+    db_name = str(tmp_path / 'cli.db')
+    assert cli(['--db', db_name, '-q', 'set-setting', '--json', 'عام', 'الحد', '{"max": 3}']) == 0
+    assert cli(['--db', db_name, '-q', 'get-setting', '--type', 'عام', 'الحد']) == 0
+    assert json.loads(capsys.readouterr().out) == {'max': 3}
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ النسخ الاحتياطي ██████████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+@pytest.mark.parametrize('name', ['backup.db', 'backup.db.gz'])
+def test_backup_and_restore(program, tmp_path, name):
+    program.add_employees_bulk([make_employee(index) for index in range(5)])
+    program.save_setting('عام', 'اللغة', 'ar')
+
+    dest = str(tmp_path / name)
+    report = program.backup(dest)
+    assert report['pages'] > 0 and report['compressed'] == name.endswith('.gz')
+
+    program.add_employees_bulk([make_employee(index) for index in range(5, 9)])
+    program.save_setting('عام', 'اللغة', 'en')
+    assert len(program.get_employees()) == 9
+
+    report = program.restore(dest)
+    assert report['pages'] > 0
+    assert len(program.get_employees()) == 5
+    assert program.get_setting('اللغة') == 'ar'
+    assert program.get_table_counts()['employees'] == 5
+    assert len(program.search_employees('احمد')) == 5
+
+
+def test_restore_missing_backup_keeps_database(program, tmp_path):
+    program.add_employee(make_employee(1))
+    report = program.restore(str(tmp_path / 'missing.db'))
+    assert report['pages'] == 0
+    assert len(program.get_employees()) == 1
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ الأرشفة ██████████████████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+def test_financial_summary_follows_items(program):
+    program.add_financial_item(make_financial_item('2024-01'))
+    program.add_financial_item(make_financial_item('2024-01', total=40.0))
+    program.add_financial_item(make_financial_item('2024-01', directorate='مديرية جدة', total=50.0))
+
+    summary = program.get_financial_summary('2024-01')
+    assert summary['total_amount'].sum() == 190.0
+    riyadh = program.get_financial_summary(['2024-01'], directorate='مديرية الرياض')
+    assert riyadh['total_amount'].tolist() == [140.0]
+
+    program.db.write(lambda conn: conn.execute("DELETE FROM financial_items WHERE total_amount = 40"))
+    assert program.get_financial_summary('2024-01')['total_amount'].sum() == 150.0
+
+
+def test_archived_months_stay_readable(program, tmp_path):
+    for month in ('2023-11', '2024-01', '2024-02', '2099-01'):
+        program.add_financial_item(make_financial_item(month))
+    program.add_financial_item(make_financial_item('2024-01', directorate='مديرية جدة', total=50.0))
+
+    report = program.archive_financial_months(before='2025-01')
+    assert sorted(report['months']) == ['2023-11', '2024-01', '2024-02']
+    assert report['items'] == 4
+    assert sorted(path.name for path in tmp_path.glob('*_archive_*.db')) == [
+        'program_archive_2023.db', 'program_archive_2024.db'
+    ]
+    assert program._fetchone("SELECT COUNT(*) FROM financial_items")[0] == 1
+
+    items = program.get_financial_items()
+    assert items['month'].tolist() == ['2023-11', '2024-01', '2024-01', '2024-02', '2099-01']
+    assert len(program.get_financial_items('2024-01', 'مديرية جدة')) == 1
+    summary = program.get_financial_summary('2024-01')
+    assert summary['total_amount'].sum() == 150.0
+
+    # الشهر المؤرشف مغلق أمام البنود الجديدة
+    assert not program.add_financial_item(make_financial_item('2024-01'))
+
+
+# ██████████████████████████████████████████████████████████████████████████████
+# ████████████████████████████ المحاكاة █████████████████████████████████████████
+# ██████████████████████████████████████████████████████████████████████████████
+
+def test_scenario_baseline_matches_payroll(program):
+    program.add_employees_bulk([make_employee(index) for index in range(8)])
+    for index, rate in enumerate((100, 80, 60, 40)):
+        program.update_employee_attendance(f'RSA-{index:04d}', rate)
+
+    scenarios = scenario_grid(feeding_rate=[2500, 3000], attendance_change=[0, -10])
+    assert len(scenarios) == 4
+    table = program.simulate_scenarios(scenarios, month='2024-01')
+    assert table['name'].tolist()[0] == 'الأساس' and len(table) == 5
+
+    payroll = program.run_payroll('2024-01', write=False)
+    items = list(program.get_payroll_formulas())
+    assert table.loc[0, 'الإجمالي'] == pytest.approx(payroll[items].to_numpy().sum())
+    assert table.loc[0, 'العمال_المطلوبون'] == 8
+    changed = (table['feeding_rate'] != 2500) | (table['attendance_change'] != 0)
+    assert (table.loc[changed, 'الفرق_عن_الأساس'] != 0).all()
+    assert (table.loc[~changed, 'الفرق_عن_الأساس'] == 0).all() and (~changed).sum() == 2
+
+
+def test_scenario_limited_to_directorates(program):
+    program.add_employees_bulk([make_employee(index) for index in range(6)])
+    for index in range(6):
+        program.update_employee_attendance(f'RSA-{index:04d}', 90)
+
+    table = program.simulate_scenarios(
+        [{'name': 'جدة', 'attendance_change': -50, 'headcount_change': 100, 'directorates': 'مديرية جدة'}],
+        month='2024-01', by_directorate=True,
+    ).set_index(['name', 'directorate'])
+    assert table.loc[('جدة', 'مديرية الرياض'), 'الفرق_عن_الأساس'] == 0
+    assert table.loc[('جدة', 'مديرية جدة'), 'العمال_المطلوبون'] == 6
+    assert table.loc[('جدة', 'مديرية جدة'), 'الفرق_عن_الأساس'] != 0
+
+    assert program.simulate_scenarios([{'unknown_rate': 1}]).empty
+
+
+def test_payroll_employee_count_is_per_directorate(program):
+    program.add_employees_bulk([make_employee(index) for index in range(5)])
+    program.save_setting(FORMULA_SETTING_TYPE, 'الصيانة', 'maintenance_rate * days / employee_count')
+
+    payroll = program.run_payroll('2024-01', write=False).set_index('directorate')
+    assert payroll['employee_count'].to_dict() == {'مديرية الرياض': 2, 'مديرية جدة': 3}
+    assert payroll['الصيانة'].tolist() == [150 * 30, 150 * 30]
+
+
+def test_recalculate_skips_one_word_descriptions(program):
+    program.add_financial_item(dict(make_financial_item('2024-01'), calculation_formula='يومي'))
+    program.add_financial_item(dict(make_financial_item('2024-01'), calculation_formula='days * 2'))
+
+    assert program.recalculate_financial_items('2024-01') == 1
+    items = read_frame(program.db_name, "SELECT * FROM financial_items").set_index('calculation_formula')
+    assert items.loc['يومي', 'total_amount'] == 100
+    assert items.loc['days * 2', 'total_amount'] == 2 * 60
+
+
+def test_export_parquet_with_null_first_chunk(program, tmp_path):
+    pytest.importorskip('pyarrow')
+    for index in range(4):
+        program.add_financial_item(dict(
+            make_financial_item('2024-01'),
+            employee_count=None if index < 2 else index, calculation_formula=None if index < 2 else 'days',
+        ))
+    dest = tmp_path / 'financial.parquet'
+
+    report = program.export_report('مالي', 'مديرية الرياض', dest=str(dest), chunksize=2, detailed=True)
+    assert report['rows'] == 4
+    exported = pd.read_parquet(dest)
+    assert exported['employee_count'].tolist()[2:] == [2, 3]
+    assert exported['calculation_formula'].tolist()[2:] == ['days', 'days']
+
+
+def test_asset_movements_accept_duplicate_rows(program):
+    program.add_asset(make_asset('مولد', 'مديرية الرياض', 4, 10))
+    program.add_asset(make_asset('مولد', 'مديرية الرياض', 1, 2))
+    first, second = [row[0] for row in program._fetchall("SELECT id FROM assets ORDER BY id")]
+
+    report = program.record_asset_movements([
+        {'asset_name': 'مولد', 'location': 'مديرية الرياض', 'quantity_change': 3},
+        {'asset_id': second, 'quantity_change': -1},
+    ])
+    assert report['recorded'] == 2 and not report['errors']
+    assert dict(program._fetchall("SELECT id, current_quantity FROM assets")) == {first: 7, second: 0}
+    assert program.get_asset_ledger('مولد')['balance'].tolist() == [4, 1, 7, 0]
+
+
+def test_financial_report_includes_archived_months(program, tmp_path):
+    for month in ('2023-11', '2024-01', '2099-01'):
+        program.add_financial_item(make_financial_item(month))
+    program.archive_financial_months(before='2025-01')
+
+    # الملخص الشهري يشمل الأشهر المؤرشفة دون إرفاق ملفات الأرشيف
+    summary = program.generate_report('مالي')
+    assert summary['month'].tolist() == ['2023-11', '2024-01', '2099-01']
+    assert summary['total_amount'].tolist() == [100.0, 100.0, 100.0]
+    assert program.generate_report('مالي', months='2024-01')['item_count'].tolist() == [1]
+    assert len(program.generate_report('مالي', 'مديرية جدة')) == 0
+
+    detailed = program.generate_report('مالي', months=['2023-11', '2099-01'], detailed=True)
+    assert detailed['month'].tolist() == ['2023-11', '2099-01']
+    assert 'calculation_formula' in detailed
+    assert program.generate_report('مالي', detailed=True)['month'].tolist() == ['2023-11', '2024-01', '2099-01']
+    report = program.export_report('مالي', dest=str(tmp_path / 'financial.csv'), months=['2024-01', '2099-01'])
+    assert report['rows'] == 2
+    assert cli(['--db', program.db_name, '-q', 'export', 'مالي', str(tmp_path / 'items.csv'),
+                 '--month', '2023-11', '--detailed']) == 0
+    assert pd.read_csv(tmp_path / 'items.csv')['month'].tolist() == ['2023-11']